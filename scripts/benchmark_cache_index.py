@@ -0,0 +1,82 @@
+
+"""
+Recall versus latency of the approximate IVF and IVF-PQ cache indices against
+exact brute-force search (seqmod.modules.cache_index) on synthetic clustered keys
+(or on hidden states dumped by run_cache.py --dump).
+"""
+
+import time
+
+import torch
+
+from seqmod.modules.cache_index import BruteForceIndex, IVFIndex, IVFPQIndex
+
+
+def timed(func, *args, repeats=3):
+    start = time.time()
+    for _ in range(repeats):
+        output = func(*args)
+    return output, (time.time() - start) / repeats
+
+
+def recall(vals, expected):
+    hits = sum(len(set(v) & set(e)) for v, e in zip(vals.tolist(), expected.tolist()))
+    return hits / expected.nelement()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', default=1000000, type=int)
+    parser.add_argument('--dim', default=256, type=int)
+    parser.add_argument('--clusters', default=1000, type=int)
+    parser.add_argument('--dump', help='Use hidden states from run_cache.py --dump')
+    parser.add_argument('--num_queries', default=32, type=int)
+    parser.add_argument('--k', default=16, type=int)
+    parser.add_argument('--nlist', default=1024, type=int)
+    parser.add_argument('--num_subspaces', default=32, type=int)
+    parser.add_argument('--train_size', default=50000, type=int)
+    parser.add_argument('--nprobes', default=[1, 4, 16, 64], type=int, nargs='+')
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    torch.manual_seed(1001)
+    if args.dump is not None:
+        keys, *_ = torch.load(args.dump)
+        keys = keys.view(-1, keys.size(-1))[:args.size]
+        args.size, args.dim = keys.size()
+    else:
+        centers = torch.randn(args.clusters, args.dim)
+        keys = centers[torch.randint(0, args.clusters, (args.size,))] + \
+            0.5 * torch.randn(args.size, args.dim)
+    keys = keys.to(args.device)
+    vals = torch.arange(0, args.size, device=args.device)
+    queries = keys[torch.randint(0, args.size, (args.num_queries,))] + \
+        0.1 * torch.randn(args.num_queries, args.dim, device=args.device)
+
+    exact = BruteForceIndex(args.dim, args.size, device=args.device)
+    exact.add(keys, vals)
+    (_, expected), secs = timed(exact.search, queries, args.k)
+    print("{:<16} recall@{}: {:.3f}  {:8.2f}ms/batch  {:8.1f}MB".format(
+        'brute-force', args.k, 1.0, secs * 1000,
+        keys.nelement() * keys.element_size() / 2 ** 20))
+
+    train = keys[torch.randperm(args.size)[:args.train_size]]
+    for name in ('ivf', 'ivfpq'):
+        if name == 'ivf':
+            index = IVFIndex(args.dim, args.size, nlist=args.nlist, device=args.device)
+            nbytes = keys.nelement() * keys.element_size()
+        else:
+            index = IVFPQIndex(args.dim, args.size, nlist=args.nlist,
+                               num_subspaces=args.num_subspaces, device=args.device)
+            nbytes = args.size * args.num_subspaces
+        start = time.time()
+        index.train(train, niter=10, seed=1)
+        index.add(keys, vals)
+        print("{} train+add: {:.1f}s".format(name, time.time() - start))
+
+        for nprobe in args.nprobes:
+            (_, found), secs = timed(index.search, queries, args.k, nprobe)
+            print("{:<16} recall@{}: {:.3f}  {:8.2f}ms/batch  {:8.1f}MB".format(
+                '{} (nprobe={})'.format(name, nprobe), args.k,
+                recall(found, expected), secs * 1000, nbytes / 2 ** 20))
@@ -0,0 +1,66 @@
+
+"""
+Training throughput (tokens/sec over all ranks) of an LM trained with Trainer
+on random data with 1, 2, 4 ... processes (see seqmod.misc.distributed), each
+process using an even share of the cores.
+"""
+
+import os
+import time
+import tempfile
+
+import torch
+
+from seqmod.misc import Dict, BlockDataset, Trainer, distributed
+from seqmod.modules.lm import LM
+
+
+def make_data(args):
+    d = Dict(sequential=True)
+    d.fit([[str(i) for i in range(args.vocab)]])
+    data = torch.randint(0, args.vocab, (args.num_batches * args.batch_size * args.bptt,))
+    return d, data
+
+
+def run(args, d, data, outfile):
+    torch.manual_seed(1001)
+    model = LM(args.emb_dim, args.hid_dim, d, num_layers=args.num_layers, cell='LSTM')
+    dataset = BlockDataset(data, d, args.batch_size, args.bptt, fitted=True)
+    trainer = Trainer(model, {'train': dataset},
+                      torch.optim.SGD(model.parameters(), lr=0.1), max_norm=5)
+    # warm up
+    trainer.train_batches(2 * distributed.get_world_size(), 0)
+    start = time.time()
+    trainer.train(1, 0, run_test=False)
+    duration = time.time() - start
+    if distributed.is_master():
+        batches = len(dataset) // distributed.get_world_size() * distributed.get_world_size()
+        with open(outfile, 'w') as f:
+            f.write(str(batches * args.batch_size * args.bptt / duration))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nprocs', default='1,2,4,8')
+    parser.add_argument('--vocab', default=10000, type=int)
+    parser.add_argument('--emb_dim', default=256, type=int)
+    parser.add_argument('--hid_dim', default=512, type=int)
+    parser.add_argument('--num_layers', default=1, type=int)
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--bptt', default=35, type=int)
+    parser.add_argument('--num_batches', default=64, type=int)
+    args = parser.parse_args()
+
+    d, data = make_data(args)
+    fd, outfile = tempfile.mkstemp()
+    os.close(fd)
+    base = None
+    for nprocs in map(int, args.nprocs.split(',')):
+        distributed.spawn(run, nprocs, args, d, data, outfile)
+        with open(outfile) as f:
+            tokens = float(f.read())
+        base = base or tokens
+        print("nprocs={:<3} threads/proc={:<3} {:10.0f} tokens/sec (x{:.2f})".format(
+            nprocs, distributed.default_threads(nprocs), tokens, tokens / base))
+    os.remove(outfile)
@@ -0,0 +1,55 @@
+
+"""
+Import time of seqmod entry points in fresh interpreters (best of several
+runs) against bare interpreter startup, listing heavy optional
+dependencies pulled in by each import.
+
+python scripts/benchmark_import.py --repeats 5
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+
+STATEMENTS = [
+    'pass',
+    'import torch',
+    'import seqmod',
+    'from seqmod.misc import Dict',
+    'from seqmod.misc import Trainer',
+    'from seqmod.modules.lm import LM',
+    'import seqmod; seqmod.__commit__',
+]
+
+HEAVY = ('torch', 'sklearn', 'scipy', 'hyperopt', 'visdom', 'tensorboardX')
+
+REPORT = """
+import sys
+{statement}
+print(' '.join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def import_time(statement, repeats, cwd):
+    best, loaded = float('inf'), ''
+    for _ in range(repeats):
+        start = time.time()
+        loaded = subprocess.check_output(
+            [sys.executable, '-c', REPORT.format(statement=statement, heavy=HEAVY)],
+            cwd=cwd).decode('utf-8').strip()
+        best = min(best, time.time() - start)
+    return best, loaded
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', default=3, type=int)
+    args = parser.parse_args()
+
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for statement in STATEMENTS:
+        secs, loaded = import_time(statement, args.repeats, topdir)
+        print("{:<40} {:6.2f}s  {}".format(statement, secs, loaded))
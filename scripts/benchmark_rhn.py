@@ -0,0 +1,58 @@
+
+"""
+Training throughput (tokens/sec, forward and backward) of the step-wise RHN
+cells against the fused implementation with and without TorchScript.
+"""
+
+import time
+
+import torch
+
+from seqmod.modules.rnn import RHN, RHNCoupled
+
+
+def run(rnn, args, device):
+    inp = torch.randn(args.bptt, args.batch_size, args.emb_dim, device=device)
+    hidden = torch.zeros(1, args.batch_size, args.hid_dim, device=device)
+
+    def step():
+        rnn.zero_grad()
+        out, _ = rnn(inp, hidden)
+        out.sum().backward()
+
+    step()  # warm up (and compile)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(args.repeats):
+        step()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+    return args.repeats * args.bptt * args.batch_size / (time.time() - start)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--emb_dim', default=256, type=int)
+    parser.add_argument('--hid_dim', default=512, type=int)
+    parser.add_argument('--depth', default=5, type=int)
+    parser.add_argument('--bptt', default=35, type=int)
+    parser.add_argument('--batch_size', default=20, type=int)
+    parser.add_argument('--repeats', default=5, type=int)
+    parser.add_argument('--untied_noise', action='store_true')
+    parser.add_argument('--gpu', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if args.gpu else 'cpu'
+
+    for cell in (RHN, RHNCoupled):
+        rnn = cell(args.emb_dim, args.hid_dim, num_layers=args.depth,
+                   tied_noise=not args.untied_noise).to(device)
+        for name, fused, jit in [('step-wise', False, False),
+                                 ('fused', True, False),
+                                 ('fused+jit', True, True)]:
+            rnn.fused, rnn.jit = fused, jit
+            print("{:<12} {:<10} {:10.1f} tokens/sec".format(
+                cell.__name__, name, run(rnn, args, device)))
@@ -0,0 +1,95 @@
+
+"""
+Load generator for the continuous batching server (seqmod.misc.server).
+Requests with random seeds and lengths arrive following a Poisson process
+and are sent over HTTP to an in-process server (or to a running one with
+--url_port). Reports p50/p99 latency and throughput for each of the given
+maximum batch sizes (a batch size of 1 corresponds to serving the requests
+one after the other).
+"""
+
+import os
+import time
+import random
+import asyncio
+
+import numpy as np
+
+from seqmod.misc.dataset import Dict
+from seqmod.misc.server import GenerationServer, post
+from seqmod.modules.lm import LM
+import seqmod.utils as u
+
+from serve import make_worker
+
+
+async def load(args, port):
+    vocab = args.vocab
+
+    async def one(delay):
+        await asyncio.sleep(delay)
+        data = {'seed': random.sample(vocab, random.randint(0, 10)),
+                'max_seq_len': random.randint(args.min_len, args.max_len),
+                'method': random.choice(['sample', 'argmax']),
+                'temperature': random.choice([0.5, 1.0])}
+        start = time.time()
+        result = await post(data, host='localhost', port=port)
+        return time.time() - start, len(result['hyp'])
+
+    # poisson arrivals
+    delays = np.cumsum(np.random.exponential(1 / args.rate, args.num_requests))
+    start = time.time()
+    results = await asyncio.gather(*[one(delay) for delay in delays])
+    return results, time.time() - start
+
+
+def benchmark(model, args, max_batch_size):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = GenerationServer(make_worker(model), max_batch_size=max_batch_size)
+    port = args.port + max_batch_size
+    http = loop.run_until_complete(server.serve_http(port=port))
+    results, secs = loop.run_until_complete(load(args, port))
+    http.close()
+    loop.run_until_complete(server.stop())
+    loop.close()
+
+    latencies, tokens = zip(*results)
+    print("batch {:>3}  p50: {:.3f}s  p99: {:.3f}s  req/s: {:.1f}  tok/s: {:.1f}"
+          .format(max_batch_size, np.percentile(latencies, 50),
+                  np.percentile(latencies, 99), len(results) / secs,
+                  sum(tokens) / secs))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path')
+    parser.add_argument('--num_requests', default=200, type=int)
+    parser.add_argument('--rate', default=50., type=float, help='Requests/sec')
+    parser.add_argument('--min_len', default=10, type=int)
+    parser.add_argument('--max_len', default=50, type=int)
+    parser.add_argument('--max_batch_sizes', default=[1, 8, 32], type=int, nargs='+')
+    parser.add_argument('--port', default=8500, type=int)
+    # random model
+    parser.add_argument('--vocab_size', default=10000, type=int)
+    parser.add_argument('--hid_dim', default=512, type=int)
+    args = parser.parse_args()
+
+    if args.model_path is not None:
+        if os.path.isdir(args.model_path):
+            model = u.load_model(os.path.join(args.model_path, 'model.pt'))
+        else:
+            model = u.load_model(args.model_path)
+    else:
+        d = Dict(eos_token='<eos>', bos_token='<bos>')
+        d.fit([[str(i) for i in range(args.vocab_size)]])
+        model = LM(args.hid_dim, args.hid_dim, d, cell='LSTM')
+    model.eval()
+
+    args.vocab = [w for w in model.embeddings.d.vocab if not w.startswith('<')] \
+        if hasattr(model, 'embeddings') else \
+        [w for w in model.encoder.embeddings.d.vocab if not w.startswith('<')]
+
+    for max_batch_size in args.max_batch_sizes:
+        benchmark(model, args, max_batch_size)
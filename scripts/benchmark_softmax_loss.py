@@ -0,0 +1,82 @@
+
+"""
+Benchmark peak memory and speed of the full log-softmax loss against the
+chunked fused cross-entropy (FullSoftmax.chunked_loss) for a large vocabulary.
+
+On GPU peak memory is taken from the CUDA allocator, on CPU each run is done
+in a separate process and the increase in maximum resident set size is
+reported instead.
+"""
+
+import time
+import resource
+import multiprocessing
+
+import torch
+import torch.nn.functional as F
+
+from seqmod.modules.softmax import FullSoftmax
+
+
+def run(mode, args, device):
+    torch.manual_seed(1001)
+    softmax = FullSoftmax(args.hid_dim, args.hid_dim, args.vocab).to(device)
+    rows = args.bptt * args.batch_size
+    output = torch.randn(rows, args.hid_dim, device=device, requires_grad=True)
+    targets = torch.randint(0, args.vocab, (rows,), dtype=torch.int64, device=device)
+
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_max_memory_allocated()
+        base = torch.cuda.max_memory_allocated()
+    else:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.time()
+    for _ in range(args.repeats):
+        if mode == 'full':
+            loss = F.nll_loss(softmax(output), targets, size_average=False)
+        else:
+            loss = softmax.chunked_loss(output, targets, chunk_size=args.chunk_size)
+        loss.backward()
+
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        peak = (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+    else:
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) / 2 ** 10
+
+    return peak, (time.time() - start) / args.repeats, loss.item()
+
+
+def _run(queue, mode, args, device):
+    queue.put(run(mode, args, device))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vocab', default=100000, type=int)
+    parser.add_argument('--hid_dim', default=512, type=int)
+    parser.add_argument('--bptt', default=35, type=int)
+    parser.add_argument('--batch_size', default=20, type=int)
+    parser.add_argument('--chunk_size', default=1024, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('--gpu', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if args.gpu else 'cpu'
+    ctx = multiprocessing.get_context('spawn')
+
+    for mode in ('full', 'chunked'):
+        if device == 'cuda':
+            peak, secs, loss = run(mode, args, device)
+        else:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=_run, args=(queue, mode, args, device))
+            proc.start()
+            peak, secs, loss = queue.get()
+            proc.join()
+
+        print("{:<8} peak: {:8.1f}MB  time: {:.3f}s  loss: {:.4f}".format(
+            mode, peak, secs, loss))
@@ -0,0 +1,77 @@
+
+"""
+Per-step decoding latency of the stacked recurrent cells (StackedLSTM,
+StackedGRU, StackedNormalizedGRU) and full-sequence latency of NormalizedGRU,
+eager (python loop over layers/time) against TorchScript compiled loops.
+"""
+
+import time
+
+import torch
+
+from seqmod.modules.rnn import StackedLSTM, StackedGRU, StackedNormalizedGRU
+from seqmod.modules.rnn import NormalizedGRU
+
+
+def timed(func, repeats, device):
+    with torch.no_grad():
+        func()  # warm up (and compile)
+        func()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeats):
+            func()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+    return (time.time() - start) / repeats
+
+
+def step_latency(rnn, args, device):
+    inp = torch.randn(args.batch_size, args.emb_dim, device=device)
+    hidden = torch.zeros(args.num_layers, args.batch_size, args.hid_dim, device=device)
+    if isinstance(rnn, StackedLSTM):
+        hidden = hidden, hidden
+
+    def decode():
+        h = hidden
+        for _ in range(args.steps):
+            _, h = rnn(inp, h)
+
+    return timed(decode, args.repeats, device) / args.steps
+
+
+def seq_latency(rnn, args, device):
+    inp = torch.randn(args.steps, args.batch_size, args.emb_dim, device=device)
+    hidden = torch.zeros(args.num_layers, args.batch_size, args.hid_dim, device=device)
+    return timed(lambda: rnn(inp, hidden), args.repeats, device)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--emb_dim', default=256, type=int)
+    parser.add_argument('--hid_dim', default=512, type=int)
+    parser.add_argument('--num_layers', default=3, type=int)
+    parser.add_argument('--batch_size', default=16, type=int)
+    parser.add_argument('--steps', default=50, type=int)
+    parser.add_argument('--repeats', default=5, type=int)
+    parser.add_argument('--gpu', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if args.gpu else 'cpu'
+
+    for cls in (StackedLSTM, StackedGRU, StackedNormalizedGRU):
+        rnn = cls(args.num_layers, args.emb_dim, args.hid_dim).to(device).eval()
+        for jit in (False, True):
+            rnn.jit = jit
+            print("{:<22} {:<6} {:8.3f} ms/step".format(
+                cls.__name__, 'jit' if jit else 'eager',
+                step_latency(rnn, args, device) * 1000))
+
+    rnn = NormalizedGRU(args.emb_dim, args.hid_dim, args.num_layers).to(device).eval()
+    for jit in (False, True):
+        rnn.jit = jit
+        print("{:<22} {:<6} {:8.3f} ms/step".format(
+            'NormalizedGRU', 'jit' if jit else 'eager',
+            seq_latency(rnn, args, device) / args.steps * 1000))
@@ -0,0 +1,62 @@
+
+"""
+Export a trained LM or EncoderDecoder to TorchScript artifacts for serving
+(see seqmod.modules.export and seqmod.runtime) and compare the cold start
+(fresh interpreter, import + load) of the pickled model and the artifacts
+against bare interpreter startup (python + torch import).
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+from seqmod.modules.export import export_traced
+import seqmod.utils as u
+
+
+PICKLED = """
+import seqmod.utils as u
+u.load_model({path!r})
+"""
+
+TRACED = """
+import importlib.util
+spec = importlib.util.spec_from_file_location('runtime', {runtime!r})
+runtime = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(runtime)
+runtime.TracedModel({path!r})
+"""
+
+
+def cold_start(code, repeats=3):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code])
+        best = min(best, time.time() - start)
+    return best
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--no_timing', action='store_true')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.model_path):
+        args.model_path = os.path.join(args.model_path, 'model.pt')
+    model = u.load_model(args.model_path)
+    model.to(device=args.device)
+    print("Exported to {}".format(export_traced(model, args.output)))
+
+    if not args.no_timing:
+        import seqmod.runtime
+        print("interpreter startup: {:.2f}s".format(cold_start('import torch')))
+        print("cold start (pickled model): {:.2f}s".format(
+            cold_start(PICKLED.format(path=args.model_path))))
+        print("cold start (traced artifacts): {:.2f}s".format(
+            cold_start(TRACED.format(runtime=seqmod.runtime.__file__, path=args.output))))
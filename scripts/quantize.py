@@ -0,0 +1,147 @@
+
+"""
+Export a trained LM or EncoderDecoder with dynamic int8 quantization for CPU
+inference (see seqmod.modules.quantize) and report size, speed and quality
+(perplexity for LMs, BLEU for EncoderDecoders) against the float model on a
+held-out set.
+
+python scripts/quantize.py --model_path model.pt --output model.int8 \
+    --test_path test.txt                                    # LM
+python scripts/quantize.py --model_path model.pt --output model.int8 \
+    --src_path test.src --trg_path test.trg                 # EncoderDecoder
+"""
+
+import os
+import sys
+import math
+import time
+import collections
+
+import torch
+
+from seqmod.misc import text_processor
+from seqmod.loaders import load_lines
+from seqmod.modules.lm import BaseLM
+from seqmod.modules.quantize import quantize_dynamic, model_bytes
+import seqmod.utils as u
+
+
+def corpus_bleu(hyps, refs, max_n=4):
+    """
+    Corpus-level BLEU (single reference, no smoothing) on token lists.
+    """
+    matches, totals = [0] * max_n, [0] * max_n
+    hyp_len, ref_len = 0, 0
+    for hyp, ref in zip(hyps, refs):
+        hyp_len, ref_len = hyp_len + len(hyp), ref_len + len(ref)
+        for n in range(1, max_n + 1):
+            hyp_ngrams = collections.Counter(
+                tuple(hyp[i:i+n]) for i in range(len(hyp) - n + 1))
+            ref_ngrams = collections.Counter(
+                tuple(ref[i:i+n]) for i in range(len(ref) - n + 1))
+            matches[n-1] += sum((hyp_ngrams & ref_ngrams).values())
+            totals[n-1] += max(0, len(hyp) - n + 1)
+
+    if min(matches) == 0:
+        return 0.0
+    log_precision = sum(math.log(m / t) for m, t in zip(matches, totals)) / max_n
+    brevity = min(0.0, 1 - ref_len / max(hyp_len, 1))
+    return 100 * math.exp(log_precision + brevity)
+
+
+def lm_perplexity(model, sents, batch_tokens):
+    # sents are already transformed, so that token counts are known
+    log_prob = sum(score for score, _ in model.score_corpus(
+        sents, batch_tokens=batch_tokens))
+    return math.exp(-log_prob / sum(len(s) - 1 for s in sents))
+
+
+def translate_bleu(model, src, trg, batch_size, beam_width):
+    src_d, trg_d = model.encoder.embeddings.d, model.decoder.embeddings.d
+    specials = {trg_d.get_bos(), trg_d.get_eos(), trg_d.get_pad()}
+    hyps = []
+    for start in range(0, len(src), batch_size):
+        batch, lengths = src_d.pack(
+            list(src_d.transform(src[start:start+batch_size])), return_lengths=True)
+        lengths = torch.tensor(lengths)
+        if beam_width > 1:
+            _, batch_hyps, _ = model.translate_beam(
+                batch, lengths, beam_width=beam_width)
+        else:
+            _, batch_hyps, _ = model.translate(batch, lengths)
+        for hyp in batch_hyps:
+            hyps.append([trg_d.vocab[i] for i in hyp if i not in specials])
+    return corpus_bleu(hyps, trg)
+
+
+def timed(func, *args):
+    start = time.time()
+    with torch.no_grad():
+        output = func(*args)
+    return output, time.time() - start
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', required=True)
+    parser.add_argument('--output', help='Prefix to save the quantized model to')
+    parser.add_argument('--dtype', default='qint8', help='qint8 or float16')
+    # LM held-out data
+    parser.add_argument('--test_path')
+    parser.add_argument('--batch_tokens', default=4000, type=int)
+    # EncoderDecoder held-out data
+    parser.add_argument('--src_path')
+    parser.add_argument('--trg_path')
+    parser.add_argument('--batch_size', default=50, type=int)
+    parser.add_argument('--beam_width', default=1, type=int)
+    parser.add_argument('--max_sents', default=1000, type=int)
+    parser.add_argument('--lower', action='store_true')
+    parser.add_argument('--num', action='store_true')
+    parser.add_argument('--level', default='token')
+    parser.add_argument('--threads', type=int)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    print("Loading model...", file=sys.stderr)
+    if os.path.isdir(args.model_path):
+        model = u.load_model(os.path.join(args.model_path, 'model.pt'))
+    else:
+        model = u.load_model(args.model_path)
+    model.cpu().eval()
+
+    quantized = quantize_dynamic(model, dtype=getattr(torch, args.dtype))
+    if args.output is not None:
+        print("Saved quantized model to {}".format(u.save_model(quantized, args.output)))
+
+    float_size, quant_size = model_bytes(model), model_bytes(quantized)
+    print("size:  {:10.2f}MB -> {:10.2f}MB ({:+.1f}%)".format(
+        float_size / 2 ** 20, quant_size / 2 ** 20,
+        100 * (quant_size - float_size) / float_size))
+
+    processor = text_processor(lower=args.lower, num=args.num, level=args.level)
+
+    def lines(path):
+        return list(load_lines(path, processor=processor))[:args.max_sents]
+
+    if isinstance(model, BaseLM):
+        if args.test_path is None:
+            sys.exit(0)
+        sents = list(model.embeddings.d.transform(lines(args.test_path)))
+        metric = 'ppl'
+        func, func_args = lm_perplexity, (sents, args.batch_tokens)
+    else:
+        if args.src_path is None or args.trg_path is None:
+            sys.exit(0)
+        src, trg = lines(args.src_path), lines(args.trg_path)
+        metric = 'BLEU'
+        func, func_args = translate_bleu, (src, trg, args.batch_size, args.beam_width)
+
+    (float_score, float_secs) = timed(func, model, *func_args)
+    (quant_score, quant_secs) = timed(func, quantized, *func_args)
+    print("time:  {:10.2f}s  -> {:10.2f}s  (x{:.2f} speed-up)".format(
+        float_secs, quant_secs, float_secs / quant_secs))
+    print("{:<5}  {:10.2f}   -> {:10.2f}   ({:+.2f})".format(
+        metric + ':', float_score, quant_score, quant_score - float_score))
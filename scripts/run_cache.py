@@ -6,11 +6,10 @@ import itertools
 import numpy as np
 import tqdm
 import torch
-import torch.nn.functional as F
 
-from seqmod.misc import text_processor, BlockDataset, LossStatistics
+from seqmod.misc import text_processor, BlockDataset
 from seqmod.loaders import load_lines
-from seqmod.modules.cache import Cache
+from seqmod.modules.cache import evaluate_grid
 import seqmod.utils as u
 
 
@@ -39,6 +38,7 @@ if __name__ == '__main__':
     parser.add_argument('--theta', default=0.1, type=float)
     # test
     parser.add_argument('--run_grid', action='store_true')
+    parser.add_argument('--dump', help='File to store (or load) model outputs')
     parser.add_argument('--batch_size', default=50, type=int)
     parser.add_argument('--bptt', default=35, type=int)
     parser.add_argument('--device', default='cpu')
@@ -68,60 +68,51 @@ if __name__ == '__main__':
             torch.from_numpy(np.load(args.path).astype(np.int64)), d,
             args.batch_size, args.bptt, device=args.device, fitted=True)
 
-    cache = Cache(model.hid_dim, args.cache_size, len(d), device=args.device)
-    loss, hidden = LossStatistics('ppl'), None
-
-    def batch_index_add_(t, index, src):
+    def encode(model, dataset):
         """
-        t: (batch x vocab)
-        index: (batch x cache_size)
-        src: (batch x cache_size)
+        Run the model once over the dataset storing the output hidden states
+        and the probability assigned by the model to the targets.
         """
-        (batch, vocab) = t.size()
-        ex = torch.arange(0, batch, out=t.new()).unsqueeze(1).long() * vocab
-        t.view(-1).index_add_(
-            0,
-            (index + ex).view(-1),
-            src.view(-1))
+        outputs, targets, model_probs, hidden = [], [], [], None
+        for source, target in tqdm.tqdm(dataset):
+            # outs: (bptt x batch x hid)
+            outs, hidden, _ = model(source, hidden=hidden)
+            # (bptt x batch x vocab)
+            logprobs = model.project(outs, reshape=True)
+            model_probs.append(logprobs.gather(2, target.unsqueeze(2)).squeeze(2).exp())
+            outputs.append(outs)
+            targets.append(target)
+
+        return torch.cat(outputs), torch.cat(targets), torch.cat(model_probs)
+
+    with torch.no_grad():
+        if args.dump is not None and os.path.isfile(args.dump):
+            print("Loading model outputs...", file=sys.stderr)
+            outputs, targets, model_probs = torch.load(args.dump)
+            outputs, targets, model_probs = [
+                t.to(args.device) for t in (outputs, targets, model_probs)]
+        else:
+            print("Computing model outputs...", file=sys.stderr)
+            outputs, targets, model_probs = encode(model, test)
+            if args.dump is not None:
+                torch.save((outputs.cpu(), targets.cpu(), model_probs.cpu()), args.dump)
+
+        print("Computing perplexity...", file=sys.stderr)
+        if args.run_grid:
+            thetas = list(range_float(0, 1, 0.1))
+            alphas = list(range_float(0, 0.5, 0.01))
+        else:
+            thetas, alphas = [args.theta], [args.alpha]
 
-    print("Computing perplexity...", file=sys.stderr)
+        loss = evaluate_grid(outputs, targets, model_probs, args.cache_size,
+                             thetas, alphas, block_size=args.bptt)
 
     if args.run_grid:
-        grid = itertools.product(range_float(0, 1, 0.1), range_float(0, 0.5, 0.01))
+        fname = 'cache.{}.grid.csv'.format(args.cache_size)
+        fname = os.path.join(os.path.dirname(args.model_path), fname)
+        with open(fname, 'a') as f:
+            for (i, theta), (j, alpha) in itertools.product(
+                    enumerate(thetas), enumerate(alphas)):
+                f.write('{} {} {}\n'.format(theta, alpha, loss[i, j].exp().item()))
     else:
-        grid = [(args.theta, args.alpha)]
-
-    with torch.no_grad():
-
-        for theta, alpha in grid:
-            for (source, targets) in tqdm.tqdm(test):
-                # outs: (bptt x batch x hid)
-                outs, hidden, _ = model(source, hidden=hidden)
-
-                for out, target in zip(outs, targets):
-                    # (batch x vocab)
-                    logits = model.project(out, normalize=False)
-
-                    if cache.stored > 0:  # only interpolate after first step
-                        # query (batch x cache_size)
-                        cache_logits, vals = cache.query(out)
-
-                        # interpolate
-                        cache_prob = alpha * F.softmax(theta * cache_logits, dim=1)
-                        prob = (1 - alpha) * F.softmax(logits, dim=1)
-                        batch_index_add_(prob, vals, cache_prob)
-
-                    else:
-                        prob = F.softmax(logits, dim=1)
-
-                    bloss = F.nll_loss(prob.add(1e-8).log(), target).item()
-                    loss.add(bloss, target.nelement())
-                    cache.add(out.unsqueeze(0), target.unsqueeze(0))
-
-            if args.run_grid:
-                fname = 'cache.{}.grid.csv'.format(args.cache_size)
-                fname = os.path.join(os.path.dirname(args.model_path), fname)
-                with open(fname, 'a') as f:
-                    f.write('{} {} {}\n'.format(theta, alpha, loss.reduce()))
-            else:
-                print(loss.reduce())
+        print(loss[0, 0].exp().item())
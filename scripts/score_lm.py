@@ -0,0 +1,54 @@
+
+"""
+Score a sentence-per-line file with a trained LM, printing the log-probability
+and perplexity of each sentence (tab-separated) in input order. The input
+is streamed, so files of arbitrary size can be scored with bounded memory.
+"""
+
+import os
+import sys
+
+import torch
+
+from seqmod.misc import text_processor
+from seqmod.loaders import load_lines
+from seqmod.modules.prefix_cache import PrefixCache
+import seqmod.utils as u
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', required=True)
+    parser.add_argument('--model_path', required=True)
+    parser.add_argument('--lower', action='store_true')
+    parser.add_argument('--num', action='store_true')
+    parser.add_argument('--level', default='token')
+    parser.add_argument('--batch_tokens', default=4000, type=int)
+    parser.add_argument('--buffer_size', default=10000, type=int)
+    parser.add_argument('--prefix_cache', action='store_true')
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    print("Loading model...", file=sys.stderr)
+    if os.path.isdir(args.model_path):
+        model = u.load_model(os.path.join(args.model_path, 'model.pt'))
+    else:
+        model = u.load_model(args.model_path)
+    d = model.embeddings.d
+    model.to(device=args.device)
+    model.eval()
+
+    processor = text_processor(lower=args.lower, num=args.num, level=args.level)
+    cache = PrefixCache() if args.prefix_cache else None
+    scores = model.score_corpus(
+        load_lines(args.path, processor=processor), d=d,
+        batch_tokens=args.batch_tokens, buffer_size=args.buffer_size,
+        prefix_cache=cache)
+
+    with torch.no_grad():
+        for log_prob, ppl in scores:
+            print("{:.4f}\t{:.4f}".format(log_prob, ppl))
+
+    if cache is not None:
+        print("Prefix cache: {}".format(cache.stats()), file=sys.stderr)
@@ -0,0 +1,54 @@
+
+"""
+Serve a trained LM or EncoderDecoder over HTTP (or a Unix socket) with
+continuous batching (see seqmod.misc.server).
+
+curl -d '{"seed": "some text", "max_seq_len": 50, "temperature": 0.5}' \
+    localhost:8000/generate
+"""
+
+import os
+import sys
+import asyncio
+
+from seqmod.misc.server import GenerationServer, LMWorker, EncoderDecoderWorker
+from seqmod.modules.lm import BaseLM
+import seqmod.utils as u
+
+
+def make_worker(model, device='cpu', bos=False):
+    if isinstance(model, BaseLM):
+        return LMWorker(model, model.embeddings.d, device=device, bos=bos)
+    return EncoderDecoderWorker(model, device=device)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', required=True)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--unix_socket', help='Serve over a Unix socket instead')
+    parser.add_argument('--max_batch_size', default=32, type=int)
+    parser.add_argument('--bos', action='store_true')
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    print("Loading model...", file=sys.stderr)
+    if os.path.isdir(args.model_path):
+        model = u.load_model(os.path.join(args.model_path, 'model.pt'))
+    else:
+        model = u.load_model(args.model_path)
+    model.to(device=args.device)
+    model.eval()
+
+    server = GenerationServer(
+        make_worker(model, device=args.device, bos=args.bos),
+        max_batch_size=args.max_batch_size)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(server.serve_http(
+        host=args.host, port=args.port, path=args.unix_socket))
+    print("Serving on {}".format(
+        args.unix_socket or '{}:{}'.format(args.host, args.port)), file=sys.stderr)
+    loop.run_forever()
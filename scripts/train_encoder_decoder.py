@@ -17,6 +17,7 @@ from seqmod.modules.encoder_decoder import make_rnn_encoder_decoder
 import seqmod.utils as u
 
 from seqmod.misc import EarlyStopping, Trainer, Checkpoint
+from seqmod.misc import distributed
 from seqmod.misc import StdLogger, VisdomLogger, TensorboardLogger
 from seqmod.misc import PairedDataset, Dict, inflection_sigmoid
 
@@ -107,12 +108,19 @@ if __name__ == '__main__':
     parser.add_argument('--device', default='cpu')
     parser.add_argument('--reverse', action='store_true')
     parser.add_argument('--checkpoint', default=50, type=int)
+    parser.add_argument('--prefetch', default=0, type=int,
+                        help='Number of batches to prepare in the background')
+    parser.add_argument('--timing', action='store_true',
+                        help='Report time per training phase at checkpoints')
     parser.add_argument('--hooks_per_epoch', default=2, type=int)
     parser.add_argument('--target', default='redrum', type=str)
     parser.add_argument('--beam', action='store_true')
     parser.add_argument('--plot', action='store_true')
     args = parser.parse_args()
 
+    # data-parallel training if started by the launcher (see seqmod.misc.distributed)
+    distributed.init_from_env()
+
     vocab = args.vocab
     size = args.train_len
     batch_size = args.batch_size
@@ -172,20 +180,24 @@ if __name__ == '__main__':
     model.to(device=args.device)
 
     early_stopping = EarlyStopping(args.patience)
+    checkpoint = None
+    if distributed.is_master():  # only rank 0 saves and logs
+        checkpoint = Checkpoint('EncoderDecoder', mode='nlast', keep=3).setup(args)
     trainer = Trainer(
         model, {'train': train, 'valid': valid}, optimizer, losses=('ppl',),
         early_stopping=early_stopping, max_norm=args.max_norm,
-        checkpoint=Checkpoint('EncoderDecoder', mode='nlast', keep=3).setup(args))
+        checkpoint=checkpoint, timing=args.timing)
     trainer.add_loggers(StdLogger())
     # trainer.add_loggers(VisdomLogger(env='encdec'))
-    trainer.add_loggers(TensorboardLogger(comment='encdec'))
+    if distributed.is_master():
+        trainer.add_loggers(TensorboardLogger(comment='encdec'))
 
     hook = make_encdec_hook(args.target, beam=args.beam)
     trainer.add_hook(hook, hooks_per_epoch=args.hooks_per_epoch)
     hook = u.make_schedule_hook(
         inflection_sigmoid(len(train) * 2, 1.75, inverse=True))
-    trainer.add_hook(hook, hooks_per_epoch=1000)
+    trainer.add_hook(hook, hooks_per_epoch=1000, all_ranks=True)
 
     (model, valid_loss), test_loss = trainer.train(
-        args.epochs, args.checkpoint, shuffle=True,
+        args.epochs, args.checkpoint, shuffle=True, prefetch=args.prefetch,
         use_schedule=args.use_schedule)
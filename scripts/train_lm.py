@@ -17,6 +17,7 @@ from seqmod.modules.lm import LM
 from seqmod.misc import Trainer, StdLogger, VisdomLogger, EarlyStopping
 from seqmod.misc import Dict, BlockDataset, text_processor, Checkpoint
 from seqmod.misc import inflection_sigmoid, inverse_exponential, inverse_linear
+from seqmod.misc import distributed
 from seqmod import utils as u
 from seqmod.loaders import load_lines
 
@@ -70,6 +71,9 @@ if __name__ == '__main__':
     parser.add_argument('--tie_weights', action='store_true')
     parser.add_argument('--mixtures', default=0, type=int)
     parser.add_argument('--sampled_softmax', action='store_true')
+    parser.add_argument('--adaptive_softmax', action='store_true')
+    parser.add_argument('--adaptive_cutoffs', nargs='+', type=int)
+    parser.add_argument('--loss_chunk_size', default=0, type=int)
     parser.add_argument('--deepout_layers', default=0, type=int)
     parser.add_argument('--deepout_act', default='MaxOut')
     parser.add_argument('--maxouts', default=2, type=int)
@@ -108,12 +112,19 @@ if __name__ == '__main__':
     parser.add_argument('--max_seq_len', default=25, type=int)
     parser.add_argument('--temperature', default=1, type=float)
     parser.add_argument('--checkpoint', default=100, type=int)
+    parser.add_argument('--prefetch', default=0, type=int,
+                        help='Number of batches to prepare in the background')
+    parser.add_argument('--timing', action='store_true',
+                        help='Report time per training phase at checkpoints')
     parser.add_argument('--hooks_per_epoch', default=1, type=int)
     parser.add_argument('--visdom', action='store_true')
     parser.add_argument('--visdom_host', default='localhost')
     parser.add_argument('--save', action='store_true')
     args = parser.parse_args()
 
+    # data-parallel training if started by the launcher (see seqmod.misc.distributed)
+    distributed.init_from_env()
+
     if args.processed:
         print("Loading preprocessed datasets...")
         assert args.dict_path, "Processed data requires DICT_PATH"
@@ -182,7 +193,10 @@ if __name__ == '__main__':
            att_dim=args.att_dim, tie_weights=args.tie_weights, mixtures=args.mixtures,
            deepout_layers=args.deepout_layers, train_init=args.train_init,
            deepout_act=args.deepout_act, maxouts=args.maxouts,
-           sampled_softmax=args.sampled_softmax, word_dropout=args.word_dropout)
+           sampled_softmax=args.sampled_softmax, word_dropout=args.word_dropout,
+           adaptive_softmax=args.adaptive_softmax,
+           adaptive_cutoffs=args.adaptive_cutoffs,
+           loss_chunk_size=args.loss_chunk_size)
 
     u.initialize_model(
         m,
@@ -204,7 +218,7 @@ if __name__ == '__main__':
     loss_type = 'bpc' if args.level == 'char' else 'ppl'
     trainer = Trainer(
         m, {"train": train, "test": test, "valid": valid}, optimizer,
-        max_norm=args.max_norm, losses=(loss_type,))
+        max_norm=args.max_norm, losses=(loss_type,), timing=args.timing)
 
     # hooks
     # - general hook
@@ -213,14 +227,16 @@ if __name__ == '__main__':
         early_stopping = EarlyStopping(args.patience)
 
     checkpoint = None
-    if args.save:
+    if args.save and distributed.is_master():
         checkpoint = Checkpoint(m.__class__.__name__, keep=3).setup(args)
 
     model_hook = u.make_lm_hook(
         d, temperature=args.temperature, max_seq_len=args.max_seq_len,
         device=args.device, level=args.level, early_stopping=early_stopping,
         checkpoint=checkpoint)
-    trainer.add_hook(model_hook, hooks_per_epoch=args.hooks_per_epoch)
+    # hooks updating the training state (early stopping, schedules) run on all ranks
+    trainer.add_hook(model_hook, hooks_per_epoch=args.hooks_per_epoch,
+                     all_ranks=early_stopping is not None)
 
     # - scheduled sampling hook
     if args.use_schedule:
@@ -228,21 +244,24 @@ if __name__ == '__main__':
             len(train) * args.schedule_inflection, args.schedule_steepness,
             a=args.schedule_init, inverse=True)
         trainer.add_hook(
-            u.make_schedule_hook(schedule, verbose=True), hooks_per_epoch=10e4)
+            u.make_schedule_hook(schedule, verbose=True), hooks_per_epoch=10e4,
+            all_ranks=True)
 
     # - lr schedule hook
     if args.lr_schedule_factor < 1.0:
         hook = make_lr_hook(
             optimizer, args.lr_schedule_factor, args.lr_schedule_checkpoints)
         # run a hook args.checkpoint * 4 batches
-        trainer.add_hook(hook, hooks_per_epoch=args.lr_checkpoints_per_epoch)
+        trainer.add_hook(hook, hooks_per_epoch=args.lr_checkpoints_per_epoch,
+                         all_ranks=True)
 
     # loggers
     trainer.add_loggers(StdLogger())
-    if args.visdom:
+    if args.visdom and distributed.is_master():
         visdom_logger = VisdomLogger(
             env='lm', server='http://' + args.visdom_host)
         trainer.add_loggers(visdom_logger)
 
     (best_model, valid_loss), test_loss = trainer.train(
-        args.epochs, args.checkpoint, use_schedule=args.use_schedule)
+        args.epochs, args.checkpoint, prefetch=args.prefetch,
+        use_schedule=args.use_schedule)
@@ -41,6 +41,7 @@ if __name__ == '__main__':
     parser.add_argument('--mode', default='prev+post')
     parser.add_argument('--clone', action='store_true')
     parser.add_argument('--softmax', default='full')
+    parser.add_argument('--loss_chunk_size', default=0, type=int)
     parser.add_argument('--emb_dim', type=int, default=620)
     parser.add_argument('--hid_dim', type=int, default=2400)
     parser.add_argument('--num_layers', type=int, default=1)
@@ -80,7 +81,8 @@ if __name__ == '__main__':
     m = Skipthought(
         embeddings, args.mode, cell=args.cell, hid_dim=args.hid_dim,
         num_layers=args.num_layers, summary=args.summary,
-        softmax=args.softmax, dropout=args.dropout)
+        softmax=args.softmax, dropout=args.dropout,
+        loss_chunk_size=args.loss_chunk_size)
 
     print("Initializing parameters ...")
     utils.initialize_model(
@@ -1,27 +1,39 @@
 
 import logging
 
+from .misc.lazy import lazy_module
+
 __version__ = "0.3"
 
-# grab git commit of seqmod
-from .misc.git import GitInfo
-
-try:
-    __commit__ = GitInfo(__file__).get_commit()
-except Exception:
-    logging.warning("`seqmod` is not git-tracked, I won't report seqmod git commit.")
-    __commit__ = 'Unknown!'
-
-from .misc import *
-from .hyper import *
-from .modules import *
-from . import utils
-from . import loaders
-
-# shortcut (still keep the old import for backward compatibility)
-from seqmod.misc.beam_search import Beam
-from seqmod.misc.dataset import Dict, MultiDict, PairedDataset
-from seqmod.misc.early_stopping import EarlyStopping, EarlyStoppingException
-from seqmod.misc.loggers import StdLogger, VisdomLogger
-from seqmod.misc.preprocess import text_processor
-from seqmod.misc.trainer import Trainer
+# submodules and shortcuts are imported on first access (see seqmod.misc.lazy)
+# so that importing seqmod stays cheap for short-lived processes
+_getattr, __dir__ = lazy_module(__name__, attrs={
+    'GitInfo': '.misc.git',
+    'Beam': '.misc.beam_search',
+    'Dict': '.misc.dataset',
+    'MultiDict': '.misc.dataset',
+    'PairedDataset': '.misc.dataset',
+    'EarlyStopping': '.misc.early_stopping',
+    'EarlyStoppingException': '.misc.early_stopping',
+    'StdLogger': '.misc.loggers',
+    'VisdomLogger': '.misc.loggers',
+    'text_processor': '.misc.preprocess',
+    'Trainer': '.misc.trainer',
+}, star=['.misc', '.hyper', '.modules'])
+
+
+def __getattr__(name):
+    global __commit__
+
+    # grab git commit of seqmod (runs git, so only when requested,
+    # e.g. by Checkpoint.setup)
+    if name == '__commit__':
+        from .misc.git import GitInfo
+        try:
+            __commit__ = GitInfo(__file__).get_commit()
+        except Exception:
+            logging.warning("`seqmod` is not git-tracked, I won't report seqmod git commit.")
+            __commit__ = 'Unknown!'
+        return __commit__
+
+    return _getattr(name)
@@ -1,3 +1,7 @@
 
-from .hyper_utils import *
-from .hyperband import Hyperband
+from seqmod.misc.lazy import lazy_module
+
+# hyperopt (and scipy) are only imported on first access
+__getattr__, __dir__ = lazy_module(__name__, attrs={
+    'Hyperband': '.hyperband',
+}, star=['.hyper_utils'])
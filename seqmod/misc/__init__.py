@@ -1,11 +1,26 @@
 
-from .dataset import *
-from .beam_search import Beam
-from .dataset import Dict, MultiDict, PairedDataset, BlockDataset
-from .early_stopping import EarlyStopping, EarlyStoppingException
-from .loggers import StdLogger, VisdomLogger, TensorboardLogger
-from .preprocess import text_processor
-from .trainer import Trainer, Checkpoint, LossStatistics
-from .schedules import inflection_sigmoid
-from .schedules import linear, inverse_linear
-from .schedules import exponential, inverse_exponential
+from .lazy import lazy_module
+
+# submodules are imported on first access (e.g. loggers pull in visdom and
+# tensorboardX), see seqmod.misc.lazy
+__getattr__, __dir__ = lazy_module(__name__, attrs={
+    'Beam': '.beam_search',
+    'Dict': '.dataset',
+    'MultiDict': '.dataset',
+    'PairedDataset': '.dataset',
+    'BlockDataset': '.dataset',
+    'EarlyStopping': '.early_stopping',
+    'EarlyStoppingException': '.early_stopping',
+    'StdLogger': '.loggers',
+    'VisdomLogger': '.loggers',
+    'TensorboardLogger': '.loggers',
+    'text_processor': '.preprocess',
+    'Trainer': '.trainer',
+    'Checkpoint': '.trainer',
+    'LossStatistics': '.trainer',
+    'inflection_sigmoid': '.schedules',
+    'linear': '.schedules',
+    'inverse_linear': '.schedules',
+    'exponential': '.schedules',
+    'inverse_exponential': '.schedules',
+}, star=['.dataset'])
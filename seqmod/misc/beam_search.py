@@ -32,11 +32,13 @@ class Beam(object):
         """
         return len(self.source_beams)
 
-    def _new_beam(self, outs):
+    def _new_beam(self, outs, index=None):
         """
         Computes a new beam based on the current model output and the history.
 
         outs: (width x vocab)
+        index: (optional) torch.LongTensor (vocab) mapping output columns
+            to vocabulary ids (e.g. when decoding with a shortlist)
         """
         if len(self) > 0:
             beam_outs = outs + self.scores.unsqueeze(1).expand_as(outs)
@@ -52,8 +54,10 @@ class Beam(object):
         # compute best outputs over a flatten vector of size (width x vocab)
         # i.e. regardless their source beam
         scores, flatten_ids = beam_outs.view(-1).topk(self.width, dim=0)
-        # compute source beam, best candidates (can't do // on tensors)
-        source_beams, beam = flatten_ids / vocab, flatten_ids % vocab
+        # compute source beam, best candidates
+        source_beams, beam = flatten_ids // vocab, flatten_ids % vocab
+        if index is not None:
+            beam = index[beam]
 
         return scores, source_beams, beam
 
@@ -78,11 +82,11 @@ class Beam(object):
         """
         return beam[0] == self.eos
 
-    def advance(self, outs):
+    def advance(self, outs, index=None):
         """
         Runs a decoder step accumulating the path and the ids.
         """
-        scores, source_beams, beam = self._new_beam(outs)
+        scores, source_beams, beam = self._new_beam(outs, index=index)
 
         if self.finished(beam):
             self.active = False
@@ -3,13 +3,16 @@ import time
 import math
 import logging
 import random
-from collections import Counter, Sequence, OrderedDict, defaultdict
+import itertools
+from collections import Counter, Sequence, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.utils.data
 
 from seqmod import utils
 from seqmod.misc.preprocess import segmenter
+from seqmod.misc import distributed
 
 
 def bucketing(*args):
@@ -492,6 +495,61 @@ class Dataset(Sequence, torch.utils.data.Dataset):
             torch.save(self, f)
 
 
+class BatchPrefetcher(object):
+    """
+    Iterate over the batches of a dataset in a given order, building the
+    next `depth` batches (padding, tensor creation and device moves done by
+    `dataset[idx]`) in background threads while the current one is consumed.
+
+    Threads (rather than processes) are used so that batches don't need to
+    be pickled back and device moves happen in the training process. Use it
+    as a context manager (or call `close`) to cancel pending batches when
+    the consumer stops early (exceptions, early stopping, interrupts).
+
+    Parameters:
+    -----------
+    dataset: indexable returning batches (e.g. BlockDataset, PairedDataset)
+    batch_order: iterable of batch indices
+    depth: int, number of batches to prepare ahead of the current one
+    workers: int, number of background threads
+    """
+    def __init__(self, dataset, batch_order, depth=1, workers=1):
+        if depth < 1:
+            raise ValueError("Prefetch depth must be positive, got {}".format(depth))
+
+        self.dataset = dataset
+        self.batch_order = batch_order
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = deque()
+
+    def _submit(self, order, n):
+        for idx in itertools.islice(order, n):
+            self.pending.append(self.executor.submit(self.dataset.__getitem__, idx))
+
+    def __iter__(self):
+        order = iter(self.batch_order)
+        self._submit(order, self.depth)
+        while self.pending:
+            future = self.pending.popleft()
+            # keep `depth` batches in flight while waiting for the current one
+            self._submit(order, 1)
+            yield future.result()
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        # only waits for batches already being built
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 class PairedDataset(Dataset):
     """
     Constructs a dataset out of source and target pairs. Examples will
@@ -905,9 +963,16 @@ class BlockDataset(Dataset):
 class DataIter(object):
     """
     Iterator over lines from files in autoregressive fashion
+
+    In distributed training (see seqmod.misc.distributed), each rank reads
+    a disjoint shard of the lines of every file (in blocks of `shard_lines`
+    consecutive lines, keeping context for iterators over neighbouring
+    sentences), unless `shard` is False.
     """
+    shard_lines = 1000
+
     def __init__(self, d, *paths, processor=None, shuffle=True, sort=True,
-                 device='cpu', verbose=False, max_items=None):
+                 device='cpu', verbose=False, max_items=None, shard=True):
         self.d = d
         self.paths = list(paths)
         self.processor = processor or self.default_segmenter
@@ -916,14 +981,24 @@ class DataIter(object):
         self.sort = sort
         self.max_items = max_items
         self.verbose = verbose
+        self.shard = shard
 
     def default_segmenter(self, line):
         return segmenter(line, level='token')
 
     def get_lines(self):
+        rank, world_size = 0, 1
+        if self.shard:
+            rank, world_size = distributed.get_rank(), distributed.get_world_size()
+
         for path in self.paths:
             with open(path, 'r') as f:
-                for line in f:
+                for num, line in enumerate(f):
+                    block, offset = divmod(num, self.shard_lines)
+                    if block % world_size != rank:
+                        continue
+                    if world_size > 1 and offset == 0 and block > 0:
+                        yield None              # break dependencies across shards
                     yield self.processor(line)  # might yield None
             yield None                          # break dependencies
 
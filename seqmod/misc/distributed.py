@@ -0,0 +1,257 @@
+
+"""
+Data-parallel training on CPU with torch.distributed (gloo backend).
+
+Every process (rank) holds a full replica of the model and trains on a
+disjoint shard of the batches. Gradients are averaged across ranks before
+each optimizer step, so that the replicas stay identical (see Trainer).
+
+Processes are started by the local launcher, which sets the usual
+torch.distributed environment variables (RANK, WORLD_SIZE, MASTER_ADDR,
+MASTER_PORT) and splits the cores evenly among the ranks:
+
+python -m seqmod.misc.distributed --nprocs 8 scripts/train_lm.py --path ...
+
+Scripts join the process group with `init_from_env` (`torchrun` can be used
+as well). From python (e.g. in tests), use `spawn`.
+"""
+
+import os
+import sys
+import time
+import socket
+import itertools
+import subprocess
+
+import torch
+import torch.distributed as dist
+
+
+BACKEND = 'gloo'
+# max size of the flat gradient buffers sent in a single all-reduce
+BUCKET_BYTES = 32 * 2 ** 20
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_master():
+    return get_rank() == 0
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def default_threads(nprocs):
+    return max(1, (os.cpu_count() or 1) // nprocs)
+
+
+def init_process_group(rank, world_size, master_addr='127.0.0.1', master_port=None,
+                       threads=None):
+    """
+    Join a gloo process group as `rank` out of `world_size` processes.
+
+    Parameters:
+    -----------
+    master_addr, master_port: address of the rank 0 process. The port
+        defaults to the MASTER_PORT environment variable.
+    threads: int, number of intra-op threads for this process (defaults to
+        an even split of the cores among the ranks)
+    """
+    os.environ['MASTER_ADDR'] = master_addr
+    if master_port is not None:
+        os.environ['MASTER_PORT'] = str(master_port)
+    if 'MASTER_PORT' not in os.environ:
+        raise ValueError("Missing master port")
+
+    torch.set_num_threads(threads or default_threads(world_size))
+    dist.init_process_group(BACKEND, rank=rank, world_size=world_size)
+
+
+def init_from_env():
+    """
+    Join the process group described by the environment variables set by
+    the launcher (or torchrun). Returns whether a process group was joined,
+    so scripts can call it unconditionally.
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) < 2 or is_distributed():
+        return is_distributed()
+
+    # intra-op threads are already set by the launcher (OMP_NUM_THREADS)
+    dist.init_process_group(BACKEND, init_method='env://')
+    return True
+
+
+def _worker(rank, fn, world_size, master_port, threads, args):
+    init_process_group(rank, world_size, master_port=master_port, threads=threads)
+    try:
+        fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def spawn(fn, nprocs, *args, threads=None):
+    """
+    Run `fn(*args)` in `nprocs` processes joined in a process group.
+    `fn` must be picklable (e.g. a module-level function).
+    """
+    torch.multiprocessing.spawn(
+        _worker, args=(fn, nprocs, free_port(), threads, args), nprocs=nprocs)
+
+
+def launch(script, nprocs, script_args=(), threads=None):
+    """
+    Run a training script in `nprocs` processes (see module docstring).
+    Only rank 0 reads from stdin (e.g. Checkpoint prompts). Returns the
+    first non-zero exit code, if any, killing the other ranks.
+    """
+    threads = threads or default_threads(nprocs)
+    port, procs = free_port(), []
+    for rank in range(nprocs):
+        env = dict(os.environ, RANK=str(rank), LOCAL_RANK=str(rank),
+                   WORLD_SIZE=str(nprocs), LOCAL_WORLD_SIZE=str(nprocs),
+                   MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port),
+                   OMP_NUM_THREADS=str(threads))
+        stdin = None if rank == 0 else subprocess.DEVNULL
+        procs.append(subprocess.Popen(
+            [sys.executable, script] + list(script_args), env=env, stdin=stdin))
+
+    try:
+        running = list(procs)
+        while running:
+            for proc in list(running):
+                if proc.poll() is None:
+                    continue
+                if proc.returncode != 0:
+                    # other ranks would wait forever on the failed one
+                    return proc.returncode
+                running.remove(proc)
+            time.sleep(0.1)
+        return 0
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+
+
+def broadcast_model(model, src=0):
+    """
+    Copy parameters and buffers of the model at rank `src` to all ranks.
+    """
+    with torch.no_grad():
+        for tensor in itertools.chain(model.parameters(), model.buffers()):
+            dist.broadcast(tensor.data, src)
+
+
+def _buckets(tensors, bucket_bytes):
+    bucket, size = [], 0
+    for t in tensors:
+        if bucket and (size + t.numel() * t.element_size() > bucket_bytes or
+                       t.dtype != bucket[0].dtype):
+            yield bucket
+            bucket, size = [], 0
+        bucket.append(t)
+        size += t.numel() * t.element_size()
+    if bucket:
+        yield bucket
+
+
+def all_reduce_grads(model, bucket_bytes=BUCKET_BYTES):
+    """
+    Average the gradients of the model across ranks (in place), flattening
+    them into large buffers to minimize the number of all-reduce calls.
+    Missing gradients (parameters not used by this rank) count as zeros.
+    """
+    world_size = get_world_size()
+    params = [p for p in model.parameters() if p.requires_grad]
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+        elif p.grad.is_sparse:
+            raise ValueError("Sparse gradients aren't supported")
+
+    for grads in _buckets([p.grad for p in params], bucket_bytes):
+        flat = torch.cat([g.view(-1) for g in grads])
+        dist.all_reduce(flat)
+        flat.div_(world_size)
+        offset = 0
+        for g in grads:
+            g.copy_(flat[offset:offset + g.numel()].view_as(g))
+            offset += g.numel()
+
+
+def broadcast_object(obj, src=0):
+    """
+    Return the (picklable) object of rank `src` on all ranks.
+    """
+    objs = [obj]
+    dist.broadcast_object_list(objs, src)
+    return objs[0]
+
+
+def all_gather_object(obj):
+    """
+    Return the list of (picklable) objects of all ranks, in rank order.
+    """
+    objs = [None] * get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+
+def shard(items, rank=None, world_size=None):
+    """
+    Items of the current rank. Indexable datasets (e.g. BlockDataset) are
+    split into contiguous shards (keeping consecutive batches together for
+    models carrying hidden state across batches), only building the
+    batches of the shard. Other iterables are split every `world_size`-th
+    item.
+    """
+    rank = get_rank() if rank is None else rank
+    world_size = get_world_size() if world_size is None else world_size
+    if hasattr(items, '__len__') and hasattr(items, '__getitem__'):
+        start, stop = (len(items) * r // world_size for r in (rank, rank + 1))
+        return (items[i] for i in range(start, stop))
+    return itertools.islice(items, rank, None, world_size)
+
+
+def synchronized(iterator):
+    """
+    Iterate in lockstep with the other ranks, stopping as soon as any of
+    them runs out of items, so that all ranks run the same number of
+    (collective) optimizer steps on shards of unequal size.
+    """
+    iterator = iter(iterator)
+    while True:
+        item = next(iterator, None)
+        flag = torch.tensor([0 if item is None else 1])
+        dist.all_reduce(flag, op=dist.ReduceOp.MIN)
+        if flag.item() == 0:
+            return
+        yield item
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Run a training script in several processes')
+    parser.add_argument('--nprocs', default=default_threads(1), type=int,
+                        help='Number of processes (defaults to the number of cores)')
+    parser.add_argument('--threads', type=int,
+                        help='Intra-op threads per process (defaults to cores/nprocs)')
+    parser.add_argument('script')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    sys.exit(launch(args.script, args.nprocs, args.script_args, threads=args.threads))
@@ -1,7 +1,15 @@
 
+import os
+import copy
 import heapq
+import shutil
+import weakref
+import tempfile
 from operator import itemgetter
 
+import torch
+import torch.nn as nn
+
 
 class pqueue(object):
     def __init__(self, maxsize, heapmax=False):
@@ -15,8 +23,12 @@ class pqueue(object):
         # add current queue length to break ties
         heapq.heappush(self.queue, (priority, len(self.queue), item))
         if len(self.queue) > self.maxsize:
-            # print("Popped {}".format(self.pop()))
-            self.pop()
+            _, item = self.pop()
+            self.discard(item)
+
+    def discard(self, item):
+        "Called on items dropped from the queue"
+        pass
 
     def pop(self):
         p, _, x = heapq.heappop(self.queue)
@@ -50,6 +62,74 @@ class pqueue(object):
         return len(self.queue) == 0
 
 
+class ModelSnapshot(object):
+    """
+    Snapshot of the parameters (and buffers) of a model, from which the model
+    can be rebuilt on demand. Only the state_dict tensors are copied (to host
+    memory, tied weights are only copied once), and they can be spilled to
+    disk to free host memory, in which case they are memory-mapped back when
+    restoring.
+
+    Parameters:
+    -----------
+    model: nn.Module, model to take the snapshot from. A reference is kept
+        as a template to rebuild the model from (see `restore`).
+    path: str (optional), if given the snapshot is directly saved to disk.
+    """
+    def __init__(self, model, path=None):
+        self.model = model
+        self.state, self.path = None, None
+        if path is not None:
+            self.path = path
+            torch.save(self._copy_state(model, device=None), path)
+        else:
+            self.state = self._copy_state(model, device='cpu')
+
+    @staticmethod
+    def _copy_state(model, device='cpu'):
+        state, copies = {}, {}
+        for name, t in model.state_dict(keep_vars=False).items():
+            key = (t.data_ptr(), t.dtype, t.size(), t.stride())
+            if key not in copies:
+                if device is None:  # saving: serialization already copies
+                    copies[key] = t.detach()
+                else:
+                    copies[key] = t.detach().to(device, copy=True)
+            state[name] = copies[key]
+        return state
+
+    def in_memory(self):
+        return self.state is not None
+
+    def spill(self, path):
+        "Move the snapshot from host memory to disk"
+        if not self.in_memory():
+            return
+        torch.save(self.state, path)
+        self.state, self.path = None, path
+
+    def state_dict(self):
+        if self.in_memory():
+            return self.state
+        return torch.load(self.path, map_location='cpu', mmap=True)
+
+    def restore(self, model=None):
+        """
+        Rebuild the model: a cpu copy of `model` (by default the model the
+        snapshot was taken from) with the snapshot parameters. Move the
+        template to cpu beforehand to avoid copying it on its device.
+        """
+        model = copy.deepcopy(model if model is not None else self.model).cpu()
+        model.load_state_dict(self.state_dict())
+        return model
+
+    def remove(self):
+        "Free the snapshot (removing it from disk if it was spilled)"
+        if self.path is not None and os.path.isfile(self.path):
+            os.remove(self.path)
+        self.state, self.path = None, None
+
+
 class EarlyStoppingException(Exception):
     def __init(self, message, data={}):
         super(EarlyStoppingException, self).__init__(message)
@@ -86,20 +166,33 @@ class EarlyStopping(pqueue):
     reset_on_emptied: bool, default False,
         Whether to reset the number of registered failures after emptying the
         queue.
+
+    max_in_memory: int (optional), maximum number of model snapshots kept in
+        host memory. Models passed to `add_checkpoint` are stored as
+        parameter snapshots (see ModelSnapshot), the best `max_in_memory`
+        ones in memory and the rest on disk. By default all are kept in
+        memory (that is, up to `maxsize`).
+
+    snapshot_dir: str (optional), directory for snapshots spilled to disk.
+        By default a temporary directory, removed together with the object.
     """
 
     def __init__(self, patience, maxsize=10, tolerance=1e-4,
-                 reset_patience=True, reset_on_emptied=False):
+                 reset_patience=True, reset_on_emptied=False,
+                 max_in_memory=None, snapshot_dir=None):
         """Set params."""
         self.patience = patience
         self.maxsize = maxsize
         self.tolerance = tolerance
         self.reset_patience = reset_patience
         self.reset_on_emptied = reset_on_emptied
+        self.max_in_memory = max_in_memory
+        self.snapshot_dir = snapshot_dir
         # data
         self.stopped = False
         self.fails = 0
         self.checks = []  # register losses over checkpoints
+        self.num_snapshots = 0
 
         if self.reset_on_emptied and patience >= maxsize:
             raise ValueError(
@@ -108,6 +201,40 @@ class EarlyStopping(pqueue):
 
         super(EarlyStopping, self).__init__(self.maxsize, heapmax=True)
 
+    def _snapshot_path(self):
+        if self.snapshot_dir is None:
+            self.snapshot_dir = tempfile.mkdtemp(prefix='seqmod-snapshots-')
+            weakref.finalize(self, shutil.rmtree, self.snapshot_dir, True)
+        elif not os.path.isdir(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir)
+        self.num_snapshots += 1
+        return os.path.join(
+            self.snapshot_dir, 'snapshot.{}.pt'.format(self.num_snapshots))
+
+    def _snapshot(self, model):
+        if self.max_in_memory is not None and self.max_in_memory <= 0:
+            return ModelSnapshot(model, path=self._snapshot_path())
+        return ModelSnapshot(model)
+
+    def _spill(self):
+        "Spill the worst in-memory snapshots to disk beyond `max_in_memory`"
+        if self.max_in_memory is None:
+            return
+        snapshots = [x for *_, x in sorted(self.queue, key=itemgetter(0), reverse=self.heapmax)
+                     if isinstance(x, ModelSnapshot) and x.in_memory()]
+        for snapshot in snapshots[self.max_in_memory:]:
+            snapshot.spill(self._snapshot_path())
+
+    def discard(self, item):
+        if isinstance(item, ModelSnapshot):
+            item.remove()
+
+    def push(self, item, priority):
+        if isinstance(item, nn.Module):
+            item = self._snapshot(item)
+        super(EarlyStopping, self).push(item, priority)
+        self._spill()
+
     def _find_smallest(self):
         (index, _), *_ = sorted(enumerate(self.checks), key=itemgetter(1))
         return index + 1        # 1-index
@@ -120,7 +247,14 @@ class EarlyStopping(pqueue):
         return msg
 
     def add_checkpoint(self, checkpoint, model=None, add_check=True):
-        """Add loss to queue and stop if patience is exceeded."""
+        """
+        Add loss to queue and stop if patience is exceeded.
+
+        If `model` is an nn.Module, only a snapshot of its parameters is
+        stored (see ModelSnapshot), and the `model` entry in the data of
+        the raised EarlyStoppingException is the best ModelSnapshot (use
+        its `restore` method to get the model back).
+        """
         if add_check:
             self.checks.append(checkpoint)
 
@@ -130,6 +264,9 @@ class EarlyStopping(pqueue):
 
         smallest, best_model = self.get_min()
         if self.is_full():
+            for *_, item in self.queue:
+                if item is not best_model:
+                    self.discard(item)
             self.queue = []
             if self.reset_on_emptied:
                 self.fails = 0
@@ -0,0 +1,66 @@
+
+import sys
+import pkgutil
+import importlib
+import importlib.util
+
+
+def lazy_module(name, attrs=None, star=()):
+    """
+    Build module-level `__getattr__` and `__dir__` functions (PEP 562) for
+    a package that imports its submodules on first attribute access instead
+    of at package import time. Resolved attributes are cached in the package.
+
+    Parameters:
+    -----------
+    name: str, name of the package (its `__name__`)
+    attrs: dict, attribute name to the (relative) submodule defining it
+    star: list of (relative) submodules whose public names are exported as
+        with `from .submodule import *`. Names are looked up in order and
+        the first submodule defining them wins.
+
+    `__all__` is computed on first access (i.e. by `from package import *`),
+    importing all submodules in `attrs` and `star`, as an eager package would.
+    """
+    attrs = attrs or {}
+
+    def public_names():
+        for submodule in sorted(set(attrs.values())):
+            importlib.import_module(submodule, name)
+        names = set(attrs)
+        for submodule in star:
+            submodule = importlib.import_module(submodule, name)
+            names |= set(getattr(submodule, '__all__', None) or vars(submodule))
+        # including submodules loaded in the process
+        names |= set(vars(sys.modules[name]))
+        return sorted(attr for attr in names if not attr.startswith('_'))
+
+    def __getattr__(attr):
+        if attr == '__all__':
+            value = public_names()
+        elif attr.startswith('__'):
+            raise AttributeError(
+                "module {!r} has no attribute {!r}".format(name, attr))
+        elif attr in attrs:
+            value = getattr(importlib.import_module(attrs[attr], name), attr)
+        elif importlib.util.find_spec('.' + attr, name) is not None:
+            value = importlib.import_module('.' + attr, name)
+        else:
+            for submodule in star:
+                submodule = importlib.import_module(submodule, name)
+                if not attr.startswith('_') and hasattr(submodule, attr):
+                    value = getattr(submodule, attr)
+                    break
+            else:
+                raise AttributeError(
+                    "module {!r} has no attribute {!r}".format(name, attr))
+
+        setattr(sys.modules[name], attr, value)
+        return value
+
+    def __dir__():
+        module = sys.modules[name]
+        submodules = [m.name for m in pkgutil.iter_modules(module.__path__)]
+        return sorted(set(vars(module)) | set(attrs) | set(submodules))
+
+    return __getattr__, __dir__
@@ -44,6 +44,13 @@ class Logger(object):
     - on_validation_end(epoch : int, loss : dict)
     - on_test_begin()
     - on_test_end(loss : dict)
+
+    If the Trainer was created with `timing=True`, checkpoint, epoch_end and
+    validation_end payloads also have a "timing" entry (see utils.PhaseTimer):
+        {"seconds": {phase: float}, "share": {phase: float},
+         "tokens/sec": float, "examples/sec": float}
+    (validation_end only has "seconds" of validation and, if the Trainer has
+    a Checkpoint, the time training was stalled by saving the model)
     """
     def log(self, event, payload, verbose=True):
         if verbose and hasattr(self, event):
@@ -87,6 +94,13 @@ class StdLogger(Logger):
         return "; ".join([phase + " {}: {:g}".format(k, v)
                           for (k, v) in loss.items()])
 
+    @staticmethod
+    def timing_str(timing):
+        share = ", ".join("{} {:.1f}%".format(phase, 100 * share)
+                          for phase, share in timing['share'].items())
+        return "time: {}; speed: {:g} tokens/sec, {:g} examples/sec".format(
+            share, timing['tokens/sec'], timing['examples/sec'])
+
     def epoch_begin(self, payload):
         self.logger.info("Starting epoch [{}]".format(payload['epoch']))
 
@@ -95,9 +109,16 @@ class StdLogger(Logger):
         loss = StdLogger.loss_str(payload['loss'], 'train')
         self.logger.info("Epoch[{}]; {}; speed: {:g} tokens/sec"
                          .format(payload['epoch'], loss, speed))
+        if 'timing' in payload:
+            self.logger.info("Epoch[{}]; {}".format(
+                payload['epoch'], StdLogger.timing_str(payload['timing'])))
 
     def validation_end(self, payload):
         loss = StdLogger.loss_str(payload['loss'], 'valid')
+        if 'timing' in payload:
+            loss += "; time: " + ", ".join(
+                "{} {:g} secs".format(phase, secs)
+                for phase, secs in payload['timing']['seconds'].items())
         self.logger.info("Epoch[{}]; {}".format(payload['epoch'], loss))
 
     def test_begin(self, payload):
@@ -112,6 +133,9 @@ class StdLogger(Logger):
         loss = StdLogger.loss_str(payload['loss'], 'train')
         self.logger.info("Epoch[{}]; batch [{}/{}]; {}; speed {:g} tokens/sec"
                          .format(e, b, bs, loss, speed))
+        if 'timing' in payload:
+            self.logger.info("Epoch[{}]; batch [{}/{}]; {}".format(
+                e, b, bs, StdLogger.timing_str(payload['timing'])))
 
     def info(self, payload):
         if isinstance(payload, dict):
@@ -232,6 +256,12 @@ class TensorboardLogger(Logger):
         self.tag = tag
         self.log_checkpoints = log_checkpoints
 
+    def _add_timing(self, timing, epoch):
+        self.writer.add_scalars(self.tag + '/time_share', timing['share'], epoch)
+        self.writer.add_scalars(self.tag + '/speed', {
+            'tokens/sec': timing['tokens/sec'],
+            'examples/sec': timing['examples/sec']}, epoch)
+
     @skip_on_import_error(SummaryWriter)
     def checkpoint(self, payload):
         if not self.log_checkpoints:
@@ -242,6 +272,8 @@ class TensorboardLogger(Logger):
         epoch = epoch + batch / total_batches
         losses = {'train/{}'.format(key): val for key, val in loss.items()}
         self.writer.add_scalars(self.tag, losses, epoch)
+        if 'timing' in payload:
+            self._add_timing(payload['timing'], epoch)
 
     @skip_on_import_error(SummaryWriter)
     def epoch_end(self, payload):
@@ -251,9 +283,14 @@ class TensorboardLogger(Logger):
 
         losses = {'train/{}'.format(key): val for key, val in loss.items()}
         self.writer.add_scalars(self.tag, losses, epoch)
+        if 'timing' in payload:
+            self._add_timing(payload['timing'], epoch)
 
     @skip_on_import_error(SummaryWriter)
     def validation_end(self, payload):
         epoch, loss = payload['epoch'] + 1, payload['loss']
         losses = {'valid/{}'.format(key): val for key, val in loss.items()}
         self.writer.add_scalars(self.tag, losses, epoch)
+        if 'timing' in payload:
+            self.writer.add_scalars(
+                self.tag + '/validation_secs', payload['timing']['seconds'], epoch)
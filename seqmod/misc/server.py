@@ -0,0 +1,436 @@
+
+"""
+Continuous batching generation server.
+
+Incoming generation (LM) or translation (EncoderDecoder) requests are queued
+and merged into a single running decoding batch. At each decoding step the
+finished sequences are evicted from the batch and queued requests are
+admitted, so that concurrent requests don't have to wait for each other.
+
+Example:
+--------
+>>> server = GenerationServer(LMWorker(model, d), max_batch_size=32)
+>>> asyncio.get_event_loop().run_until_complete(
+...     server.serve_http(host='localhost', port=8000))
+
+POST /generate {"seed": "some text", "max_seq_len": 25, "method": "sample",
+                "temperature": 1.0}
+"""
+
+import json
+import time
+import asyncio
+import logging
+
+import torch
+import torch.nn.functional as F
+
+from seqmod.modules.lm import read_batch
+from seqmod.modules.decoder import RNNDecoderState
+
+
+METHODS = ('argmax', 'sample')
+
+
+class Request(object):
+    """
+    Single generation request.
+
+    Parameters:
+    -----------
+    inp: list of str, seed text (LM) or source sentence (EncoderDecoder)
+    max_seq_len: int, maximum number of symbols to generate
+    method: str, one of 'argmax', 'sample'
+    temperature: float, temperature for multinomial sampling
+    ignore_eos: bool, whether to keep generating after <eos>
+    """
+    def __init__(self, inp=None, max_seq_len=25, method='sample',
+                 temperature=1.0, ignore_eos=False):
+        if method not in METHODS:
+            raise ValueError("Unknown method [{}], expected one of {}".format(
+                method, METHODS))
+        if temperature <= 0:
+            raise ValueError("temperature must be positive")
+
+        self.inp = inp
+        self.max_seq_len = max_seq_len
+        self.method = method
+        self.temperature = temperature
+        self.ignore_eos = ignore_eos
+        # decoding
+        self.hyp, self.score = [], 0.0
+        self.future = None
+        self.start = time.time()
+
+    @classmethod
+    def from_json(cls, data):
+        inp = data.get('seed', data.get('src'))
+        if isinstance(inp, str):
+            inp = inp.split()
+        return cls(inp=inp,
+                   max_seq_len=int(data.get('max_seq_len', 25)),
+                   method=data.get('method', 'sample'),
+                   temperature=float(data.get('temperature', 1.0)),
+                   ignore_eos=bool(data.get('ignore_eos', False)))
+
+
+class BaseWorker(object):
+    """
+    Holds the running decoding batch. Subclasses implement `admit` (encode
+    new requests and append them to the running batch) and `index` (select
+    entries of the running batch).
+    """
+    def __init__(self, model, d, device='cpu'):
+        self.model = model
+        self.d = d
+        self.device = device
+        self.eos = d.get_eos()
+        self.requests = []
+        self.prev = None   # (batch), last generated symbol
+
+    def __len__(self):
+        return len(self.requests)
+
+    def validate(self, request):
+        """
+        Check a request before it is queued, raising a ValueError for bad
+        input (e.g. symbols that the Dict can't index).
+        """
+        for w in request.inp or []:
+            self.input_dict.index(w)
+
+    @property
+    def input_dict(self):
+        return self.d
+
+    def admit(self, requests):
+        raise NotImplementedError
+
+    def index(self, index):
+        raise NotImplementedError
+
+    def forward(self):
+        """
+        Run a decoding step returning log-probs (batch x vocab)
+        """
+        raise NotImplementedError
+
+    def result(self, request):
+        return {'hyp': [self.d.vocab[i] for i in request.hyp],
+                'score': request.score / max(1, len(request.hyp))}
+
+    def step(self):
+        """
+        Run a decoding step over the running batch, evict finished requests
+        and return them.
+        """
+        with torch.no_grad():
+            logprobs = self.forward()
+
+            # per-request decoding method and temperature
+            temperature = torch.tensor(
+                [r.temperature for r in self.requests], device=logprobs.device)
+            sample = torch.tensor(
+                [r.method == 'sample' for r in self.requests],
+                device=logprobs.device)
+            sampled = F.softmax(logprobs / temperature.unsqueeze(1), dim=1) \
+                       .multinomial(1).squeeze(1)
+            prev = torch.where(sample, sampled, logprobs.max(1)[1])
+            scores = logprobs.gather(1, prev.unsqueeze(1)).squeeze(1)
+
+        finished, keep = [], []
+        for idx, (r, token, score) in enumerate(
+                zip(self.requests, prev.tolist(), scores.tolist())):
+            r.hyp.append(token)
+            r.score += score
+            if len(r.hyp) >= r.max_seq_len or \
+               (token == self.eos and not r.ignore_eos):
+                finished.append(r)
+            else:
+                keep.append(idx)
+
+        self.prev = prev
+        if finished:
+            self.requests = [self.requests[idx] for idx in keep]
+            if keep:
+                self.index(torch.tensor(keep, device=prev.device))
+
+        return finished
+
+
+class LMWorker(BaseWorker):
+    """
+    Continuous batching worker for (non-attentional, unconditional) LMs.
+    Seeds of at least two symbols are read in a packed batch (see read_batch),
+    requests without seed start from <eos> (as in Generator).
+    """
+    def __init__(self, model, d, device='cpu', bos=False):
+        if model.has_attention:
+            raise ValueError("LMWorker doesn't support attentional LMs")
+        if getattr(model, 'conds', None) is not None:
+            raise ValueError("LMWorker doesn't support conditional LMs")
+        if self.eos_or_bos(d) is None:
+            raise ValueError("LMWorker requires a Dict with <eos> or <bos>")
+
+        self.bos = bos
+        self.hidden = None
+        super(LMWorker, self).__init__(model, d, device=device)
+
+    @staticmethod
+    def eos_or_bos(d):
+        return d.get_eos() if d.get_eos() is not None else d.get_bos()
+
+    def _hidden(self, hidden):
+        return hidden if isinstance(hidden, tuple) else (hidden,)
+
+    def admit(self, requests):
+        with torch.no_grad():
+            self._admit(requests)
+
+    def _admit(self, requests):
+        seeds = []
+        for r in requests:
+            seed = [self.d.index(w) for w in r.inp or []]
+            if self.bos and self.d.get_bos() is not None:
+                seed = [self.d.get_bos()] + seed
+            seeds.append(seed or [self.eos_or_bos(self.d)])
+
+        # read seeds with at least two symbols (others start from scratch)
+        long_ids = [idx for idx, s in enumerate(seeds) if len(s) > 1]
+        hidden = self.model.init_hidden_for(
+            torch.zeros(1, len(seeds), 1, device=self.device))
+        if long_ids:
+            _, long_hidden = read_batch(
+                self.model, [seeds[idx] for idx in long_ids], device=self.device)
+            index = torch.tensor(long_ids, device=self.device)
+            for h, long_h in zip(self._hidden(hidden), self._hidden(long_hidden)):
+                h.index_copy_(1, index, long_h)
+
+        prev = torch.tensor([s[-1] for s in seeds], device=self.device)
+
+        if self.requests:
+            if isinstance(hidden, tuple):
+                hidden = tuple(torch.cat([h, new_h], 1)
+                               for h, new_h in zip(self.hidden, hidden))
+            else:
+                hidden = torch.cat([self.hidden, hidden], 1)
+            prev = torch.cat([self.prev, prev])
+
+        self.hidden, self.prev = hidden, prev
+        self.requests.extend(requests)
+
+    def index(self, index):
+        if isinstance(self.hidden, tuple):
+            self.hidden = tuple(h.index_select(1, index) for h in self.hidden)
+        else:
+            self.hidden = self.hidden.index_select(1, index)
+        self.prev = self.prev.index_select(0, index)
+
+    def forward(self):
+        outs, self.hidden, _ = self.model(self.prev.unsqueeze(0), hidden=self.hidden)
+        return self.model.project(outs)
+
+
+class EncoderDecoderWorker(BaseWorker):
+    """
+    Continuous batching worker for RNN EncoderDecoders. The decoder states
+    of newly admitted sources are concatenated to the running decoder state
+    (see RNNDecoderState.concat_batches).
+    """
+    def __init__(self, model, device='cpu'):
+        if model.decoder.conditional:
+            raise ValueError("EncoderDecoderWorker doesn't support conditional decoders")
+
+        self.src_dict = model.encoder.embeddings.d
+        self.state = None
+        d = model.decoder.embeddings.d
+        super(EncoderDecoderWorker, self).__init__(model, d, device=device)
+        self.bos = d.get_bos()
+        if model.reverse:
+            self.bos, self.eos = self.eos, self.bos
+
+    @property
+    def input_dict(self):
+        return self.src_dict
+
+    def validate(self, request):
+        if not request.inp:
+            raise ValueError("Translation requests need a source sentence")
+        super(EncoderDecoderWorker, self).validate(request)
+
+    def admit(self, requests):
+        src = list(self.src_dict.transform([r.inp for r in requests]))
+        lengths = torch.tensor([len(s) for s in src], device=self.device)
+        inp = torch.full((max(len(s) for s in src), len(src)),
+                         self.src_dict.get_pad(), dtype=torch.int64)
+        for idx, s in enumerate(src):
+            inp[:len(s), idx] = torch.tensor(s)
+        inp = inp.to(self.device)
+
+        with torch.no_grad():
+            enc_outs, enc_hidden = self.model.encoder(inp, lengths=lengths)
+            state = self.model.decoder.init_state(enc_outs, enc_hidden, lengths)
+
+        prev = torch.tensor([self.bos] * len(requests), device=self.device)
+
+        if self.requests:
+            state = RNNDecoderState.concat_batches([self.state, state])
+            prev = torch.cat([self.prev, prev])
+
+        self.state, self.prev = state, prev
+        self.requests.extend(requests)
+
+    def index(self, index):
+        self.state = self.state.index_batches(index)
+        self.prev = self.prev.index_select(0, index)
+
+    def forward(self):
+        out, _ = self.model.decoder(self.prev, self.state)
+        return self.model.decoder.project(out)
+
+    def result(self, request):
+        result = super(EncoderDecoderWorker, self).result(request)
+        if self.model.reverse:
+            result['hyp'] = result['hyp'][::-1]
+        return result
+
+
+class GenerationServer(object):
+    """
+    Asyncio front end to a worker. Requests are queued and admitted into the
+    running batch (up to `max_batch_size`) before each decoding step. Decoding
+    steps run in an executor thread so that the event loop keeps accepting
+    requests in the meantime.
+
+    Parameters:
+    -----------
+    worker: LMWorker or EncoderDecoderWorker
+    max_batch_size: int, maximum number of requests decoded in parallel
+    """
+    def __init__(self, worker, max_batch_size=32):
+        self.worker = worker
+        self.max_batch_size = max_batch_size
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.queue = asyncio.Queue()
+            self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def submit(self, request):
+        """
+        Queue a Request and wait for its result
+        """
+        self.worker.validate(request)
+        self.start()
+        request.future = asyncio.get_running_loop().create_future()
+        await self.queue.put(request)
+        return await request.future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = []
+            if not len(self.worker):  # wait for work
+                requests.append(await self.queue.get())
+            while not self.queue.empty() and \
+                  len(self.worker) + len(requests) < self.max_batch_size:
+                requests.append(self.queue.get_nowait())
+
+            try:
+                if requests:
+                    await loop.run_in_executor(None, self.worker.admit, requests)
+                finished = await loop.run_in_executor(None, self.worker.step)
+            except Exception as e:
+                logging.exception("Decoding step failed")
+                for r in set(self.worker.requests + requests):
+                    if not r.future.done():
+                        r.future.set_exception(e)
+                self.worker.requests = []
+                continue
+
+            for r in finished:
+                if not r.future.done():
+                    r.future.set_result(self.worker.result(r))
+
+    async def handle(self, reader, writer):
+        """
+        Minimal HTTP/1.1 handler: POST a JSON request to any path and get back
+        a JSON object with the generated symbols (`hyp`) and the
+        length-normalized `score`. Bad requests get a 400 and failed ones a
+        500 response, both with an `error` message.
+        """
+        try:
+            request_line = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode().partition(':')
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            if not request_line.startswith(b'POST'):
+                status, response = '405 Method Not Allowed', {'error': 'use POST'}
+            else:
+                try:
+                    request = Request.from_json(json.loads(body.decode() or '{}'))
+                    self.worker.validate(request)
+                except Exception as e:
+                    status, response = '400 Bad Request', {'error': str(e)}
+                else:
+                    try:
+                        status, response = '200 OK', await self.submit(request)
+                    except Exception as e:  # logged by `run`
+                        status = '500 Internal Server Error'
+                        response = {'error': '{}: {}'.format(type(e).__name__, e)}
+
+            payload = json.dumps(response).encode()
+            writer.write(
+                'HTTP/1.1 {}\r\nContent-Type: application/json\r\n'
+                'Content-Length: {}\r\nConnection: close\r\n\r\n'
+                .format(status, len(payload)).encode() + payload)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve_http(self, host='localhost', port=8000, path=None):
+        """
+        Serve over TCP (or over a Unix socket if `path` is given).
+        """
+        self.start()
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path=path)
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+        return server
+
+
+async def post(data, host='localhost', port=8000, path=None, url='/generate'):
+    """
+    Minimal client for GenerationServer.serve_http
+    """
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    payload = json.dumps(data).encode()
+    writer.write('POST {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json'
+                 '\r\nContent-Length: {}\r\n\r\n'
+                 .format(url, host, len(payload)).encode() + payload)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    _, _, body = response.partition(b'\r\n\r\n')
+    return json.loads(body.decode())
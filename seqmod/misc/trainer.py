@@ -2,20 +2,23 @@
 import os
 import random
 from time import time
-import copy
 import math
 import collections
 import yaml
 import argparse
 import logging
+import contextlib
 from operator import itemgetter
 from datetime import datetime
 
 import torch
 from torch.optim import lr_scheduler
+from concurrent.futures import ThreadPoolExecutor
 
 from seqmod import utils as u
-from seqmod.misc.early_stopping import EarlyStoppingException
+from seqmod.misc.early_stopping import EarlyStoppingException, ModelSnapshot
+from seqmod.misc.dataset import BatchPrefetcher
+from seqmod.misc import distributed
 from .git import GitInfo
 
 
@@ -45,6 +48,18 @@ def get_formatter(loss):
         return identity
 
 
+def get_batch_size(batch_data):
+    """
+    Number of examples in a batch, assuming (seq_len x batch) tensors, or
+    (batch) tensors for non-sequential data, possibly nested in tuples
+    """
+    while isinstance(batch_data, (tuple, list)) and len(batch_data) > 0:
+        batch_data = batch_data[0]
+    if not isinstance(batch_data, torch.Tensor):
+        return 0
+    return batch_data.size(1) if batch_data.dim() > 1 else batch_data.size(0)
+
+
 class LossStatistics(object):
     """
     Accumulator for different losses (for report purposes)
@@ -148,8 +163,14 @@ class Checkpoint(object):
     mode: (default 'nbest') one of 'nbest' or 'nlast'
     keep: max number of best models to keep in disk.
     ext: model file extension.
+    background: bool, whether to write models in a background thread. The
+        model is first copied to cpu memory (see utils.snapshot_model), so
+        that training can go on while it is serialized. At most one write is
+        in flight: a save waits for the previous one to finish. Files are
+        always written atomically (see utils.atomic_save).
     """
-    def __init__(self, subdir, topdir='./models', mode='nbest', keep=1, ext='torch'):
+    def __init__(self, subdir, topdir='./models', mode='nbest', keep=1, ext='torch',
+                 background=True):
         self.topdir = topdir
         self.subdir = subdir
         self.subdir += '-{}'.format(datetime.now().strftime("%Y_%m_%d-%H_%M_%S"))
@@ -159,6 +180,8 @@ class Checkpoint(object):
         self.buf_last = []
         self.ext = ext
         self.is_setup = False
+        self.background = background
+        self.executor, self.pending = None, None
 
         if self.mode not in ('nbest', 'nlast'):
             raise ValueError("Not a mode: {}".format(self.mode))
@@ -166,6 +189,30 @@ class Checkpoint(object):
     def get_modelname(self, index):
         return self.checkpoint_path('model-{}'.format(index))
 
+    def wait(self):
+        """
+        Wait for the write in flight (if any) to finish, raising its errors
+        """
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def save_model(self, model, prefix):
+        """
+        Write a model to `prefix` (see utils.save_model), in the background
+        if `background`. Returns the filename.
+        """
+        if not self.background:
+            return u.save_model(model, prefix, mode=self.ext)
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        self.wait()
+        snapshot = u.snapshot_model(model)
+        self.pending = self.executor.submit(u.save_model, snapshot, prefix, mode=self.ext)
+        _, ext = u.get_save_fn(self.ext)
+        return prefix + '.' + ext
+
     def checkpoint_path(self, *path):
         return os.path.join(self.topdir, self.subdir, *path)
 
@@ -207,6 +254,9 @@ class Checkpoint(object):
         """
         Dispatch method
         """
+        # finish previous write before evicting old models
+        self.wait()
+
         if self.mode == 'nbest':
             if loss is None:
                 raise ValueError("`nbest` requires loss")
@@ -230,7 +280,7 @@ class Checkpoint(object):
             self.buf_last.pop()
 
         timestamp = datetime.now().strftime("%Y_%m_%d-%H_%M_%S")
-        modelname = u.save_model(model, self.get_modelname(timestamp), mode=self.ext)
+        modelname = self.save_model(model, self.get_modelname(timestamp))
         self.buf_last.append((modelname, timestamp))
         self.buf_last.sort(key=itemgetter(1), reverse=True)
 
@@ -258,8 +308,7 @@ class Checkpoint(object):
             else:
                 return
 
-        modelname = u.save_model(
-            model, self.get_modelname(format_loss(loss)), mode=self.ext)
+        modelname = self.save_model(model, self.get_modelname(format_loss(loss)))
         self.buf_best.append((modelname, loss))
         self.buf_best.sort(key=itemgetter(1))
 
@@ -272,6 +321,7 @@ class Checkpoint(object):
         if not self.is_setup:
             raise ValueError("Checkpoint not setup yet")
 
+        self.wait()
         import shutil
         shutil.rmtree(os.path.join(self.topdir, self.subdir))
 
@@ -279,7 +329,7 @@ class Checkpoint(object):
 class Trainer(object):
     def __init__(self, model, datasets, optimizer, scheduler=None, checkpoint=None,
                  early_stopping=None, max_norm=None, losses=('loss',), weights=None,
-                 verbose=True):
+                 verbose=True, timing=False):
         """
         Parameter:
         ----------
@@ -291,6 +341,22 @@ class Trainer(object):
             apart the different losses in a complex loss function)
         - weights: dict or None, if given the losses will be reduce to a single
             value by a weighted sum using this parameter.
+        - timing: bool, whether to time the training phases (data fetching,
+            forward/backward, optimizer step, hooks, validation) and report
+            them with the throughput in the checkpoint, epoch_end and
+            validation_end payloads under "timing" (see utils.PhaseTimer).
+            Forward and backward are only told apart for models that report
+            it with utils.mark_phase (LM, EncoderDecoder and Skipthought),
+            otherwise they are reported as "loss".
+
+        Data-parallel training is enabled when a process group has been
+        initialized (see seqmod.misc.distributed). Each rank trains on a
+        disjoint shard of the batch order, gradients are averaged across
+        ranks before each optimizer step and validation runs on shards of
+        the validation set, aggregating the losses across ranks. Only rank 0
+        logs, saves checkpoints and runs hooks (unless registered with
+        `all_ranks`). Reported training losses and throughput are the ones
+        of rank 0.
         """
         # attributes
         self.model = model
@@ -301,12 +367,24 @@ class Trainer(object):
         self.early_stopping = early_stopping
         self.loss = LossStatistics(*losses, weights=weights)
         self.max_norm = max_norm
+        self.timer = u.PhaseTimer(enabled=timing)
         # config
         self.verbose = verbose
         # containers
         self.loggers = []
         self.hooks = []
         self.last_batch_order = None
+        # distributed
+        self.rank = distributed.get_rank()
+        self.world_size = distributed.get_world_size()
+        # whether validation is run by all ranks (False in rank 0-only hooks)
+        self.collective = True
+        if self.world_size > 1:
+            distributed.broadcast_model(self.model)
+
+    @property
+    def is_master(self):
+        return self.rank == 0
 
     # logging
     def add_loggers(self, *loggers):
@@ -314,11 +392,14 @@ class Trainer(object):
             self.loggers.append(logger)
 
     def log(self, event, payload):
+        if not self.is_master:
+            return
         for logger in self.loggers:
             logger.log(event, payload, verbose=self.verbose)
 
     # hooks
-    def add_hook(self, hook, hooks_per_epoch=None, num_checkpoints=None):
+    def add_hook(self, hook, hooks_per_epoch=None, num_checkpoints=None,
+                 all_ranks=False):
         """
         Add a trainer hook that gets executed after a number of checkpoints.
         The number of times a hook gets executed per epoch can be specified
@@ -340,9 +421,15 @@ class Trainer(object):
 
         Only one of the two options can be specified.
 
+        In distributed training, hooks only run on rank 0 (and validate on
+        the full validation set) unless `all_ranks` is set. Hooks that change
+        the training state (learning rate schedules, early stopping, etc.)
+        must run on all ranks, so that ranks keep in sync.
+
         Parameters:
         -----------
         hook: fn(trainer, epoch, batch_num, checkpoint)
+        all_ranks: bool, whether to run the hook on all ranks
         """
         if hooks_per_epoch is not None and num_checkpoints is not None:
             raise ValueError("Only one of `hooks_per_epoch` or "
@@ -351,7 +438,7 @@ class Trainer(object):
             raise ValueError("Either `num_checkpoints` or `hooks_per_epoch` "
                              "must be passed to ``add_hook``")
 
-        hook = {'hook': hook}
+        hook = {'hook': hook, 'all_ranks': all_ranks}
 
         if hooks_per_epoch is not None:
             # check if train is given and has length
@@ -367,18 +454,28 @@ class Trainer(object):
 
         self.hooks.append(hook)
 
+    def run_hook(self, hook, epoch, batch_num, num_checkpoints):
+        if hook['all_ranks']:
+            hook['hook'](self, epoch, batch_num, num_checkpoints)
+        elif self.is_master:
+            self.collective = False
+            try:
+                hook['hook'](self, epoch, batch_num, num_checkpoints)
+            finally:
+                self.collective = True
+
     def run_hooks(self, epoch, batch_num, checkpoint):
         for hook in self.hooks:
             num_checkpoints = batch_num // checkpoint
             if 'hooks_per_epoch' in hook:
-                # get repetition frequency
-                batches = len(self.datasets['train'])
+                # get repetition frequency (each rank sees a shard of the batches)
+                batches = -(-len(self.datasets['train']) // self.world_size)
                 rep = max(1, batches // (checkpoint * hook['hooks_per_epoch']) - 1)
                 if num_checkpoints % rep == 0:
-                    hook['hook'](self, epoch, batch_num, num_checkpoints)
+                    self.run_hook(hook, epoch, batch_num, num_checkpoints)
             elif 'num_checkpoints' in hook:
                 if num_checkpoints % hook['num_checkpoints'] == 0:
-                    hook['hook'](self, epoch, batch_num, num_checkpoints)
+                    self.run_hook(hook, epoch, batch_num, num_checkpoints)
 
     # callbacks
     def on_batch_end(self, epoch, batch, loss):
@@ -389,23 +486,33 @@ class Trainer(object):
         self.log("epoch_begin", {"epoch": epoch})
 
     def on_epoch_end(self, epoch, loss, examples, duration, valid_loss=None):
-        self.log("epoch_end", {"epoch": epoch,
-                               "loss": loss.pack(),
-                               "examples": examples,
-                               "duration": duration})
+        payload = {"epoch": epoch,
+                   "loss": loss.pack(),
+                   "examples": examples,
+                   "duration": duration}
+        if self.timer.enabled:
+            payload["timing"] = self.timer.pack(total=True)
+        self.log("epoch_end", payload)
 
     def on_validation_begin(self, epoch):
         self.log("validation_begin", {"epoch": epoch})
 
-    def on_validation_end(self, epoch, loss):
-        self.log("validation_end", {"epoch": epoch, "loss": loss.pack()})
-        if self.early_stopping is not None:
-            self.early_stopping.add_checkpoint(
-                # need some extra free GPU memory to duplicate the model before
-                # moving to cpu and storing it in the EarlyStopping object
-                loss.reduce(), copy.deepcopy(self.model).cpu())
-        if self.checkpoint is not None:
+    def on_validation_end(self, epoch, loss, duration=None):
+        payload = {"epoch": epoch, "loss": loss.pack()}
+        # save first so that the time training is stalled by it gets logged
+        stall = None
+        if self.checkpoint is not None and self.is_master:
+            start = time()
             self.checkpoint.save(self.model, loss.reduce())
+            stall = time() - start
+        if self.timer.enabled and duration is not None:
+            payload["timing"] = {"seconds": {"validation": duration}}
+            if stall is not None:
+                payload["timing"]["seconds"]["checkpoint"] = stall
+        self.log("validation_end", payload)
+        if self.early_stopping is not None:
+            # only a snapshot of the parameters is stored (see ModelSnapshot)
+            self.early_stopping.add_checkpoint(loss.reduce(), self.model)
 
     def on_test_begin(self):
         self.log("test_begin", {})
@@ -416,6 +523,8 @@ class Trainer(object):
     # optimizer
     def optimizer_step(self):
         "Runs an optimizing step"
+        if self.world_size > 1:
+            distributed.all_reduce_grads(self.model)
         if self.max_norm is not None:
             torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_norm)
         self.optimizer.step()
@@ -456,6 +565,10 @@ class Trainer(object):
         - model: nn.Module (optional), whether to use a different model
             (e.g. best model resulting from early stopping)
         - kwargs: extra arguments passed to model.loss
+
+        In distributed training, each rank validates on a shard of the
+        dataset and the losses of all ranks are returned (all ranks must
+        call it, except from rank 0-only hooks, which use the full dataset).
         """
         if test and 'test' not in self.datasets:
             raise ValueError("Can not validate on test set, "
@@ -463,13 +576,26 @@ class Trainer(object):
 
         dataset = self.datasets['test' if test else 'valid']
         model, loss = model or self.model, self.loss.init()
+        collective = self.collective and self.world_size > 1
 
-        for batch in dataset:
+        for batch in distributed.shard(dataset) if collective else dataset:
             batch_loss, batch_examples = model.loss(batch, test=True, **kwargs)
             loss.add(batch_loss, batch_examples)
 
+        if collective:
+            loss = self.gather_loss(loss)
+
         return loss
 
+    def gather_loss(self, loss):
+        "Merge the loss statistics of all ranks"
+        gathered = loss.init()
+        for history, examples in distributed.all_gather_object(
+                (loss.history, loss.examples)):
+            gathered.history.extend(history)
+            gathered.examples += examples
+        return gathered
+
     def _get_batch_mode_batch_order(self, shuffle, num_batches):
         "Get batch order for an undefined number of batches"
         batch_order = list(range(len(self.datasets['train'])))
@@ -490,58 +616,113 @@ class Trainer(object):
         return batch_order[:num_batches]
 
     def get_batch_order(self, shuffle, num_batches=None):
-        "Get batch order for a single epoch"
+        """
+        Get batch order for a single epoch. In distributed training, the order
+        of rank 0 is split into equally sized contiguous shards and the shard
+        of the current rank is returned. The order is padded by wrapping around
+        so that no batch is dropped and all ranks run the same number of
+        (collective) optimizer steps.
+        """
         if num_batches is None:
             batch_order = list(range(len(self.datasets['train'])))
             if shuffle:
                 random.shuffle(batch_order)
-            return batch_order
-
         else:
-            return self._get_batch_mode_batch_order(shuffle, num_batches)
+            batch_order = self._get_batch_mode_batch_order(shuffle, num_batches)
+
+        if self.world_size > 1:
+            batch_order = distributed.broadcast_object(batch_order)
+            shard_size = -(-len(batch_order) // self.world_size)  # ceil
+            batch_order = [batch_order[i % len(batch_order)]
+                           for i in range(shard_size * self.world_size)]
+            start = self.rank * shard_size
+            batch_order = batch_order[start:start + shard_size]
+
+        return batch_order
 
     def run_checkpoint(self, epoch, b, checkpoint, duration, total_batches, loss):
         "Run checkpoint when needed"
         # log
-        self.log('checkpoint', {
+        payload = {
             'epoch': epoch,
             'batch': b,
             'total_batches': total_batches,
             'examples': loss.examples,
             'duration': duration,
-            'loss': loss.pack()})
+            'loss': loss.pack()}
+        if self.timer.enabled:
+            payload['timing'] = self.timer.pack()
+            # hooks are timed as part of the next checkpoint
+            self.timer.reset()
+        self.log('checkpoint', payload)
         # run hooks
         self.model.eval()
         with torch.no_grad():
             self.run_hooks(epoch, b, checkpoint)
         self.model.train()
-
-    def run_inner_loop(self, epoch, checkpoint, batch_order, **kwargs):
+        self.timer.mark('hooks')
+
+    def run_batch(self, batch_data, **kwargs):
+        """
+        Optimize on a single batch, returning the output of `model.loss`
+        (loss might be None for skipped batches)
+        """
+        timer = self.timer
+        timer.mark('fetch')
+        self.optimizer.zero_grad()
+        batch_loss, batch_examples = self.model.loss(batch_data, **kwargs)
+        # the model might have reported the end of the forward pass (models
+        # interleaving several backward passes end up in either phase)
+        reported = timer.last_phase in ('forward', 'backward')
+        timer.mark('backward' if reported else 'loss')
+        if batch_loss is None:  # to skip a batch loss might return None
+            if self.world_size > 1:
+                # still take part in the step of the other ranks (zero gradients)
+                self.optimizer_step()
+            return batch_loss, batch_examples
+        self.optimizer_step()
+        timer.mark('optimizer')
+        if timer.enabled:
+            timer.add(batch_examples, get_batch_size(batch_data))
+        return batch_loss, batch_examples
+
+    def get_batches(self, batch_order, prefetch=0):
+        """
+        Iterator over training batches in `batch_order`, building the next
+        `prefetch` batches in a background thread if `prefetch` > 0
+        (see BatchPrefetcher). The result must be closed after use.
+        """
+        dataset = self.datasets['train']
+        if prefetch > 0:
+            return BatchPrefetcher(dataset, batch_order, depth=prefetch)
+        return (dataset[batch] for batch in batch_order)
+
+    def run_inner_loop(self, epoch, checkpoint, batch_order, prefetch=0, **kwargs):
         """
         General train loop for a single run
         """
         run_loss, check_loss = self.loss.init(), self.loss.init()
         start, total_batches = time(), len(batch_order)
 
-        for b, batch in enumerate(batch_order):
-            # optimize
-            self.optimizer.zero_grad()
-            batch_data = self.datasets['train'][batch]
-            batch_loss, batch_examples = self.model.loss(batch_data, **kwargs)
-            if batch_loss is None:  # to skip a batch loss might return None
-                continue
-            self.optimizer_step()
-            run_loss.add(batch_loss, batch_examples)
-            check_loss.add(batch_loss, batch_examples)
-            self.on_batch_end(epoch, b, run_loss)
-
-            # checkpoint
-            if checkpoint and b > 0 and b % checkpoint == 0:
-                self.run_checkpoint(
-                    epoch, b, checkpoint, time()-start, total_batches, check_loss)
-
-                check_loss.reset()
-                start = time()
+        # closing stops background prefetching on early stopping/exceptions
+        with contextlib.closing(self.get_batches(batch_order, prefetch)) as batches:
+            self.timer.start()
+            for b, batch_data in enumerate(batches):
+                # optimize
+                batch_loss, batch_examples = self.run_batch(batch_data, **kwargs)
+                if batch_loss is None:
+                    continue
+                run_loss.add(batch_loss, batch_examples)
+                check_loss.add(batch_loss, batch_examples)
+                self.on_batch_end(epoch, b, run_loss)
+
+                # checkpoint
+                if checkpoint and b > 0 and b % checkpoint == 0:
+                    self.run_checkpoint(
+                        epoch, b, checkpoint, time()-start, total_batches, check_loss)
+
+                    check_loss.reset()
+                    start = time()
 
         return run_loss
 
@@ -552,13 +733,16 @@ class Trainer(object):
         run_loss, check_loss = self.loss.init(), self.loss.init()
         start, total_batches = time(), '~'
 
+        if self.world_size > 1:
+            # all ranks must run the same number of optimizer steps
+            generator = distributed.synchronized(generator)
+
+        self.timer.start()
         for b, batch in enumerate(generator):
             # optimize
-            self.optimizer.zero_grad()
-            batch_loss, batch_examples = self.model.loss(batch, **kwargs)
+            batch_loss, batch_examples = self.run_batch(batch, **kwargs)
             if batch_loss is None:
                 continue
-            self.optimizer_step()
             run_loss.add(batch_loss, batch_examples)
             check_loss.add(batch_loss, batch_examples)
             self.on_batch_end(epoch, b, run_loss)
@@ -574,12 +758,14 @@ class Trainer(object):
         return run_loss
 
     def run_outer_loop(self, checkpoint, epochs=None, num_batches=None, generator=None,
-                       shuffle=True, run_test=True, **kwargs):
+                       shuffle=True, run_test=True, prefetch=0, **kwargs):
         """
         General train loop for multiple runs/epochs
         """
         best_model, valid_loss, test_loss = None, None, None
         start = time()
+        # let the model report phases (see utils.mark_phase)
+        u.set_phase_timer(self.timer if self.timer.enabled else None)
 
         try:
             for e in range(epochs):
@@ -587,6 +773,7 @@ class Trainer(object):
                 # run epoch
                 self.on_epoch_begin(e)
                 epoch_start = time()
+                self.timer.reset_total()
                 self.model.train()
 
                 if generator is not None:
@@ -594,7 +781,8 @@ class Trainer(object):
                         e, checkpoint, generator(), **kwargs)
                 else:
                     batch_order = self.get_batch_order(shuffle, num_batches=num_batches)
-                    run_loss = self.run_inner_loop(e, checkpoint, batch_order, **kwargs)
+                    run_loss = self.run_inner_loop(
+                        e, checkpoint, batch_order, prefetch=prefetch, **kwargs)
 
                 self.on_epoch_end(e, run_loss, run_loss.examples, time() - epoch_start)
 
@@ -602,9 +790,10 @@ class Trainer(object):
                 if 'valid' in self.datasets:
                     self.model.eval()
                     self.on_validation_begin(e)
+                    valid_start = time()
                     with torch.no_grad():
                         valid_loss = self.validate_model(**kwargs)
-                    self.on_validation_end(e, valid_loss)
+                    self.on_validation_end(e, valid_loss, duration=time() - valid_start)
                     self.model.train()
 
                 if valid_loss is not None:
@@ -621,10 +810,15 @@ class Trainer(object):
         except KeyboardInterrupt:
             self.log("info", "Training interrupted")
 
+        finally:
+            u.set_phase_timer(None)
+
         self.log("info", "Trained for [{:.3f} secs]".format(time() - start))
 
         # prepare best model
         self.model.cpu()        # free gpu
+        if isinstance(best_model, ModelSnapshot):
+            best_model = best_model.restore()
         best_model = best_model or self.model
 
         if run_test and 'test' in self.datasets:
@@ -636,14 +830,15 @@ class Trainer(object):
             self.on_test_end(test_loss)
             test_loss = test_loss.reduce()
 
-        if self.checkpoint is not None:
+        if self.checkpoint is not None and self.is_master:
+            self.checkpoint.wait()
             if not u.prompt('Do you want to keep intermediate results? (yes/no)'):
                 self.checkpoint.remove()
 
         return (best_model.cpu(), valid_loss), test_loss
 
     def train_batches(self, num_batches, checkpoint,
-                      shuffle=False, run_test=False, **kwargs):
+                      shuffle=False, run_test=False, prefetch=0, **kwargs):
         """
         Run training on a given number of batches. `num_batches` might be
         larger than the actual total number of batches in the dataset, in
@@ -665,6 +860,8 @@ class Trainer(object):
         - num_batches: int
         - checkpoint: int, log a checkpoint and hooks every x batches
         - run_test: bool, whether to run testing after the number of batches
+        - prefetch: int, number of batches to prepare in a background thread
+            while the model computes (0 to build them synchronously)
         - kwargs: rest loss kwargs
 
         Returns (best_model, valid_loss), test_loss
@@ -680,15 +877,18 @@ class Trainer(object):
         """
         return self.run_outer_loop(
             checkpoint, epochs=1, num_batches=num_batches, shuffle=shuffle,
-            run_test=run_test, **kwargs)
+            run_test=run_test, prefetch=prefetch, **kwargs)
 
-    def train(self, epochs, checkpoint, shuffle=False, run_test=True, **kwargs):
+    def train(self, epochs, checkpoint, shuffle=False, run_test=True, prefetch=0,
+              **kwargs):
         """
         Parameters:
         -----------
 
         - epochs: int
         - checkpoint: int, log a checkpoint and hooks every x batches
+        - prefetch: int, number of batches to prepare in a background thread
+            while the model computes (0 to build them synchronously)
 
         Returns (best_model, valid_loss), test_loss
         -------
@@ -703,7 +903,7 @@ class Trainer(object):
         """
         return self.run_outer_loop(
             checkpoint, epochs=epochs, shuffle=shuffle,
-            run_test=run_test, **kwargs)
+            run_test=run_test, prefetch=prefetch, **kwargs)
 
     def train_generator(self, epochs, generator, checkpoint, run_test=True, **kwargs):
         """
@@ -1,10 +1,9 @@
 
-from .log_uniform import *
-from .attention import *
-from .ff import *
-from .rnn import *
-from .encoder_decoder import *
-from .encoder import *
-from .dcnn_encoder import DCNNEncoder
-from .cnn_text_encoder import CNNTextEncoder
-from .lm import *
+from seqmod.misc.lazy import lazy_module
+
+# submodules are imported on first access, see seqmod.misc.lazy
+__getattr__, __dir__ = lazy_module(__name__, attrs={
+    'DCNNEncoder': '.dcnn_encoder',
+    'CNNTextEncoder': '.cnn_text_encoder',
+}, star=['.log_uniform', '.attention', '.ff', '.rnn',
+         '.encoder_decoder', '.encoder', '.lm'])
@@ -13,12 +13,22 @@ def DotScorer(dec_out, enc_outs, **kwargs):
     enc_outs: (src_seq_len x batch x hid_dim)
 
     output: ((trg_seq_len x) batch x src_seq_len)
+
+    In step-wise mode, dec_out can also be (batch * width x hid_dim) with
+    `width` queries per encoder batch entry (e.g. beam search), in which case
+    the output will be (batch * width x src_seq_len).
     """
     if dec_out.dim() == 2:
-        # (batch x seq_len x hid_dim) * (batch x hid_dim x 1) => (batch x seq_len x 1)
-        score = torch.bmm(enc_outs.transpose(0, 1), dec_out.unsqueeze(2))
-        # (batch x seq_len)
-        return score.squeeze(2)
+        # dec_out might hold several (beam) queries per encoder batch entry
+        # laid out contiguously (batch * width x hid_dim)
+        batch, hid_dim = enc_outs.size(1), dec_out.size(1)
+        # (batch x seq_len x hid_dim) * (batch x hid_dim x width)
+        # => (batch x seq_len x width)
+        score = torch.bmm(
+            enc_outs.transpose(0, 1),
+            dec_out.view(batch, -1, hid_dim).transpose(1, 2))
+        # (batch * width x seq_len)
+        return score.transpose(1, 2).contiguous().view(dec_out.size(0), -1)
 
     elif dec_out.dim() == 3:
         score = torch.bmm(
@@ -91,12 +101,17 @@ class BahdanauScorer(nn.Module):
 
         # => step-wise mode
         if dec_att.dim() == 2:
-            # (batch x seq_len x att_dim)
-            dec_enc_att = F.tanh(enc_att + dec_att.unsqueeze(0))
-            # (batch x seq_len x att_dim) * (1 x att_dim x 1) -> (batch x seq_len x 1)
-            scores = dec_enc_att.transpose(0, 1) @ self.v_a.unsqueeze(0)
-            # (batch x seq_len x 1) -> (batch x seq_len)
-            scores = scores.squeeze(2)
+            (seq_len, batch, dim), dec_batch = enc_att.size(), dec_att.size(0)
+            # group (beam) queries per encoder batch entry
+            # (seq_len x batch x 1 x att_dim) + (1 x batch x width x att_dim)
+            # => (seq_len x batch x width x att_dim)
+            dec_enc_att = F.tanh(
+                enc_att.unsqueeze(2) + dec_att.view(1, batch, -1, dim))
+            # (seq_len x batch x width x att_dim) * (att_dim x 1)
+            # => (seq_len x batch x width x 1)
+            scores = dec_enc_att @ self.v_a
+            # (seq_len x batch * width) -> (batch * width x seq_len)
+            scores = scores.view(seq_len, dec_batch).t().contiguous()
             return scores
 
         # => ffw mode
@@ -172,24 +187,38 @@ class Attention(nn.Module):
         - dec_out: torch.Tensor(batch_size x hid_dim)
         - enc_outs: torch.Tensor(seq_len x batch_size x hid_dim)
         - enc_att: (optional), torch.Tensor(seq_len x batch_size x att_dim)
+        - mask: (optional), torch.ByteTensor(batch_size x seq_len)
+
+        `dec_out` can also be (batch_size * width x hid_dim), holding `width`
+        contiguous queries for each entry in the encoder batch (as during beam
+        search). This way, the encoder tensors don't have to be repeated along
+        the beam.
+
+        Returns:
+        --------
+        - context: (batch_size (* width) x hid_dim)
+        - weights: (batch_size (* width) x seq_len)
         """
-        # (batch x seq_len)
+        seq_len, batch, _ = enc_outs.size()
+
+        # (batch * width x seq_len) => (batch x width x seq_len)
         weights = self.scorer(dec_out, enc_outs, enc_att=enc_att)
+        weights = weights.view(batch, -1, seq_len)
 
         if mask is not None:
             # weights = weights * mask.float()
-            weights.masked_fill_(1 - mask, -float('inf'))
+            weights.masked_fill_(~mask.unsqueeze(1), -float('inf'))
 
-        weights = F.softmax(weights, dim=1)
+        weights = F.softmax(weights, dim=2)
 
-        # (eq 7) (batch x 1 x seq_len) * (batch x seq_len x hid_dim)
-        # => (batch x hid_dim)
-        context = weights.unsqueeze(1).bmm(enc_outs.transpose(0, 1)).squeeze(1)
+        # (eq 7) (batch x width x seq_len) * (batch x seq_len x hid_dim)
+        # => (batch * width x hid_dim)
+        context = weights.bmm(enc_outs.transpose(0, 1)).view(dec_out.size(0), -1)
         # (eq 5) linear out combining context and hidden
         # (batch x hid_dim * 2) => (batch x hid_dim)
         context = F.tanh(self.linear_out(torch.cat([context, dec_out], 1)))
 
-        return context, weights
+        return context, weights.view(-1, seq_len)
 
     def fast_forward(self, dec_out, enc_outs, enc_att=None, mask=None):
         """
@@ -212,7 +241,7 @@ class Attention(nn.Module):
             # (batch x src_seq_len) => (trg_seq_len x batch x src_seq_len)
             mask = mask.unsqueeze(0).expand_as(weights)
             # weights = weights * mask.float()
-            weights.masked_fill_(1 - mask, -float('inf'))
+            weights.masked_fill_(~mask, -float('inf'))
 
         weights = F.softmax(weights, dim=2)
 
@@ -1,5 +1,6 @@
 
 import torch
+import torch.nn.functional as F
 
 
 class Cache(object):
@@ -20,8 +21,14 @@ class Cache(object):
         - global: global normalization. `alpha` corresponds to to a weight to
             increase the importance of the probability distribution of the cache.
             Range usually in (0, 4).
+
+    index: (optional) key index (see seqmod.modules.cache_index), e.g.
+        BruteForceIndex or IVFPQIndex for large (approximate) caches. With an
+        index, the stored items are shared across the batch and queries
+        return the `topk` nearest items.
     """
-    def __init__(self, dim, size, vocab, theta=1.0, alpha=0.5, device='cpu'):
+    def __init__(self, dim, size, vocab, theta=1.0, alpha=0.5, device='cpu',
+                 index=None):
 
         self.dim = dim
         self.size = size
@@ -29,6 +36,7 @@ class Cache(object):
         self.theta = theta
         self.alpha = alpha
         self.device = device
+        self.index = index
 
         self.stored = 0         # number of items stored in the cache
         self.current = 0        # index along size that should get written
@@ -40,6 +48,8 @@ class Cache(object):
         self.current = 0
         self.memkeys.zero_()
         self.memvals.zero_()
+        if self.index is not None:
+            self.index.reset()
 
     def add(self, keys, vals):
         """
@@ -53,6 +63,12 @@ class Cache(object):
             raise ValueError("Wrong key-val dims. Keys: {}, vals: {}".format(
                 str(keys.size()), str(vals.size())))
 
+        if self.index is not None:
+            self.index.add(keys.contiguous().view(-1, self.dim),
+                           vals.contiguous().view(-1))
+            self.stored = len(self.index)
+            return
+
         batch = keys.size(1)
 
         if self.memkeys.size(1) == 1 and batch > 1:
@@ -84,23 +100,175 @@ class Cache(object):
 
         self.stored = min(self.size, self.stored + len(keys))
 
-    def query(self, query):
+    def query(self, query, topk=None):
         """
         Return scores for words in the cache given an input query.
 
         Parameters:
         -----------
         query: torch.Tensor(batch, hid_dim)
+        topk: (optional) int, only return the `topk` highest scoring items
+            (required if the cache has an index)
 
         Returns:
         --------
         scores: torch.Tensor(batch, size), output is just the dotproduct
-            with the keys in the cache
+            with the keys in the cache (-inf for missing items with an index)
         vals: torch.LongTensor(batch, size)
         """
+        if self.index is not None:
+            if topk is None:
+                raise ValueError("Caches with an index require `topk`")
+            return self.index.search(query, topk)
+
         # select full entries
         memkeys, memvals = self.memkeys[:self.stored], self.memvals[:self.stored]
         # dot product => (batch x size)
-        scores = (memkeys * query.unsqueeze(0)).sum(2)
+        scores = torch.bmm(memkeys.transpose(0, 1), query.unsqueeze(2)).squeeze(2)
+        memvals = memvals.t()
+
+        if topk is not None and topk < self.stored:
+            scores, index = scores.topk(topk, dim=1)
+            memvals = memvals.gather(1, index)
+
+        return scores, memvals
+
+    def ordered(self):
+        """
+        Return the stored keys and values in insertion order (oldest first).
+
+        Returns:
+        --------
+        memkeys: torch.Tensor(stored, batch, dim)
+        memvals: torch.LongTensor(stored, batch)
+        """
+        offset = self.current if self.stored == self.size else 0
+        index = torch.arange(
+            offset, offset + self.stored, dtype=torch.int64, device=self.device)
+        index = index % self.size
+
+        return self.memkeys.index_select(0, index), self.memvals.index_select(0, index)
+
+    def query_block(self, keys, vals):
+        """
+        Score a whole block of consecutive steps at once. Each step is scored
+        against the previous `size` items, i.e. the content of the cache and
+        the preceding steps in the block (as if `query` and `add` had been
+        called step by step). The block isn't added to the cache.
+
+        Parameters:
+        -----------
+        keys: torch.Tensor(n, batch, dim), block queries (and keys)
+        vals: torch.LongTensor(n, batch), block values
+
+        Returns:
+        --------
+        scores: torch.Tensor(n, batch, stored + n), dot products with the
+            visible items (-inf for items outside each step's window)
+        vals: torch.LongTensor(batch, stored + n)
+        """
+        if self.index is not None:
+            raise ValueError("query_block isn't supported by caches with an index")
+
+        n, batch, _ = keys.size()
+        if self.stored > 0 and self.memkeys.size(1) != batch:
+            raise ValueError(
+                "Wrong batch dimension. Expected {} but got {} elements".format(
+                    self.memkeys.size(1), batch))
+
+        memkeys, memvals = self.ordered()
+        if self.stored > 0:
+            keys_, vals_ = torch.cat([memkeys, keys]), torch.cat([memvals, vals])
+        else:
+            keys_, vals_ = keys, vals
+
+        # (batch x n x dim) * (batch x dim x stored + n) => (n x batch x stored + n)
+        scores = torch.bmm(keys.transpose(0, 1), keys_.permute(1, 2, 0))
+        scores = scores.transpose(0, 1)
+
+        # causal window over the last `size` items
+        pos = torch.arange(0, len(keys_), dtype=torch.int64, device=keys.device)
+        step = torch.arange(0, n, dtype=torch.int64, device=keys.device) \
+                    .unsqueeze(1) + self.stored
+        mask = pos.unsqueeze(0).lt(step) & pos.unsqueeze(0).ge(step - self.size)
+        scores = scores.masked_fill(~mask.unsqueeze(1), -float('inf'))
+
+        return scores, vals_.t()
+
+
+def cache_target_probs(scores, vals, targets, theta):
+    """
+    Compute the probability assigned by the cache to the targets from the
+    output of `Cache.query_block` without materializing the distribution
+    over the vocabulary.
+
+    Parameters:
+    -----------
+    scores: torch.Tensor(n, batch, items)
+    vals: torch.LongTensor(batch, items)
+    targets: torch.LongTensor(n, batch)
+    theta: float
+
+    Returns:
+    --------
+    probs: torch.Tensor(n, batch), cache probability of the targets
+    has_items: torch.BoolTensor(n, batch), whether the window wasn't empty
+    """
+    visible = scores > -float('inf')
+    has_items = visible.sum(2) > 0
+    # mask after scaling (theta * -inf is undefined for zero theta)
+    probs = F.softmax((theta * scores).masked_fill(~visible, -float('inf')), dim=2)
+    probs = probs.masked_fill(~has_items.unsqueeze(2), 0)
+    match = vals.unsqueeze(0) == targets.unsqueeze(2)
+
+    return (probs * match.float()).sum(2), has_items
+
+
+def interpolate(model_probs, cache_probs, has_items, alpha):
+    """
+    Linear interpolation of model and cache probabilities of the targets,
+    only applied where the cache window wasn't empty. `alpha` can be a
+    float or a tensor broadcasting against the probabilities (e.g. to
+    evaluate several values at once).
+    """
+    probs = (1 - alpha) * model_probs + alpha * cache_probs
+    return torch.where(has_items, probs, model_probs.expand_as(probs))
+
+
+def evaluate_grid(hidden, targets, model_probs, size, thetas, alphas,
+                  block_size=100):
+    """
+    Evaluate a (theta, alpha) grid of cache parameters over precomputed
+    hidden states and model target probabilities in a single pass.
+
+    Parameters:
+    -----------
+    hidden: torch.Tensor(seq_len, batch, dim)
+    targets: torch.LongTensor(seq_len, batch)
+    model_probs: torch.Tensor(seq_len, batch), model probability of targets
+    size: int, cache size
+    thetas, alphas: lists of floats
+    block_size: int, number of steps to process at once
+
+    Returns:
+    --------
+    loss: torch.Tensor(len(thetas), len(alphas)), average negative
+        log-likelihood for each grid point
+    """
+    cache = Cache(hidden.size(2), size, None, device=hidden.device)
+    alphas = torch.tensor(alphas, device=hidden.device).view(-1, 1, 1)
+    loss = torch.zeros(len(thetas), len(alphas), device=hidden.device)
+
+    for start in range(0, len(hidden), block_size):
+        keys = hidden[start:start+block_size]
+        vals = targets[start:start+block_size]
+        probs = model_probs[start:start+block_size].unsqueeze(0)
+        scores, memvals = cache.query_block(keys, vals)
+        for idx, theta in enumerate(thetas):
+            cache_probs, has_items = cache_target_probs(scores, memvals, vals, theta)
+            # (alphas x n x batch)
+            probs_ = interpolate(probs, cache_probs, has_items, alphas)
+            loss[idx] -= probs_.add(1e-8).log().view(len(alphas), -1).sum(1)
+        cache.add(keys, vals)
 
-        return scores.t(), memvals.t()
+    return loss / targets.nelement()
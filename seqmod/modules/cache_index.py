@@ -0,0 +1,304 @@
+
+import torch
+
+
+def kmeans(x, k, niter=20, seed=None):
+    """
+    Lloyd's k-means with random initialization (squared euclidean distance).
+
+    Parameters:
+    -----------
+    x: torch.Tensor(n, dim)
+    k: int, number of centroids (must not exceed n)
+
+    Returns:
+    --------
+    centroids: torch.Tensor(k, dim)
+    """
+    if k > len(x):
+        raise ValueError("Can't fit {} centroids to {} points".format(k, len(x)))
+
+    generator = torch.Generator()
+    if seed is not None:
+        generator.manual_seed(seed)
+    perm = torch.randperm(len(x), generator=generator)[:k].to(x.device)
+    centroids = x[perm].clone()
+
+    for _ in range(niter):
+        assign = assign_centroids(x, centroids)
+        counts = torch.bincount(assign, minlength=k).float()
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        empty = counts == 0
+        # keep previous centroid for empty clusters
+        centroids = torch.where(
+            empty.unsqueeze(1), centroids, sums / counts.clamp(min=1).unsqueeze(1))
+
+    return centroids
+
+
+def assign_centroids(x, centroids, batch_size=8192):
+    """
+    Index of the closest centroid (squared euclidean distance) for each row.
+    """
+    norms = (centroids ** 2).sum(1)
+    assign = []
+    for start in range(0, len(x), batch_size):
+        # ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2 (||x||^2 is constant)
+        dists = norms.unsqueeze(0) - 2 * x[start:start+batch_size] @ centroids.t()
+        assign.append(dists.min(1)[1])
+    return torch.cat(assign)
+
+
+class BruteForceIndex(object):
+    """
+    Exact inner product search over a ring buffer of keys.
+
+    Parameters:
+    -----------
+    dim: int, dimensionality of the keys
+    size: int, maximum number of stored keys (older keys are overwritten)
+    """
+    def __init__(self, dim, size, device='cpu'):
+        self.dim = dim
+        self.size = size
+        self.device = device
+        self.reset()
+
+    def __len__(self):
+        return self.stored
+
+    def reset(self):
+        self.stored = 0
+        self.current = 0
+        self._init_storage()
+        self.vals = torch.zeros(self.size, dtype=torch.int64, device=self.device)
+
+    def _init_storage(self):
+        self.keys = torch.zeros(self.size, self.dim, device=self.device)
+
+    def _slots(self, n):
+        """
+        Ring buffer slots for `n` new items (only the last `size` are kept)
+        """
+        slots = torch.arange(self.current, self.current + n,
+                             dtype=torch.int64, device=self.device) % self.size
+        self.current = (self.current + n) % self.size
+        self.stored = min(self.size, self.stored + n)
+        return slots
+
+    def add(self, keys, vals):
+        """
+        Parameters:
+        -----------
+        keys: torch.Tensor(n, dim)
+        vals: torch.LongTensor(n)
+        """
+        keys, vals = keys[-self.size:], vals[-self.size:]
+        slots = self._slots(len(keys))
+        self.keys.index_copy_(0, slots, keys)
+        self.vals.index_copy_(0, slots, vals)
+
+    def search(self, queries, k):
+        """
+        Parameters:
+        -----------
+        queries: torch.Tensor(batch, dim)
+        k: int, number of neighbours
+
+        Returns:
+        --------
+        scores: torch.Tensor(batch, k), inner products (-inf if less than
+            k items were found)
+        vals: torch.LongTensor(batch, k)
+        """
+        scores = queries @ self.keys[:self.stored].t()
+        k_ = min(k, self.stored)
+        scores, index = scores.topk(k_, dim=1)
+        return _pad_results(scores, self.vals[index], k)
+
+
+def _pad_results(scores, vals, k):
+    if scores.size(1) < k:
+        missing = k - scores.size(1)
+        scores = torch.cat(
+            [scores, scores.new_full((len(scores), missing), -float('inf'))], 1)
+        vals = torch.cat([vals, vals.new_zeros((len(vals), missing))], 1)
+    return scores, vals
+
+
+class IVFIndex(BruteForceIndex):
+    """
+    Approximate inner product search with an inverted file: keys are
+    assigned to the closest of `nlist` coarse centroids and queries are only
+    scored against the keys in the `nprobe` closest clusters. The coarse
+    quantizer has to be trained on a sample of keys before adding (see
+    `train`).
+
+    Parameters:
+    -----------
+    dim: int, dimensionality of the keys
+    size: int, maximum number of stored keys (older keys are overwritten)
+    nlist: int, number of coarse clusters
+    nprobe: int, number of clusters visited per query
+    """
+    def __init__(self, dim, size, nlist=1024, nprobe=8, device='cpu'):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.coarse = None
+        super(IVFIndex, self).__init__(dim, size, device=device)
+
+    @property
+    def is_trained(self):
+        return self.coarse is not None
+
+    def reset(self):
+        super(IVFIndex, self).reset()
+        self.assign = torch.full(
+            (self.size,), -1, dtype=torch.int64, device=self.device)
+        self.lists = [torch.zeros(0, dtype=torch.int64, device=self.device)
+                      for _ in range(self.nlist)]
+
+    def train(self, keys, niter=20, seed=None):
+        """
+        Fit the coarse quantizer on a sample of keys.
+
+        Parameters:
+        -----------
+        keys: torch.Tensor(n, dim), with n at least nlist
+        """
+        self.coarse = kmeans(keys.to(self.device), self.nlist, niter=niter, seed=seed)
+
+    def _store(self, slots, keys, assign):
+        self.keys.index_copy_(0, slots, keys)
+
+    def add(self, keys, vals):
+        if not self.is_trained:
+            raise ValueError("{} must be trained before adding keys".format(
+                type(self).__name__))
+
+        keys, vals = keys[-self.size:], vals[-self.size:]
+        assign = assign_centroids(keys, self.coarse)
+        slots = self._slots(len(keys))
+        self._store(slots, keys, assign)
+        self.vals.index_copy_(0, slots, vals)
+        # overwritten slots remain in their old lists until compaction,
+        # they are filtered out at search time (see _candidates)
+        self.assign.index_copy_(0, slots, assign)
+
+        assign, sort = assign.sort()
+        slots = slots[sort]
+        clusters, counts = torch.unique_consecutive(assign, return_counts=True)
+        for cluster, cluster_slots in zip(clusters.tolist(), slots.split(counts.tolist())):
+            lst = torch.cat([self.lists[cluster], cluster_slots])
+            if len(lst) > 2 * self.size / self.nlist + 64:  # compact
+                lst = lst[self.assign[lst] == cluster].unique()
+            self.lists[cluster] = lst
+
+    def _candidates(self, clusters):
+        cands = torch.cat([self.lists[c] for c in clusters])
+        cand_clusters = torch.cat([
+            torch.full((len(self.lists[c]),), c, dtype=torch.int64, device=self.device)
+            for c in clusters])
+        # drop slots that were overwritten by a key in a different cluster
+        # (and duplicates of slots re-added to the same cluster)
+        cands = cands[self.assign[cands] == cand_clusters].unique()
+        return cands, self.assign[cands]
+
+    def _prepare(self, queries, coarse_scores):
+        return queries
+
+    def _score(self, prepared, coarse_scores, cands, cand_clusters):
+        return self.keys[cands] @ prepared
+
+    def search(self, queries, k, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        # (batch x nlist)
+        coarse_scores = queries @ self.coarse.t()
+        probes = coarse_scores.topk(nprobe, dim=1)[1].tolist()
+        prepared = self._prepare(queries, coarse_scores)
+
+        scores, vals = [], []
+        for b, clusters in enumerate(probes):
+            cands, cand_clusters = self._candidates(clusters)
+            score = self._score(prepared[b], coarse_scores[b], cands, cand_clusters)
+            score, index = score.topk(min(k, len(cands)))
+            score, val = _pad_results(
+                score.unsqueeze(0), self.vals[cands[index]].unsqueeze(0), k)
+            scores.append(score)
+            vals.append(val)
+
+        return torch.cat(scores), torch.cat(vals)
+
+
+class IVFPQIndex(IVFIndex):
+    """
+    Inverted file index with product quantized residuals (IVF-PQ). Keys are
+    only stored as `num_subspaces` codes of `nbits` bits (one byte each) and
+    scored with lookup tables (asymmetric distance computation). Coarse
+    quantizer and PQ codebooks have to be trained on a sample of keys before
+    adding (see `train`).
+
+    Parameters:
+    -----------
+    dim: int, dimensionality of the keys
+    size: int, maximum number of stored keys (older keys are overwritten)
+    nlist: int, number of coarse clusters
+    num_subspaces: int, number of PQ subspaces (must divide dim)
+    nbits: int, bits per subspace code (at most 8)
+    nprobe: int, number of clusters visited per query
+    """
+    def __init__(self, dim, size, nlist=1024, num_subspaces=16, nbits=8,
+                 nprobe=8, device='cpu'):
+        if dim % num_subspaces != 0:
+            raise ValueError("num_subspaces must divide dim")
+        if nbits > 8:
+            raise ValueError("nbits must be at most 8")
+
+        self.num_subspaces = num_subspaces
+        self.ksub = 2 ** nbits
+        self.codebooks = None
+        super(IVFPQIndex, self).__init__(
+            dim, size, nlist=nlist, nprobe=nprobe, device=device)
+
+    def _init_storage(self):
+        self.codes = torch.zeros(
+            self.size, self.num_subspaces, dtype=torch.uint8, device=self.device)
+
+    def train(self, keys, niter=20, seed=None):
+        """
+        Fit the coarse quantizer and the PQ codebooks on a sample of keys.
+
+        Parameters:
+        -----------
+        keys: torch.Tensor(n, dim), with n at least max(nlist, 2 ** nbits)
+        """
+        keys = keys.to(self.device)
+        super(IVFPQIndex, self).train(keys, niter=niter, seed=seed)
+        residuals = keys - self.coarse[assign_centroids(keys, self.coarse)]
+        residuals = residuals.view(len(keys), self.num_subspaces, -1)
+        # (num_subspaces x ksub x dsub)
+        self.codebooks = torch.stack([
+            kmeans(residuals[:, m], self.ksub, niter=niter, seed=seed)
+            for m in range(self.num_subspaces)])
+
+    def _store(self, slots, keys, assign):
+        residuals = (keys - self.coarse[assign]).view(len(keys), self.num_subspaces, -1)
+        codes = torch.stack([
+            assign_centroids(residuals[:, m], self.codebooks[m])
+            for m in range(self.num_subspaces)], 1)
+        self.codes.index_copy_(0, slots, codes.to(torch.uint8))
+
+    def _prepare(self, queries, coarse_scores):
+        # (batch x num_subspaces * ksub) lookup tables of inner products
+        # between query subvectors and codebook entries
+        luts = torch.einsum(
+            'bmd,mkd->bmk',
+            queries.view(len(queries), self.num_subspaces, -1), self.codebooks)
+        return luts.contiguous().view(len(queries), -1)
+
+    def _score(self, lut, coarse_scores, cands, cand_clusters):
+        # q.key = q.centroid + q.residual
+        offsets = torch.arange(
+            0, self.num_subspaces, device=self.device) * self.ksub
+        codes = self.codes[cands].long() + offsets
+        return lut.take(codes).sum(1) + coarse_scores[cand_clusters]
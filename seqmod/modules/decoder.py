@@ -5,7 +5,7 @@ import torch
 import torch.nn as nn
 
 from seqmod.modules.rnn import StackedGRU, StackedLSTM
-from seqmod.modules.softmax import FullSoftmax, SampledSoftmax
+from seqmod.modules.softmax import FullSoftmax, SampledSoftmax, AdaptiveSoftmax
 from seqmod.modules import attention
 from seqmod.modules.torch_utils import make_length_mask, make_dropout_mask, swap
 
@@ -52,8 +52,16 @@ class BaseDecoder(nn.Module):
 class RNNWrapper(nn.Module):
     """
     Wrapper to abstract over RNN and RNNCell differences for the decoder
+
+    Parameters:
+    -----------
+
+    - jit: bool, whether the stacked cells should run the loop over layers
+        as a TorchScript compiled function (ignored if `ffw` is True, since
+        the native RNN modules already run the layers in a single kernel).
     """
-    def __init__(self, num_layers, in_dim, hid_dim, cell, dropout=0.0, ffw=False):
+    def __init__(self, num_layers, in_dim, hid_dim, cell, dropout=0.0, ffw=False,
+                 jit=False):
         self.ffw = ffw
         self.in_dim = in_dim
         super(RNNWrapper, self).__init__()
@@ -63,7 +71,7 @@ class RNNWrapper(nn.Module):
             self.rnn = stacked(in_dim, hid_dim, num_layers, dropout=dropout)
         else:
             stacked = StackedLSTM if cell == 'LSTM' else StackedGRU
-            self.rnn = stacked(num_layers, in_dim, hid_dim, dropout=dropout)
+            self.rnn = stacked(num_layers, in_dim, hid_dim, dropout=dropout, jit=jit)
 
     def forward(self, inp, hidden, dropout_mask=None):
         if self.ffw:
@@ -96,13 +104,17 @@ class RNNDecoder(BaseDecoder):
     - context_feed: bool, whether to concatenate the encoding to the
         rnn input to facilitate gradient flow from the encoder to each
         decoder step. (Useful for non-attentive decoders.)
+    - jit: bool, whether to run the per-step loop over rnn layers as a
+        TorchScript compiled function (only used with variational dropout
+        or input feeding, see RNNWrapper).
     """
     def __init__(self, embeddings, hid_dim, num_layers, cell, encoding_size,
                  dropout=0.0, variational=False, input_feed=False,
                  context_feed=False, sampled_softmax=False,
-                 att_type=None, deepout_layers=0, deepout_act='ReLU',
+                 adaptive_softmax=False, adaptive_cutoffs=None,
+                 loss_chunk_size=0, att_type=None, deepout_layers=0, deepout_act='ReLU',
                  tie_weights=False, train_init=False, add_init_jitter=False,
-                 reuse_hidden=True, cond_dims=None, cond_vocabs=None):
+                 reuse_hidden=True, cond_dims=None, cond_vocabs=None, jit=False):
 
         if train_init and reuse_hidden:
             logging.warn("Decoder `train_init` is True therefore "
@@ -121,6 +133,7 @@ class RNNDecoder(BaseDecoder):
         self.train_init = train_init
         self.add_init_jitter = add_init_jitter
         self.reuse_hidden = reuse_hidden
+        self.jit = jit
 
         self.has_attention = False
         if self.att_type is not None and self.att_type.lower() != 'none':
@@ -147,7 +160,7 @@ class RNNDecoder(BaseDecoder):
 
         # rnn layer
         self.rnn = RNNWrapper(num_layers, in_dim, hid_dim, cell,
-                              dropout=dropout, ffw=self.ffw)
+                              dropout=dropout, ffw=self.ffw, jit=jit)
 
         # train init
         self.h_0 = None
@@ -161,16 +174,21 @@ class RNNDecoder(BaseDecoder):
                 self.hid_dim, self.hid_dim, scorer=self.att_type)
 
         # output projection
-        if sampled_softmax:
+        if adaptive_softmax:
+            self.project = AdaptiveSoftmax(
+                hid_dim, self.embeddings.num_embeddings, cutoffs=adaptive_cutoffs)
+        elif sampled_softmax:
             self.project = SampledSoftmax(
                 hid_dim, self.embeddings.embedding_dim, self.embeddings.num_embeddings,
                 nsampled=8192, tie_weights=tie_weights, dropout=dropout,
-                deepout_layers=deepout_layers, deepout_act=deepout_act)
+                deepout_layers=deepout_layers, deepout_act=deepout_act,
+                loss_chunk_size=loss_chunk_size)
         else:
             self.project = FullSoftmax(
                 hid_dim, self.embeddings.embedding_dim, self.embeddings.num_embeddings,
                 tie_weights=tie_weights, dropout=dropout,
-                deepout_layers=deepout_layers, deepout_act=deepout_act)
+                deepout_layers=deepout_layers, deepout_act=deepout_act,
+                loss_chunk_size=loss_chunk_size)
 
         if tie_weights:
             self.project.tie_embedding_weights(self.embeddings)
@@ -237,7 +255,8 @@ class RNNDecoder(BaseDecoder):
         input_feed = None
         if self.input_feed:
             # init with gaussian
-            input_feed = context.new(batch, self.hid_dim).normal_(0, 0.05)
+            input_feed = torch.zeros(
+                batch, self.hid_dim, device=context.device).normal_(0, 0.05)
 
         if self.conditional:
             if conds is None:
@@ -270,10 +289,10 @@ class RNNDecoder(BaseDecoder):
 
         # condition on encoder summary for non-attentive decoders
         if self.context_feed:
-            inp = torch.cat([inp, state.context], 1)
+            inp = torch.cat([inp, state.select_beam(state.context)], 1)
 
         if self.conditional:
-            inp = torch.cat([inp, state.conds], 1)
+            inp = torch.cat([inp, state.select_beam(state.conds)], 1)
 
         out, hidden = self.rnn(inp, state.hidden)
 
@@ -334,7 +353,32 @@ class State(object):
     Abstract state class to be implemented by different decoder states.
     It is used to carry over data across subsequent steps of the decoding
     process. For beam search two methods are obligatory.
+
+    Expanding a state along the beam only copies the mutable parts of the
+    state (e.g. the hidden state). Read-only encoder tensors are kept as a
+    single copy and the beam entries are mapped back to their original batch
+    entries through `beam_map` (see `select_beam`). Beam entries are laid out
+    contiguously per batch entry: (batch * width).
     """
+    beam_map = None
+
+    def make_beam_map(self, batch, width, device='cpu'):
+        """
+        Compute a LongTensor (batch * width) mapping each beam entry to its
+        source batch entry.
+        """
+        self.beam_map = torch.arange(0, batch, dtype=torch.int64, device=device) \
+                             .unsqueeze(1).repeat(1, width).view(-1)
+        return self.beam_map
+
+    def select_beam(self, t, dim=0):
+        """
+        Index a read-only tensor with batch dimension `dim` along the beam.
+        """
+        if t is None or self.beam_map is None:
+            return t
+        return t.index_select(dim, self.beam_map)
+
     def expand_along_beam(self, width):
         raise NotImplementedError
 
@@ -344,6 +388,13 @@ class State(object):
     def split_batches(self):
         raise NotImplementedError
 
+    def index_batches(self, index):
+        raise NotImplementedError
+
+    @classmethod
+    def concat_batches(cls, states):
+        raise NotImplementedError
+
 
 class RNNDecoderState(State):
     """
@@ -361,27 +412,23 @@ class RNNDecoderState(State):
 
     def expand_along_beam(self, width):
         """
-        Expand state attributes to match the beam width
+        Expand state attributes to match the beam width. Only `hidden` and
+        `input_feed` are actually copied, since they get updated during
+        decoding. Context, encoder attention, mask and conditions remain
+        untouched and are accessed along the beam through `beam_map`.
         """
+        batch = self.context.size(0 if self.context.dim() == 2 else 1)
+        beam_map = self.make_beam_map(batch, width, device=self.context.device)
+
         if isinstance(self.hidden, tuple):
-            hidden = (self.hidden[0].repeat(1, width, 1),
-                      self.hidden[1].repeat(1, width, 1))
+            hidden = (self.hidden[0].index_select(1, beam_map),
+                      self.hidden[1].index_select(1, beam_map))
         else:
-            hidden = self.hidden.repeat(1, width, 1)
+            hidden = self.hidden.index_select(1, beam_map)
         self.hidden = hidden
-        if self.context.dim() == 2:
-            self.context = self.context.repeat(width, 1)
-        else:
-            self.context = self.context.repeat(1, width, 1)
 
         if self.input_feed is not None:
-            self.input_feed = self.input_feed.repeat(width, 1)
-        if self.enc_att is not None:
-            self.enc_att = self.enc_att.repeat(1, width, 1)
-        if self.mask is not None:
-            self.mask = self.mask.repeat(width, 1)
-        if self.conds is not None:
-            self.conds = self.conds.repeat(width, 1)
+            self.input_feed = self.input_feed.index_select(0, beam_map)
 
     def reorder_beam(self, beam_ids):
         """
@@ -396,6 +443,36 @@ class RNNDecoderState(State):
             hidden = swap(self.hidden, 1, beam_ids)
         self.hidden = hidden
 
+    def index_batches(self, index):
+        """
+        Create a new decoder state selecting (possibly repeated) batch entries
+        according to `index` (e.g. to broadcast the state of each source
+        sentence over several target candidates).
+
+        Parameters:
+        -----------
+        index: torch.LongTensor (new_batch), batch entry for each output row
+        """
+        if isinstance(self.hidden, tuple):
+            hidden = (self.hidden[0].index_select(1, index),
+                      self.hidden[1].index_select(1, index))
+        else:
+            hidden = self.hidden.index_select(1, index)
+
+        context = self.context.index_select(
+            0 if self.context.dim() == 2 else 1, index)
+
+        def select(t, dim):
+            return t.index_select(dim, index) if t is not None else None
+
+        return RNNDecoderState(
+            hidden, context,
+            input_feed=select(self.input_feed, 0),
+            enc_att=select(self.enc_att, 1),
+            mask=select(self.mask, 0),
+            conds=select(self.conds, 0),
+            dropout_mask=select(self.dropout_mask, 0))
+
     def split_batches(self):
         """
         After encoding, split the decoder state into single decoder states
@@ -431,3 +508,53 @@ class RNNDecoderState(State):
                 enc_att=enc_att[b] if enc_att is not None else None,
                 mask=mask[b] if mask is not None else None,
                 conds=conds[b] if conds is not None else None)
+
+    @classmethod
+    def concat_batches(cls, states):
+        """
+        Create a new decoder state concatenating the batch entries of several
+        states (e.g. to admit new inputs into a running decoding batch).
+        Encoder outputs of different length are right-padded (and masked).
+        """
+        def cat(ts, dim):
+            return torch.cat(ts, dim) if ts[0] is not None else None
+
+        def pad(ts, dim):
+            maxlen = max(t.size(dim) for t in ts)
+            padded = []
+            for t in ts:
+                size = list(t.size())
+                size[dim] = maxlen - t.size(dim)
+                padded.append(torch.cat([t, t.new_zeros(size)], dim))
+            return padded
+
+        if isinstance(states[0].hidden, tuple):
+            hidden = (torch.cat([s.hidden[0] for s in states], 1),
+                      torch.cat([s.hidden[1] for s in states], 1))
+        else:
+            hidden = torch.cat([s.hidden for s in states], 1)
+
+        context = [s.context for s in states]
+        if context[0].dim() == 2:
+            context = torch.cat(context, 0)
+        else:
+            context = torch.cat(pad(context, 0), 1)
+
+        enc_att = [s.enc_att for s in states]
+        if enc_att[0] is not None:
+            enc_att = torch.cat(pad(enc_att, 0), 1)
+        else:
+            enc_att = None
+
+        mask = [s.mask for s in states]
+        if mask[0] is not None:
+            mask = torch.cat(pad(mask, 1), 0)
+        else:
+            mask = None
+
+        return cls(
+            hidden, context,
+            input_feed=cat([s.input_feed for s in states], 0),
+            enc_att=enc_att, mask=mask,
+            conds=cat([s.conds for s in states], 0),
+            dropout_mask=cat([s.dropout_mask for s in states], 0))
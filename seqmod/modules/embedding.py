@@ -3,7 +3,6 @@
 from itertools import accumulate
 
 import numpy as np
-from sklearn.linear_model import LinearRegression
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
@@ -222,6 +221,9 @@ class Embedding(nn.Embedding):
             not all words will be added eventually if those aren't found in the ref
             space).
         """
+        # scikit-learn is slow to import, only needed here
+        from sklearn.linear_model import LinearRegression
+
         # load embeddings
         weight, words = EmbeddingLoader(fpath, mode).load(verbose=verbose, **kwargs)
         weight = np.array(weight)
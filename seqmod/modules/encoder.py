@@ -3,6 +3,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from seqmod import utils as u
 from seqmod.modules.ff import grad_reverse, MLP, MaxOut
 
 
@@ -55,7 +56,9 @@ def GRLWrapper(EncoderBaseClass):
             grl_loss.append(F.nll_loss(cond_out, cond, size_average=True))
 
         if not test:
+            u.mark_phase('forward')
             (sum(grl_loss) / len(self.grls)).backward(retain_graph=True)
+            u.mark_phase('backward')
 
         return [l.item() for l in grl_loss], cond.size(0)
 
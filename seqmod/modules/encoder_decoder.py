@@ -1,14 +1,20 @@
 
+import copy
+import logging
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from seqmod import utils as u
 from seqmod.misc.beam_search import Beam
+from seqmod.misc.dataset import pad_sequential_batch
 from seqmod.modules.rnn_encoder import RNNEncoder, GRLRNNEncoder
-from seqmod.modules.softmax import SampledSoftmax
+from seqmod.modules.softmax import FullSoftmax, SampledSoftmax, AdaptiveSoftmax
 from seqmod.modules.decoder import RNNDecoder
 from seqmod.modules.embedding import Embedding
 from seqmod.modules.torch_utils import flip, shards, select_cols
+from seqmod.modules.torch_utils import make_length_mask
 from seqmod.modules.exposure import scheduled_sampling
 
 
@@ -80,16 +86,32 @@ class EncoderDecoder(nn.Module):
                 dec_outs.append(out)
             dec_outs = torch.stack(dec_outs)
 
-        # compute memory efficient decoder loss
+        # only project non-padding positions: ((trg_len * batch) - pads x hid_dim)
+        dec_outs, targets = dec_outs.view(-1, dec_outs.size(-1)), targets.view(-1)
+        pad = self.decoder.embeddings.d.get_pad()
+        if pad is not None:
+            index = (targets != pad).nonzero().view(-1)
+            dec_outs = dec_outs.index_select(0, index)
+            targets = targets.index_select(0, index)
+
+        # compute memory efficient decoder loss (shards of `split` steps)
         loss, shard_data = 0, {'out': dec_outs, 'trg': targets}
+        size = split * inp.size(1)
 
-        for shard in shards(shard_data, size=split, test=test):
-            out, true = shard['out'], shard['trg'].view(-1)
+        for shard in shards(shard_data, size=size, test=test):
+            out, true = shard['out'], shard['trg']
 
             if isinstance(self.decoder.project, SampledSoftmax) and self.training:
                 out, new_true = self.decoder.project(
                     out, targets=true, normalize=False, reshape=False)
                 shard_loss = F.cross_entropy(out, new_true, size_average=False)
+            elif isinstance(self.decoder.project, AdaptiveSoftmax):
+                logprobs = self.decoder.project(out, targets=true)
+                shard_loss = -(logprobs * self.nll_weight[true]).sum()
+            elif isinstance(self.decoder.project, FullSoftmax) and \
+                 self.decoder.project.loss_chunk_size:
+                shard_loss = self.decoder.project.chunked_loss(
+                    out, true, weight=self.nll_weight)
             else:
                 shard_loss = F.nll_loss(
                     self.decoder.project(out), true, size_average=False,
@@ -99,7 +121,10 @@ class EncoderDecoder(nn.Module):
             loss += shard_loss.item()
 
             if not test:
+                # each shard is projected after the backward of the previous one
+                u.mark_phase('forward')
                 shard_loss.backward(retain_graph=True)
+                u.mark_phase('backward')
 
         return loss
 
@@ -110,7 +135,8 @@ class EncoderDecoder(nn.Module):
         Parameters:
         -----------
 
-        - split: int, max targets per binned softmax loss computation
+        - split: int, max targets per binned softmax loss computation (in
+            number of decoding steps over the batch; padding is skipped)
         - use_schedule: bool, whether to use scheduled sampling when computing
             the decoder loss. The rate of sampling is defined by the
             instance variable `exposure_rate`.
@@ -146,8 +172,99 @@ class EncoderDecoder(nn.Module):
 
         return (dec_loss, *enc_losses), num_examples
 
+    def score(self, src, lengths, candidates, conds=None, batch_size=50):
+        """
+        Compute the log-probability of candidate target sequences given their
+        source sequence (forced decoding), e.g. to rerank n-best lists.
+        Each source sequence is encoded only once. Candidates are decoded in
+        rounds of `width` candidates per source sequence laid out as a beam
+        (see State.expand_along_beam), so that only the mutable parts of the
+        decoder state are copied over the candidates. No gradient is computed.
+
+        Parameters:
+        -----------
+
+        src: torch.LongTensor (seq_len x batch_size)
+        lengths: torch.LongTensor (batch_size)
+        candidates: list (batch_size) of lists of candidates, where each
+            candidate is a non-empty list of ints in the same format as the
+            hypotheses output by `translate` (i.e. without <bos>). Include
+            <eos> in the candidate if it should be scored.
+        conds: (optional) conditions for the decoder
+        batch_size: int, number of candidates to decode in parallel. Each
+            round decodes `max(1, batch_size // len(candidates))` candidates
+            per source sequence.
+
+        Returns:
+        --------
+        scores: list (batch_size) of lists of floats, log-probability of each
+            candidate in the same order as the input.
+        """
+        if len(candidates) != src.size(1):
+            raise ValueError("Expected candidates for {} source sequences "
+                             "but got {}".format(src.size(1), len(candidates)))
+
+        if any(len(cand) == 0 for cands in candidates for cand in cands):
+            raise ValueError("Can't score empty candidates")
+
+        if self.training:
+            logging.warn("Scoring in training mode!")
+
+        bos = self.decoder.embeddings.d.get_bos()
+        if self.reverse:
+            bos = self.decoder.embeddings.d.get_eos()
+        pad = self.decoder.embeddings.d.get_pad()
+
+        scores = [[0.0] * len(cands) for cands in candidates]
+        width = max(1, batch_size // len(candidates))
+        # longest candidates first, so that candidates in a round have similar
+        # lengths across source sequences
+        order = [sorted(range(len(cands)), key=lambda c: -len(cands[c]))
+                 for cands in candidates]
+
+        with torch.no_grad():
+            enc_outs, enc_hidden = self.encoder(src, lengths=lengths)
+            dec_state = self.decoder.init_state(
+                enc_outs, enc_hidden, lengths, conds=conds)
+
+            for start in range(0, max(map(len, order), default=0), width):
+                # (batch * width) rows, missing candidates are left empty
+                rows, trg = [], []
+                for b, cands in enumerate(order):
+                    for c in cands[start:start+width]:
+                        rows.append((b, c))
+                        cand = candidates[b][c]
+                        # decoder runs on the reversed target for reversed models
+                        trg.append([bos] + list(cand[::-1] if self.reverse else cand))
+                    for _ in range(width - len(cands[start:start+width])):
+                        rows.append(None)
+                        trg.append([bos])
+
+                trg, trg_lengths = pad_sequential_batch(trg, pad, True, False)
+                trg = trg.to(device=src.device)
+                trg_lengths = torch.tensor(trg_lengths, device=src.device) - 1
+
+                state = copy.copy(dec_state)
+                state.expand_along_beam(width)
+                dec_inp, dec_targets = trg[:-1], trg[1:]
+                dec_outs = torch.stack([self.decoder(t, state)[0] for t in dec_inp])
+
+                # (trg_len x batch x vocab) => (trg_len x batch)
+                logprobs = self.decoder.project(dec_outs, reshape=True)
+                logprobs = logprobs.gather(2, dec_targets.unsqueeze(2)).squeeze(2)
+                # (batch x trg_len) => (trg_len x batch)
+                mask = make_length_mask(trg_lengths).t()
+                logprobs = logprobs.masked_fill(~mask, 0).sum(0)
+
+                for row, logprob in zip(rows, logprobs.tolist()):
+                    if row is not None:
+                        scores[row[0]][row[1]] = logprob
+
+        return scores
+
     def translate(self, src, lengths, conds=None, max_decode_len=2,
-                  on_init_state=None, on_step=None, sample=False, tau=1.0):
+                  on_init_state=None, on_step=None, sample=False, tau=1.0,
+                  shortlist=None):
         """
         Translate a single input sequence using greedy decoding.
 
@@ -155,6 +272,9 @@ class EncoderDecoder(nn.Module):
         -----------
 
         src: torch.LongTensor (seq_len x batch_size)
+        shortlist: (optional) seqmod.modules.shortlist.Shortlist used to
+            restrict the output projection to a candidate set computed
+            over the entire input batch.
 
         Returns (scores, hyps, atts):
         --------
@@ -178,6 +298,7 @@ class EncoderDecoder(nn.Module):
         scores, hyps, weights = 0, [], []
         mask = torch.ones(batch_size, dtype=torch.int64)
         prev = src.new([bos] * batch_size)
+        ids = shortlist(src) if shortlist is not None else None
 
         for _ in range(len(src) * max_decode_len):
             if on_step is not None:
@@ -185,12 +306,14 @@ class EncoderDecoder(nn.Module):
 
             out, weight = self.decoder(prev, dec_state)
             # decode
-            logprobs = self.decoder.project(out)
+            logprobs = self.decoder.project(out, shortlist=ids)
             if sample:
                 prev = (logprobs / tau).exp().multinomial(1).squeeze(1)
                 logprobs = select_cols(logprobs, prev)
             else:
                 logprobs, prev = logprobs.max(1)
+            if ids is not None:
+                prev = ids[prev]  # map shortlist columns back to vocab ids
 
             # accumulate
             hyps.append(prev.tolist())
@@ -216,7 +339,8 @@ class EncoderDecoder(nn.Module):
         return scores, hyps, weights
 
     def translate_beam(self, src, lengths, conds=None, beam_width=5,
-                       max_decode_len=2, on_init_state=None, on_step=None):
+                       max_decode_len=2, on_init_state=None, on_step=None,
+                       shortlist=None):
         """
         Translate a single input sequence using beam search.
 
@@ -229,6 +353,8 @@ class EncoderDecoder(nn.Module):
         beam_width: int, width of the beam
         max_decode_len: int, limit to the length of the output sequence
             in terms of the size of the input sequence
+        shortlist: (optional) seqmod.modules.shortlist.Shortlist used to
+            restrict the output projection to a per-sentence candidate set.
 
         Returns:
         --------
@@ -255,7 +381,10 @@ class EncoderDecoder(nn.Module):
         if on_init_state is not None:
             on_init_state(self, dec_state)
 
-        for state in dec_state.split_batches():
+        for idx, state in enumerate(dec_state.split_batches()):
+            ids = None
+            if shortlist is not None:
+                ids = shortlist(src[:lengths[idx], idx])
             # create beam
             state.expand_along_beam(beam_width)
             beam = Beam(beam_width, bos, eos=eos, device=src.device)
@@ -268,8 +397,9 @@ class EncoderDecoder(nn.Module):
                 # advance
                 prev = beam.get_current_state()
                 dec_out, weight = self.decoder(prev, state)
-                logprobs = self.decoder.project(dec_out)  # (width x vocab_size)
-                beam.advance(logprobs)
+                # (width x vocab_size)
+                logprobs = self.decoder.project(dec_out, shortlist=ids)
+                beam.advance(logprobs, index=ids)
                 state.reorder_beam(beam.get_source_beam())
                 # TODO: add attention weight for decoded steps
 
@@ -305,6 +435,9 @@ def make_rnn_encoder_decoder(
         encoder_summary='full',
         att_type=None,
         sampled_softmax=False,
+        adaptive_softmax=False,
+        adaptive_cutoffs=None,
+        loss_chunk_size=0,
         dropout=0.0,
         variational=False,
         input_feed=False,
@@ -318,7 +451,8 @@ def make_rnn_encoder_decoder(
         add_init_jitter=False,
         cond_dims=None,
         cond_vocabs=None,
-        reverse=False
+        reverse=False,
+        jit=False
 ):
     """
     - num_layers: int, Number of layers for both the encoder and the decoder.
@@ -330,6 +464,11 @@ def make_rnn_encoder_decoder(
     - bidi: bool, Whether to use bidirectional encoder.
     - encoder_summary: How to compute summary vector for the decoder.
     - att_type: string, Attention mechanism to use.
+    - sampled_softmax: bool, use a sampled softmax in the decoder.
+    - adaptive_softmax: bool, use an adaptive softmax in the decoder.
+    - adaptive_cutoffs: list of ints, cluster cutoffs for the adaptive softmax.
+    - loss_chunk_size: int, if positive, compute the decoder loss in chunks of
+        the given number of rows (see FullSoftmax.chunked_loss).
     - dropout: float,
     - variational: bool, whether to do variational dropout on the decoder
     - input_feed: bool,
@@ -351,6 +490,8 @@ def make_rnn_encoder_decoder(
         to each condition.
     - cond_vocabs: tuple of integers with the number of classes for each
         condition in same order as `cond_dims`.
+    - jit: bool, whether the decoder runs the loop over rnn layers as a
+        TorchScript compiled function (see RNNDecoder).
     """
     src_embeddings, trg_embeddings = make_embeddings(
         src_dict, trg_dict, emb_dim, word_dropout)
@@ -376,11 +517,14 @@ def make_rnn_encoder_decoder(
     decoder = RNNDecoder(trg_embeddings, hid_dim, dec_layers, cell, encoder_size,
                          dropout=dropout, variational=variational, input_feed=input_feed,
                          context_feed=context_feed, sampled_softmax=sampled_softmax,
+                         adaptive_softmax=adaptive_softmax,
+                         adaptive_cutoffs=adaptive_cutoffs,
+                         loss_chunk_size=loss_chunk_size,
                          att_type=att_type, deepout_layers=deepout_layers,
                          deepout_act=deepout_act,
                          tie_weights=tie_weights, reuse_hidden=reuse_hidden,
                          train_init=train_init, add_init_jitter=add_init_jitter,
-                         cond_dims=cond_dims, cond_vocabs=cond_vocabs)
+                         cond_dims=cond_dims, cond_vocabs=cond_vocabs, jit=jit)
 
     if decoder.has_attention:
         if encoder_summary != 'full':
@@ -0,0 +1,259 @@
+
+import os
+import copy
+import json
+import warnings
+
+import torch
+import torch.nn as nn
+
+from seqmod.modules.lm import BaseLM
+from seqmod.modules.decoder import RNNDecoderState
+from seqmod.modules.torch_utils import get_last_token
+
+
+# decoder state fields in the order they are passed to the traced modules
+STATE_FIELDS = ('h', 'c', 'context', 'enc_att', 'mask', 'input_feed')
+
+
+def _hidden_tensors(hidden):
+    if isinstance(hidden, tuple):
+        return list(hidden)
+    return [hidden]
+
+
+def _make_hidden(tensors):
+    if len(tensors) == 2:
+        return tuple(tensors)
+    return tensors[0]
+
+
+def _state_tensors(state):
+    """
+    Flatten an RNNDecoderState into an ordered dict of (non-empty) tensors.
+    """
+    tensors = dict(zip(('h', 'c'), _hidden_tensors(state.hidden)))
+    tensors.update(context=state.context, enc_att=state.enc_att,
+                   mask=state.mask, input_feed=state.input_feed)
+    return [(f, tensors[f]) for f in STATE_FIELDS if tensors.get(f) is not None]
+
+
+def _batch_dim(field, tensor):
+    if field in ('h', 'c', 'enc_att') or (field == 'context' and tensor.dim() == 3):
+        return 1
+    return 0
+
+
+def _without(module, *names):
+    """
+    Shallow copy of a module without the given submodules, so that they
+    aren't serialized with the traced module that wraps it.
+    """
+    module = copy.copy(module)
+    module._modules = copy.copy(module._modules)
+    for name in names:
+        module._modules.pop(name, None)
+    return module
+
+
+class EncoderExport(nn.Module):
+    """
+    Encoder and decoder state initialization of an EncoderDecoder:
+    (src, lengths) -> state tensors (see STATE_FIELDS)
+    """
+    def __init__(self, model):
+        super(EncoderExport, self).__init__()
+        self.encoder = model.encoder
+        self.decoder = _without(model.decoder, 'embeddings', 'rnn', 'project')
+
+    def forward(self, src, lengths):
+        enc_outs, enc_hidden = self.encoder(src, lengths=lengths)
+        state = self.decoder.init_state(enc_outs, enc_hidden, lengths)
+        return tuple(t for _, t in _state_tensors(state))
+
+
+class DecoderStepExport(nn.Module):
+    """
+    Single decoding step of an RNNDecoder:
+    (prev, *state tensors) -> (out, *state tensors)
+    """
+    def __init__(self, model, fields):
+        super(DecoderStepExport, self).__init__()
+        self.decoder = _without(model.decoder, 'project')
+        self.fields = fields
+
+    def forward(self, prev, *tensors):
+        tensors = dict(zip(self.fields, tensors))
+        hidden = _make_hidden([tensors[f] for f in ('h', 'c') if f in tensors])
+        state = RNNDecoderState(
+            hidden, tensors['context'], input_feed=tensors.get('input_feed'),
+            enc_att=tensors.get('enc_att'), mask=tensors.get('mask'))
+        out, _ = self.decoder(prev, state)
+        return (out,) + tuple(t for _, t in _state_tensors(state))
+
+
+class LMExport(nn.Module):
+    """
+    LM without output projection, traced with two methods so that the
+    (shared) parameters are only serialized once:
+
+        - encode: read a (right-padded) prefix,
+            (inp, lengths) -> (out at the last prefix step, *hidden tensors)
+        - forward: single step, (prev, *hidden tensors) -> (out, *hidden tensors)
+    """
+    def __init__(self, model):
+        super(LMExport, self).__init__()
+        self.model = _without(model, 'project')
+
+    def encode(self, inp, lengths):
+        outs, hidden, _ = self.model(inp, lengths=lengths)
+        return (get_last_token(outs, lengths),) + tuple(_hidden_tensors(hidden))
+
+    def forward(self, prev, *hidden):
+        outs, hidden, _ = self.model(prev.unsqueeze(0), hidden=_make_hidden(list(hidden)))
+        return (outs.squeeze(0),) + tuple(_hidden_tensors(hidden))
+
+
+class ProjectExport(nn.Module):
+    """
+    Output projection: out -> log-probs over the vocabulary
+    """
+    def __init__(self, project):
+        super(ProjectExport, self).__init__()
+        self.project = project
+
+    def forward(self, out):
+        return self.project(out)
+
+
+def dict_to_json(d):
+    """
+    Compact (json-serializable) description of a Dict for decoding.
+    """
+    return {'vocab': d.vocab, 'bos': d.get_bos(), 'eos': d.get_eos(),
+            'pad': d.get_pad(), 'unk': d.get_unk()}
+
+
+def _example_inputs(d, batch, seq_len):
+    lengths = torch.randint(1, seq_len + 1, (batch,), dtype=torch.int64)
+    lengths[0] = seq_len
+    lengths = lengths.sort(descending=True)[0]
+    inp = torch.randint(0, len(d), (seq_len, batch), dtype=torch.int64)
+    return inp, lengths
+
+
+def _trace(module, inputs, **methods):
+    with warnings.catch_warnings():
+        # shape checks on constant parameter sizes (e.g. embedding padding_idx)
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        if methods:
+            methods['forward'] = inputs
+            return torch.jit.trace_module(module, methods, check_trace=False)
+        return torch.jit.trace(module, inputs, check_trace=False)
+
+
+def _check(module, traced, inputs):
+    torch.manual_seed(1001)
+    expected = module(*inputs)
+    torch.manual_seed(1001)
+    output = traced(*inputs)
+    for e, o in zip(expected, output):
+        if e.size() != o.size() or not torch.allclose(e.float(), o.float(), atol=1e-5):
+            raise ValueError("Traced {} doesn't generalize to new input shapes"
+                             .format(getattr(module, '__name__', type(module).__name__)))
+
+
+def export_traced(model, path, example_len=7, example_batch=3):
+    """
+    Export a model to a directory of TorchScript modules, that can be used
+    for decoding without seqmod (see seqmod.runtime):
+
+        - encoder.pt: (inp, lengths) -> state tensors (EncoderDecoder only)
+        - decoder.pt: (prev, *state tensors) -> (out, *state tensors). For
+            LMs it also has an `encode` method taking the role of the encoder:
+            (inp, lengths) -> (out, *state tensors) after reading the prefix
+        - project.pt: out -> log-probs
+        - vocab.json: source ("src", EncoderDecoder only) and target ("trg")
+            vocabularies (see `dict_to_json`)
+        - config.json: model type, state layout and decoding options
+
+    Supported models are LMs without attention or conditions (and cells
+    supporting `lengths`, see LM.forward) and EncoderDecoders with RNN
+    decoders without conditions.
+
+    Parameters:
+    -----------
+    model: LM or EncoderDecoder
+    path: str, output directory (created if needed)
+    example_len, example_batch: int, size of the tracing inputs. The traced
+        modules are checked against the model on inputs of a different size.
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    is_lm = isinstance(model, BaseLM)
+
+    if is_lm:
+        if model.has_attention or getattr(model, 'conds', None) is not None:
+            raise ValueError("Can't export LMs with attention or conditions")
+        src_d = d = model.embeddings.d
+        vocab = {'trg': dict_to_json(d)}
+        project = model.project
+    else:
+        if model.decoder.conditional:
+            raise ValueError("Can't export conditional decoders")
+        src_d, d = model.encoder.embeddings.d, model.decoder.embeddings.d
+        vocab = {'src': dict_to_json(src_d), 'trg': dict_to_json(d)}
+        project = model.decoder.project
+    project = ProjectExport(project)
+
+    inputs = tuple(t.to(device) for t in _example_inputs(src_d, example_batch, example_len))
+    checks = tuple(t.to(device) for t in _example_inputs(src_d, example_batch + 2, example_len + 3))
+
+    with torch.no_grad():
+        if is_lm:
+            step = LMExport(model)
+            out, *state = step.encode(*inputs)
+            fields = ['h', 'c'][:len(state)]
+            prev = inputs[0][0]
+            traced_encoder = None
+            traced_step = _trace(step, (prev,) + tuple(state), encode=inputs)
+            _check(step.encode, traced_step.encode, checks)
+            check_out, *check_state = step.encode(*checks)
+        else:
+            encoder = EncoderExport(model)
+            fields = [f for f, _ in _state_tensors(model.decoder.init_state(
+                *model.encoder(inputs[0], lengths=inputs[1]), inputs[1]))]
+            step = DecoderStepExport(model, fields)
+            state = encoder(*inputs)
+            prev = inputs[0][0]
+            out, *_ = step(prev, *state)
+            traced_encoder = _trace(encoder, inputs)
+            traced_step = _trace(step, (prev,) + tuple(state))
+            _check(encoder, traced_encoder, checks)
+            check_state = encoder(*checks)
+            check_out, *_ = step(checks[0][0], *check_state)
+        traced_project = _trace(project, (out,))
+
+        # check on inputs of different sizes
+        _check(step, traced_step, (checks[0][0],) + tuple(check_state))
+        _check(project, traced_project, (check_out,))
+
+    config = {
+        'model': 'LM' if is_lm else 'EncoderDecoder',
+        'state': [{'name': f, 'batch_dim': _batch_dim(f, t)}
+                  for f, t in zip(fields, state)],
+        'reverse': getattr(model, 'reverse', False),
+        'device': str(device)}
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    if traced_encoder is not None:
+        traced_encoder.save(os.path.join(path, 'encoder.pt'))
+    traced_step.save(os.path.join(path, 'decoder.pt'))
+    traced_project.save(os.path.join(path, 'project.pt'))
+    with open(os.path.join(path, 'vocab.json'), 'w') as f:
+        json.dump(vocab, f)
+    with open(os.path.join(path, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2)
+
+    return path
@@ -1,5 +1,7 @@
 
+import math
 import logging
+import itertools
 
 import numpy as np
 import torch
@@ -7,14 +9,32 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from seqmod.modules.torch_utils import init_hidden_for, repackage_hidden
-from seqmod.modules.torch_utils import swap, select_cols
+from seqmod.modules.torch_utils import swap, select_cols, pad_sequence
+from seqmod.modules.torch_utils import get_last_token
 from seqmod.modules.embedding import Embedding
 from seqmod.modules import rnn
 from seqmod.modules.ff import MaxOut
 from seqmod.modules.softmax import FullSoftmax, MixtureSoftmax, SampledSoftmax
+from seqmod.modules.softmax import AdaptiveSoftmax
 from seqmod.modules.attention import Attention
 from seqmod.misc.beam_search import Beam
 from seqmod.modules.exposure import scheduled_sampling
+from seqmod.modules.prefix_cache import read_cached
+from seqmod import utils as u
+
+from torch.nn.utils.rnn import pack_padded_sequence as pack
+from torch.nn.utils.rnn import pad_packed_sequence as unpack
+
+
+# native (cudnn/aten) rnns, including their dynamically quantized versions
+NATIVE_RNNS = (nn.RNNBase,)
+try:
+    from torch.ao.nn.quantized.dynamic.modules.rnn import RNNBase as QuantizedRNNBase
+    NATIVE_RNNS += (QuantizedRNNBase,)
+except ImportError:  # torch without torch.ao quantization
+    pass
+# cells supporting variable length input in LM.forward
+PACKED_CELLS = NATIVE_RNNS + (rnn.RHN, rnn.RHNCoupled)
 
 
 def strip_post_eos(sents, eos):
@@ -32,24 +52,66 @@ def strip_post_eos(sents, eos):
     return out
 
 
-def read_batch(m, seed_texts, device='cpu', **kwargs):
+def read_batch(m, seed_texts, device='cpu', att_cache=None, prefix_cache=None,
+               **kwargs):
     """
-    Computes the hidden states for a bunch of seeds in iterative fashion.
-    This is currently being done so because LM doesn't use padding and
-    input seeds might have different sizes (in the future this will have
-    to be implemented using pack_padded_sequence which allows for variable
-    length inputs)
+    Computes the hidden states for a bunch of seeds. Seeds are encoded in a
+    single padded forward pass (with packed sequences for torch.nn cells)
+    gathering the last hidden state of each seed. Attentional models and
+    cells that don't support variable length input fall back to reading
+    each seed separately.
 
     Parameters:
     -----------
     seed_texts: list of lists of ints
+    att_cache: (optional) dict, if given, it will be filled with the merged
+        attention caches of the seeds (see AttentionalProjection).
+    prefix_cache: (optional) seqmod.modules.prefix_cache.PrefixCache, if
+        given, seeds are read resuming from their longest cached prefix.
 
     Returns:
     --------
     prev: torch.LongTensor (1 x batch_size), sampled symbols in the batch
     hidden: torch.FloatTensor (num_layers x batch_size x hid_dim)
     """
-    prev, hs, cs = [], [], []
+    if m.has_attention or not isinstance(m.rnn, PACKED_CELLS):
+        return read_batch_iterative(
+            m, seed_texts, device=device, att_cache=att_cache, **kwargs)
+
+    # split last (which will be returned as first input for the generation)
+    prev = torch.tensor([seed_text[-1] for seed_text in seed_texts]).unsqueeze(0)
+
+    if prefix_cache is not None:
+        hidden, _ = read_cached(m, seed_texts, cache=prefix_cache, score=False)
+        return prev, hidden
+
+    seed_texts = [torch.tensor(seed_text[:-1]) for seed_text in seed_texts]
+    # sort by length as required by packed sequences
+    lengths = torch.tensor([len(seed_text) for seed_text in seed_texts])
+    if lengths.min().item() == 0:
+        raise ValueError("Seed texts need at least 2 symbols")
+    lengths, sort = torch.sort(lengths, descending=True)
+    _, unsort = sort.sort()
+    inp, _ = pad_sequence([seed_texts[i] for i in sort.tolist()])
+    # run the RNN (seq_len x batch_size)
+    inp, lengths = inp.t().contiguous().to(device), lengths.to(device)
+    _, hidden, _ = m(inp, lengths=lengths, **kwargs)
+    # unsort
+    unsort = unsort.to(device)
+    if m.cell.startswith('LSTM'):
+        hidden = hidden[0][:, unsort], hidden[1][:, unsort]
+    else:
+        hidden = hidden[:, unsort]
+
+    return prev, hidden
+
+
+def read_batch_iterative(m, seed_texts, device='cpu', att_cache=None, **kwargs):
+    """
+    Computes the hidden states for a bunch of seeds in iterative fashion
+    (see read_batch).
+    """
+    prev, hs, cs, caches = [], [], [], []
 
     for seed_text in seed_texts:
         # split last (which will be returned as first input for the generation)
@@ -58,7 +120,9 @@ def read_batch(m, seed_texts, device='cpu', **kwargs):
         prev.append(prev_i)
         # run the RNN
         inp = torch.tensor(seed_text).unsqueeze(1).to(device)
-        _, hidden, _ = m(inp, **kwargs)
+        cache = {} if att_cache is not None else None
+        _, hidden, _ = m(inp, att_cache=cache, **kwargs)
+        caches.append(cache)
         # accumulate hidden states
         if m.cell.startswith('LSTM'):
             h, c = hidden
@@ -67,6 +131,8 @@ def read_batch(m, seed_texts, device='cpu', **kwargs):
             hs.append(hidden)
     # pack output
     prev = torch.tensor(prev).unsqueeze(0)
+    if att_cache is not None:
+        att_cache.update(AttentionalProjection.merge_caches(caches))
     if m.cell.startswith('LSTM'):
         return prev, (torch.cat(hs, 1), torch.cat(cs, 1))
     else:
@@ -83,12 +149,30 @@ class Generator(object):
     model: LM, fitted LM model to use for generation.
     d: Dict, dictionary fitted on the LM's input vocabulary.
     device: str, where to run the generation
+    shortlist: (optional) seqmod.modules.shortlist.Shortlist used to restrict
+        the output projection to a candidate set computed from the seed texts
+    prefix_cache: (optional) seqmod.modules.prefix_cache.PrefixCache used to
+        resume reading the seed texts from previously seen prefixes
     """
-    def __init__(self, model, d, device='cpu'):
+    def __init__(self, model, d, device='cpu', shortlist=None,
+                 prefix_cache=None):
         self.device = device
         self.model = model
         self.d = d
         self.bos, self.eos = self.d.get_bos(), self.d.get_eos()
+        self.shortlist = shortlist
+        self.prefix_cache = prefix_cache
+
+    def _candidates(self, seed_texts):
+        """
+        Compute the shortlist candidates (if any) for the given seed texts
+        """
+        if self.shortlist is None:
+            return None
+
+        seed_texts = [[self.d.index(i) for i in s] for s in seed_texts or []]
+
+        return self.shortlist(seed_texts, device=self.device)
 
     def _seed(self, seed_texts, batch_size, bos, eos, **kwargs):
         """
@@ -124,8 +208,12 @@ class Generator(object):
         prev: (1 x batch_size), first integer token to feed into the generator
         hidden: hidden state to seed the generator, may be None if no seed text
             was passed to the generation function.
+
+        For attentional models, `self.att_cache` is (re)initialized so that
+        each generation step only attends incrementally.
         """
         hidden = None
+        self.att_cache = {} if self.model.has_attention else None
 
         if seed_texts is not None:  # read input seed batch
             seed_texts = [[self.d.index(i) for i in s] for s in seed_texts]
@@ -138,11 +226,16 @@ class Generator(object):
 
             # read batch
             prev, hidden = read_batch(
-                self.model, seed_texts, device=self.device, **kwargs)
+                self.model, seed_texts, device=self.device,
+                att_cache=self.att_cache, prefix_cache=self.prefix_cache,
+                **kwargs)
 
             # extend to batch size if only single seed
             if len(seed_texts) == 1:
                 prev = prev.repeat(1, batch_size)
+                AttentionalProjection.index_cache(
+                    self.att_cache,
+                    torch.zeros(batch_size, dtype=torch.int64, device=self.device))
                 if self.model.cell.startswith('LSTM'):
                     hidden = (hidden[0].repeat(1, batch_size, 1),
                               hidden[1].repeat(1, batch_size, 1))
@@ -166,18 +259,22 @@ class Generator(object):
         in the output distribution at each generation step.
         """
         prev, hidden = self._seed(seed_texts, batch_size, bos, eos)
+        ids = self._candidates(seed_texts)
         hyps, scores = [], 0
         mask = torch.ones(batch_size).long()
 
         for _ in range(max_seq_len):
-            outs, hidden, _ = self.model(prev, hidden=hidden, **kwargs)
-            outs = self.model.project(outs)
+            outs, hidden, _ = self.model(
+                prev, hidden=hidden, att_cache=self.att_cache, **kwargs)
+            outs = self.model.project(outs, shortlist=ids)
             score, prev = outs.max(1)
-            score, prev = score.squeeze(), prev.t()
-            hyps.append(prev.squeeze().tolist())
+            if ids is not None:
+                prev = ids[prev]
+            prev = prev.unsqueeze(0)
+            hyps.append(prev.squeeze(0).tolist())
 
             if self.eos is not None and not ignore_eos:
-                mask = mask * (prev.squeeze().cpu() != self.eos).long()
+                mask = mask * (prev.squeeze(0).cpu() != self.eos).long()
                 if mask.sum() == 0:
                     break
                 # 0-mask scores for finished batch examples
@@ -193,15 +290,20 @@ class Generator(object):
         Approximation to the highest probability output over the generated
         sequence using beam search.
         """
-        prev, hidden = self._seed(seed_texts, 1, bos, eos)
+        # seed a batch of size width (a single seed is broadcasted)
+        prev, hidden = self._seed(seed_texts, width, bos, eos)
+        ids = self._candidates(seed_texts)
         eos = self.eos if not ignore_eos else None
-        beam = Beam(width, prev.item(), eos=eos)
+        beam = Beam(width, prev[0, 0].item(), eos=eos)
 
         while beam.active and len(beam) < max_seq_len:
             prev = beam.get_current_state().unsqueeze(0)
-            outs, hidden, _ = self.model(prev, hidden=hidden, **kwargs)
-            outs = self.model.project(outs)
-            beam.advance(outs.detach())
+            outs, hidden, _ = self.model(
+                prev, hidden=hidden, att_cache=self.att_cache, **kwargs)
+            outs = self.model.project(outs, shortlist=ids)
+            beam.advance(outs.detach(), index=ids)
+            AttentionalProjection.index_cache(
+                self.att_cache, beam.get_source_beam())
 
             if self.model.cell.startswith('LSTM'):
                 hidden = (swap(hidden[0], 1, beam.get_source_beam()),
@@ -224,18 +326,22 @@ class Generator(object):
         prev, hidden = self._seed(
             seed_texts, batch_size, bos, eos, temperature=temperature)
         batch_size = prev.size(1)  # not equal to input if seed_texts
+        ids = self._candidates(seed_texts)
         hyps, scores = [], 0
         mask = torch.zeros(batch_size).long() + 1
 
         for _ in range(max_seq_len):
-            outs, hidden, _ = self.model(prev, hidden=hidden, **kwargs)
-            outs = self.model.project(outs)
+            outs, hidden, _ = self.model(
+                prev, hidden=hidden, att_cache=self.att_cache, **kwargs)
+            outs = self.model.project(outs, shortlist=ids)
             prev = outs.div_(temperature).exp().multinomial(1).t()
-            score = select_cols(outs.cpu(), prev.squeeze().cpu())
-            hyps.append(prev.squeeze().tolist())
+            score = select_cols(outs.cpu(), prev.squeeze(0).cpu())
+            if ids is not None:
+                prev = ids[prev]
+            hyps.append(prev.squeeze(0).tolist())
 
             if self.eos is not None and not ignore_eos:
-                mask = mask * (prev.squeeze().cpu() != self.eos).long()
+                mask = mask * (prev.squeeze(0).cpu() != self.eos).long()
                 if mask.sum() == 0:
                     break
                 score[mask == 0] = 0  # 0-mask scores for finished examples
@@ -253,24 +359,100 @@ class AttentionalProjection(nn.Module):
         self.hid2hid = nn.Linear(hid_dim, hid_dim)
         self.emb2hid = nn.Linear(emb_dim, hid_dim)
 
-    def forward(self, outs, emb):
+    def forward(self, outs, emb, cache=None):
         """
-        Runs attention for a given input sequence
+        Runs attention for a given input sequence. The output at step t
+        attends over the embeddings up to t-2 (at least one) using the
+        RNN output at step t-1 as query (same query at t=0). All steps are
+        computed at once using a causal mask.
+
+        Parameters:
+        -----------
+        outs: torch.Tensor (seq_len x batch_size x hid_dim)
+        emb: torch.Tensor (seq_len x batch_size x emb_dim)
+        cache: (optional) dict, incremental mode. It holds the embeddings, their
+            projection onto the attention space and the last output of previous
+            calls, so that `outs` and `emb` continue the cached sequence. The
+            cache is updated in place. Start with an empty dict.
 
         Returns: output, weights
         --------
         output: torch.Tensor (seq_len x batch_size x hid_dim)
         weights: list of torch.Tensor(batch_size x 0:t-1) of length seq_len
         """
+        seq_len, batch, _ = outs.size()
         emb_att = self.attn.scorer.project_enc_outs(emb)
-        output, weights = [], []
-        for idx, hid in enumerate(outs):
-            t = max(0, idx-1)  # use same hid at t=0
-            context, weight = self.attn(
-                outs[t], emb[:max(1, t)], enc_att=emb_att[:max(1, t)])
-            output.append(self.hid2hid(hid) + self.emb2hid(context))
-            weights.append(weight)
-        return torch.stack(output), weights
+
+        if cache:
+            offset, pad = cache['emb'].size(0), cache['pad']
+            emb = torch.cat([cache['emb'], emb])
+            emb_att = torch.cat([cache['emb_att'], emb_att])
+            query = torch.cat([cache['out'], outs[:-1]])
+        else:
+            offset = 0
+            pad = torch.zeros(batch, dtype=torch.int64, device=outs.device)
+            query = torch.cat([outs[:1], outs[:-1]])
+
+        if cache is not None:
+            cache.update(emb=emb, emb_att=emb_att, out=outs[-1:], pad=pad)
+
+        # number of visible keys at each step (seq_len x batch); entries that
+        # are left-padded in the cache start at their padding offset
+        steps = torch.arange(offset, offset + seq_len, device=outs.device)
+        n_keys = torch.max((steps - 1).unsqueeze(1), (pad + 1).unsqueeze(0))
+        max_keys = n_keys.max().item()
+        emb, emb_att = emb[:max_keys], emb_att[:max_keys]
+
+        # (seq_len x batch x max_keys)
+        keys = torch.arange(0, max_keys, dtype=torch.int64, device=outs.device)
+        mask = keys.view(1, 1, -1).lt(n_keys.unsqueeze(2)) & \
+            keys.view(1, 1, -1).ge(pad.view(1, -1, 1))
+        weights = self.attn.scorer(query, emb, enc_att=emb_att)
+        weights.masked_fill_(~mask, -float('inf'))
+        weights = F.softmax(weights, dim=2)
+
+        # (batch x seq_len x max_keys) * (batch x max_keys x emb_dim)
+        # => (seq_len x batch x emb_dim)
+        context = torch.bmm(weights.transpose(0, 1), emb.transpose(0, 1))
+        context = context.transpose(0, 1)
+        context = F.tanh(self.attn.linear_out(torch.cat([context, query], 2)))
+        output = self.hid2hid(outs) + self.emb2hid(context)
+
+        n_keys = n_keys.max(1)[0].tolist()
+        weights = [weights[t, :, :n_keys[t]] for t in range(seq_len)]
+
+        return output, weights
+
+    @staticmethod
+    def index_cache(cache, index):
+        """
+        Select (e.g. broadcast or reorder along the beam) entries in the batch
+        of an attention cache in place.
+        """
+        if not cache:
+            return
+        for key in ('emb', 'emb_att', 'out'):
+            cache[key] = cache[key].index_select(1, index)
+        cache['pad'] = cache['pad'].index_select(0, index)
+
+    @staticmethod
+    def merge_caches(caches):
+        """
+        Merge attention caches of different length (batch-size 1) left-padding
+        the shorter ones.
+        """
+        lengths = [cache['emb'].size(0) for cache in caches]
+        maxlen, merged = max(lengths), {}
+        for key in ('emb', 'emb_att'):
+            merged[key] = torch.cat([
+                F.pad(cache[key], (0, 0, 0, 0, maxlen - length, 0))
+                for cache, length in zip(caches, lengths)], 1)
+        merged['out'] = torch.cat([cache['out'] for cache in caches], 1)
+        merged['pad'] = torch.cat([
+            cache['pad'] + maxlen - length
+            for cache, length in zip(caches, lengths)])
+
+        return merged
 
 
 class BaseLM(nn.Module):
@@ -314,7 +496,7 @@ class BaseLM(nn.Module):
     def generate(self, d, conds=None, seed_texts=None, max_seq_len=25,
                  device='cpu', method='sample', temperature=1., width=5,
                  bos=False, eos=False, ignore_eos=False, batch_size=10,
-                 **kwargs):
+                 shortlist=None, prefix_cache=None, **kwargs):
         """
         Generate text using a specified method (argmax, sample, beam)
 
@@ -342,6 +524,10 @@ class BaseLM(nn.Module):
         ignore_eos: bool, whether to stop generation after hitting <eos> or not
         batch_size: int, number of parallel generations (only used if
             seed_texts is None)
+        shortlist: (optional) seqmod.modules.shortlist.Shortlist, restrict
+            the output vocabulary to a candidate set (see Generator)
+        prefix_cache: (optional) seqmod.modules.prefix_cache.PrefixCache,
+            reuse hidden states of previously read seed prefixes
 
         Returns:
         --------
@@ -359,7 +545,9 @@ class BaseLM(nn.Module):
                      for c in conds]
 
         with torch.no_grad():
-            scores, hyps = getattr(Generator(self, d, device=device), method)(
+            generator = Generator(self, d, device=device, shortlist=shortlist,
+                                  prefix_cache=prefix_cache)
+            scores, hyps = getattr(generator, method)(
                 seed_texts=seed_texts, max_seq_len=max_seq_len, conds=conds,
                 batch_size=batch_size, ignore_eos=ignore_eos, bos=bos, eos=eos,
                 # sample-only
@@ -375,7 +563,7 @@ class BaseLM(nn.Module):
 
         return norm_scores, hyps
 
-    def predict_proba(self, inp, **kwargs):
+    def predict_proba(self, inp, prefix_cache=None, **kwargs):
         """
         Compute the probability assigned by the model to an input sequence.
         In the future this should use pack_padded_sequence to run prediction
@@ -384,6 +572,9 @@ class BaseLM(nn.Module):
         Parameters:
         -----------
         inp: torch.Tensor(seq_len x batch_size)
+        prefix_cache: (optional) seqmod.modules.prefix_cache.PrefixCache, if
+            given, each sequence is scored resuming from its longest cached
+            prefix (see score_sequences)
         kwargs: other model parameters
 
         Returns:
@@ -393,23 +584,130 @@ class BaseLM(nn.Module):
         if self.training:
             logging.warn("Generating in training mode!")
 
+        if prefix_cache is not None:
+            with torch.no_grad():
+                _, scores = read_cached(
+                    self, inp.t().tolist(), cache=prefix_cache)
+            return np.exp(np.array(scores) / (len(inp) - 1))
+
         inp = inp.to(device=self.device())
 
         # compute output
-        outs, *_ = self(inp, **kwargs)
-        outs = self.project(outs, reshape=True)  # (seq_len x batch x vocab)
-
-        # select
-        outs, index = outs[:-1].cpu().numpy(), inp[1:].cpu().numpy()
-        seq_len, batch = np.ogrid[0:index.shape[0], 0:index.shape[1]]
-        # (batch x seq_len)
-        log_probs = outs.transpose(2, 0, 1)[index, seq_len, batch].T
+        with torch.no_grad():
+            outs, *_ = self(inp, **kwargs)
+            outs = self.project(outs, reshape=True)  # (seq_len x batch x vocab)
+            # select target log-probs on device (seq_len - 1 x batch)
+            log_probs = outs[:-1].gather(2, inp[1:].unsqueeze(2)).squeeze(2)
 
         # normalize by length
-        log_probs = log_probs.sum(1) / log_probs.shape[1]
+        log_probs = log_probs.mean(0).cpu().numpy()
 
         return np.exp(log_probs)
 
+    def score_sequences(self, sequences, batch_size=50, prefix_cache=None,
+                        batch_tokens=None, buffer_size=10000):
+        """
+        Stream the log-probability assigned by the model to each sequence.
+        Sequences are read in packed batches of `batch_size` or, if
+        `batch_tokens` is given, in buffers of `buffer_size` that are sorted
+        by length and read in packed batches of at most `batch_tokens` tokens
+        (including padding). If a `prefix_cache` is given, sequences resume
+        from their longest cached prefix. Cache statistics (e.g. tokens saved)
+        are available through `prefix_cache.stats()`. Sequences with less
+        than 2 symbols have nothing to score and get a `nan` log-probability.
+
+        Parameters:
+        -----------
+        sequences: iterable of lists of ints
+        batch_size: int, number of sequences to read at once
+        prefix_cache: (optional) seqmod.modules.prefix_cache.PrefixCache
+        batch_tokens: (optional) int, maximum number of tokens per batch
+        buffer_size: int, number of sequences to sort by length at once
+            (only used with `batch_tokens`)
+
+        Returns:
+        --------
+        generator over floats, summed log-probability of `seq[1:]` given
+            `seq[0]` for each input sequence in input order
+        """
+        if self.training:
+            logging.warn("Scoring in training mode!")
+
+        sequences = iter(sequences)
+        while True:
+            buf = [list(seq) for seq in itertools.islice(
+                sequences, buffer_size if batch_tokens else batch_size)]
+            if not buf:
+                break
+
+            scores = [math.nan] * len(buf)
+            valid = [idx for idx in range(len(buf)) if len(buf[idx]) > 1]
+            if batch_tokens is None:
+                batches = [valid]
+            else:
+                # length-bucketed batches (sorted, so the last is the longest)
+                batches, batch = [], []
+                for idx in sorted(valid, key=lambda i: len(buf[i])):
+                    if batch and len(buf[idx]) * (len(batch) + 1) > batch_tokens:
+                        batches.append(batch)
+                        batch = []
+                    batch.append(idx)
+                batches.append(batch)
+
+            for batch in batches:
+                if not batch:
+                    continue
+                batch_scores = self._score_batch(
+                    [buf[idx] for idx in batch], prefix_cache)
+                for idx, score in zip(batch, batch_scores):
+                    scores[idx] = score
+
+            yield from scores
+
+    def score_corpus(self, sents, d=None, batch_tokens=4000, buffer_size=10000,
+                     prefix_cache=None):
+        """
+        Stream the log-probability and perplexity of each sentence in a
+        (possibly very large) corpus. Sentences are scored with
+        `score_sequences` in length-bucketed batches of at most `batch_tokens`
+        tokens, so that only a single buffer is held in memory at any time.
+        Sentences with less than 2 symbols (after transformation) get `nan`
+        for both values.
+
+        Parameters:
+        -----------
+        sents: iterable of sentences, lists of ints or, if `d` is given,
+            lists of tokens to be transformed with it (e.g. adding <bos>
+            and <eos> if the Dict was fitted with them)
+        d: (optional) Dict
+        batch_tokens: int, maximum number of tokens per batch
+        buffer_size: int, number of sentences to sort by length at once
+        prefix_cache: (optional) seqmod.modules.prefix_cache.PrefixCache
+
+        Returns:
+        --------
+        generator over tuples (log_prob, ppl) for each input sentence, where
+            `log_prob` is the summed log-probability of `sent[1:]` and `ppl`
+            the corresponding per-token perplexity
+        """
+        if d is not None:
+            sents = d.transform(sents)
+        sents, seqs = itertools.tee(sents)
+
+        scores = self.score_sequences(
+            sents, prefix_cache=prefix_cache,
+            batch_tokens=batch_tokens, buffer_size=buffer_size)
+        for seq, score in zip(seqs, scores):
+            if len(seq) < 2:
+                yield score, math.nan
+            else:
+                yield score, math.exp(-score / (len(seq) - 1))
+
+    def _score_batch(self, seqs, prefix_cache):
+        with torch.no_grad():
+            _, scores = read_cached(self, seqs, cache=prefix_cache)
+        return scores
+
 
 class LM(BaseLM):
     """
@@ -441,19 +739,31 @@ class LM(BaseLM):
         will be inserted after the RNN to match back to the embedding dim
     - mixtures: int, use a mixture of softmaxes in the output (only if the value
         is strictly positive).
+    - adaptive_softmax: bool, use an adaptive softmax in the output layer
+        (useful for large vocabularies).
+    - adaptive_cutoffs: list of ints, cluster cutoffs for the adaptive softmax
+        (see AdaptiveSoftmax).
+    - loss_chunk_size: int, if positive, compute the loss in chunks of the
+        given number of rows without storing the full output log-probs
+        (see FullSoftmax.chunked_loss). With mixtures, it sets the chunk size
+        of the MixtureSoftmax.
     - deepout_layers: int, whether to add deep output after hidden layer and
         before output projection layer. No deep output will be added if
         deepout_layers is 0 or None.
     - deepout_act: str, activation function for the deepout module in camelcase
     - maxouts: int, only used if deepout_act is MaxOut (number of parts to use
         to compose the non-linearity function).
+    - jit: bool, whether custom rnn cells (e.g. NormalizedGRU) should run
+        their time and layer loops as TorchScript compiled functions. Native
+        torch.nn cells already run in a single kernel and ignore it.
     """
     def __init__(self, emb_dim, hid_dim, d, num_layers=1,
                  cell='GRU', bias=True, dropout=0.0, conds=None,
                  word_dropout=0.0, att_dim=0, tie_weights=False, mixtures=0,
                  train_init=False, add_init_jitter=False, sampled_softmax=False,
                  deepout_layers=0, deepout_act='MaxOut', maxouts=2,
-                 exposure_rate=1.0):
+                 exposure_rate=1.0, adaptive_softmax=False,
+                 adaptive_cutoffs=None, loss_chunk_size=0, jit=False):
 
         self.emb_dim = emb_dim
         self.hid_dim = hid_dim
@@ -488,14 +798,18 @@ class LM(BaseLM):
         if self.train_init:
             self.h_0 = nn.Parameter(torch.zeros(self.num_layers, 1, self.hid_dim))
 
+        kwargs = {}
         try:
             cell = getattr(nn, cell)
+            if jit:
+                logging.warn("`jit` is ignored by native cell {}".format(self.cell))
         except AttributeError:  # assume custom rnn cell
             cell = getattr(rnn, cell)
+            kwargs['jit'] = jit
 
         self.rnn = cell(
             rnn_input_size, self.hid_dim,
-            num_layers=num_layers, bias=bias, dropout=dropout)
+            num_layers=num_layers, bias=bias, dropout=dropout, **kwargs)
 
         # (optional) attention
         if att_dim > 0:
@@ -510,17 +824,23 @@ class LM(BaseLM):
         if mixtures > 0:
             self.project = MixtureSoftmax(
                 hid_dim, emb_dim, len(self.embeddings.d),
-                tie_weights=tie_weights, dropout=dropout, mixtures=mixtures)
+                tie_weights=tie_weights, dropout=dropout, mixtures=mixtures,
+                chunk_size=loss_chunk_size)
+        elif adaptive_softmax:
+            self.project = AdaptiveSoftmax(
+                hid_dim, len(self.embeddings.d), cutoffs=adaptive_cutoffs)
         elif sampled_softmax:
             self.project = SampledSoftmax(
                 hid_dim, emb_dim, len(self.embeddings.d), nsampled=8192,
                 tie_weights=tie_weights, dropout=dropout,
-                deepout_layers=deepout_layers, deepout_act=MaxOut, maxouts=maxouts)
+                deepout_layers=deepout_layers, deepout_act=MaxOut, maxouts=maxouts,
+                loss_chunk_size=loss_chunk_size)
         else:
             self.project = FullSoftmax(
                 hid_dim, emb_dim, len(self.embeddings.d),
                 tie_weights=tie_weights, dropout=dropout,
-                deepout_layers=deepout_layers, deepout_act=MaxOut, maxouts=maxouts)
+                deepout_layers=deepout_layers, deepout_act=MaxOut, maxouts=maxouts,
+                loss_chunk_size=loss_chunk_size)
 
         if tie_weights:
             self.project.tie_embedding_weights(self.embeddings)
@@ -530,7 +850,8 @@ class LM(BaseLM):
             inp, 1, self.num_layers, self.hid_dim, self.cell,
             h_0=self.h_0, add_init_jitter=self.add_init_jitter)
 
-    def forward(self, inp, hidden=None, conds=None, **kwargs):
+    def forward(self, inp, hidden=None, conds=None, att_cache=None,
+                lengths=None, **kwargs):
         """
         Parameters:
         -----------
@@ -539,6 +860,11 @@ class LM(BaseLM):
         conds: None or tuple of torch.Tensor (seq_len x batch_size) of length
             equal to the number of model conditions. `conditions` are required
             in case of a CLM.
+        att_cache: None or dict, attention cache for incremental decoding
+            (see AttentionalProjection). Only used by attentional models.
+        lengths: None or torch.LongTensor (batch_size), lengths of the
+            (right-padded) input sorted in descending order. If given, the
+            returned hidden corresponds to the last step of each input.
 
         Returns:
         --------
@@ -562,7 +888,17 @@ class LM(BaseLM):
 
         # RNN
         hidden = hidden if hidden is not None else self.init_hidden_for(emb)
-        outs, hidden = self.rnn(emb, hidden)
+        if lengths is None:
+            outs, hidden = self.rnn(emb, hidden)
+        elif isinstance(self.rnn, NATIVE_RNNS):
+            outs, hidden = self.rnn(pack(emb, lengths.cpu()), hidden)
+            outs, _ = unpack(outs)
+        elif isinstance(self.rnn, PACKED_CELLS):
+            # single-layer recurrence: output at each step is the hidden state
+            outs, _ = self.rnn(emb, hidden)
+            hidden = get_last_token(outs, lengths).unsqueeze(0)
+        else:
+            raise ValueError("`lengths` not supported by cell {}".format(self.cell))
 
         # (dropout after RNN)
         outs = F.dropout(outs, p=self.dropout, training=self.training)
@@ -570,7 +906,7 @@ class LM(BaseLM):
         # (optional attention)
         weights = None
         if self.has_attention:
-            outs, weights = self.attn(outs, emb)
+            outs, weights = self.attn(outs, emb, cache=att_cache)
 
         return outs, hidden, weights
 
@@ -605,10 +941,15 @@ class LM(BaseLM):
             logits, new_targets = self.project(
                 outs, targets=targets.view(-1), normalize=False, reshape=False)
             loss = F.cross_entropy(logits, new_targets, size_average=True)
+        elif isinstance(self.project, (AdaptiveSoftmax, MixtureSoftmax)):
+            loss = -self.project(outs, targets=targets.view(-1)).mean()
+        elif isinstance(self.project, FullSoftmax) and self.project.loss_chunk_size:
+            loss = self.project.chunked_loss(outs, targets) / targets.nelement()
         else:
             loss = F.nll_loss(self.project(outs), targets.view(-1), size_average=True)
 
         if not test:
+            u.mark_phase('forward')
             loss.backward()
 
         return (loss.item(),), source.nelement()
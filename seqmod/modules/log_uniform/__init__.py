@@ -1,4 +1,5 @@
 
+from .sampler import TorchLogUniformSampler
 
 try:
     from .log_uniform import LogUniformSampler
@@ -6,6 +7,6 @@ except ModuleNotFoundError:
     # only error when attempt to use the module
     def LogUniformSampler(*args, **kwargs):
         raise ValueError("Seems like you haven't compiled the `log_uniform` "
-                         "extension. SampledSoftmax relies on it for speed. "
-                         "Please go to /seqmod/modules/log_uniform/ and build "
+                         "extension. Use `TorchLogUniformSampler` instead or "
+                         "go to /seqmod/modules/log_uniform/ and build "
                          "the extension following the indications")
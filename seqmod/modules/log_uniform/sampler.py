@@ -0,0 +1,106 @@
+
+import math
+
+import numpy as np
+import torch
+
+
+class TorchLogUniformSampler(object):
+    """
+    Vectorized (NumPy/PyTorch) version of the Cython `LogUniformSampler`.
+    It follows the same sampling procedure (draw from a log-uniform
+    distribution until `size` unique ids have been found) but draws the
+    candidates in batches instead of one at a time. It only stores the
+    vocabulary size, so it can be pickled along with the model.
+
+    Parameters:
+    -----------
+    N: int, vocabulary size (range of the sampled ids)
+    """
+    def __init__(self, N):
+        self.N = N
+
+    def probability(self, idx):
+        """
+        Probability of the ids in `idx` under the log-uniform distribution
+
+        idx: torch.LongTensor
+        """
+        idx = idx.double()
+        return (torch.log(idx + 2) - torch.log(idx + 1)) / math.log(self.N + 1)
+
+    def expected_count(self, num_tries, idx):
+        """
+        Expected count of the ids in `idx` after `num_tries` draws
+        """
+        return -torch.expm1(num_tries * torch.log1p(-self.probability(idx)))
+
+    def _draw(self, size):
+        x = torch.rand(size, dtype=torch.float64)
+        return (torch.exp(x * math.log(self.N)).round() - 1).long()
+
+    def sample_ids(self, size):
+        """
+        Draw log-uniform samples until `size` unique ids have been found.
+
+        Returns:
+        --------
+        samples: np.array (size), unique ids in order of first occurrence
+        num_tries: int, number of draws needed to find `size` unique ids
+        """
+        if size > self.N:
+            raise ValueError("Can't sample {} unique ids from {}"
+                             .format(size, self.N))
+
+        draws = np.zeros(0, dtype=np.int64)
+        batch = 2 * size
+        while True:
+            draws = np.concatenate([draws, self._draw(batch).numpy()])
+            # positions of the first occurrence of each unique id in the draws
+            first = np.sort(np.unique(draws, return_index=True)[1])
+            if len(first) >= size:
+                break
+            batch *= 2
+
+        return draws[first[:size]], int(first[size - 1]) + 1
+
+    def sample(self, size, labels):
+        """
+        Parameters:
+        -----------
+        size: int, number of unique samples
+        labels: torch.LongTensor or np.array of true labels
+
+        Returns:
+        --------
+        samples: torch.LongTensor (size)
+        true_freq: torch.FloatTensor (len(labels)), expected count of labels
+        sample_freq: torch.FloatTensor (size), expected count of samples
+        """
+        samples, num_tries = self.sample_ids(size)
+        samples = torch.from_numpy(samples)
+        labels = torch.as_tensor(labels).long().cpu().view(-1)
+        true_freq = self.expected_count(num_tries, labels).float()
+        sample_freq = self.expected_count(num_tries, samples).float()
+
+        return samples, true_freq, sample_freq
+
+    def accidental_match(self, labels, samples):
+        """
+        Find sampled ids that are equal to a true label.
+
+        Returns:
+        --------
+        rows, cols: torch.LongTensor, indices into labels and samples
+            respectively for each accidental match (meant to index into the
+            logits matrix of size (len(labels) x len(samples))).
+        """
+        labels = torch.as_tensor(labels).long().cpu().view(-1).numpy()
+        samples = torch.as_tensor(samples).long().cpu().view(-1).numpy()
+        sort = np.argsort(samples)
+        pos = np.searchsorted(samples, labels, sorter=sort)
+        pos = np.minimum(pos, len(samples) - 1)
+        cols = sort[pos]
+        rows = np.nonzero(samples[cols] == labels)[0]
+
+        return torch.from_numpy(rows), torch.from_numpy(cols[rows])
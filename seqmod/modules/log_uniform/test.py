@@ -4,7 +4,12 @@ import math
 import numpy as np
 import torch
 
-from log_uniform import LogUniformSampler
+from sampler import TorchLogUniformSampler
+
+try:
+    from log_uniform import LogUniformSampler
+except ImportError:
+    LogUniformSampler = None
 
 
 def log_uniform_sample(N, size):
@@ -44,13 +49,30 @@ if __name__ == '__main__':
     end_time = time.time()
     print("unique multinomial cuda", end_time - start_time)
 
-    sampler = LogUniformSampler(N)
     labels = np.random.choice(N, batch_size)
 
+    if LogUniformSampler is not None:
+        sampler = LogUniformSampler(N)
+        start_time = time.time()
+        sample_id, true_freq, sample_freq = sampler.sample(num_samples, labels)
+        end_time = time.time()
+        print("unique log_uniform c++", end_time - start_time)
+
+        start_time = time.time()
+        sampler.accidental_match(labels, np.asarray(sample_id))
+        end_time = time.time()
+        print("accidental_match c++", end_time - start_time)
+
+    sampler = TorchLogUniformSampler(N)
     start_time = time.time()
     sample_id, true_freq, sample_freq = sampler.sample(num_samples, labels)
     end_time = time.time()
-    print("unique log_uniform c++", end_time - start_time)
+    print("unique log_uniform torch", end_time - start_time)
+
+    start_time = time.time()
+    sampler.accidental_match(labels, sample_id)
+    end_time = time.time()
+    print("accidental_match torch", end_time - start_time)
 
     """
     sampler = LogUniformSampler()
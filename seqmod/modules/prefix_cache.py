@@ -0,0 +1,253 @@
+
+from collections import OrderedDict
+
+import torch
+
+from seqmod.modules.torch_utils import pad_sequence
+
+
+def _state_nbytes(state):
+    if isinstance(state, tuple):
+        return sum(_state_nbytes(s) for s in state)
+    return state.nelement() * state.element_size()
+
+
+def _cat_states(states):
+    if isinstance(states[0], tuple):
+        return tuple(torch.cat(s, 1) for s in zip(*states))
+    return torch.cat(states, 1)
+
+
+def _clone_state(state):
+    if isinstance(state, tuple):
+        return tuple(s.detach().clone() for s in state)
+    return state.detach().clone()
+
+
+def _split_state(state):
+    if isinstance(state, tuple):
+        return list(zip(*[s.split(1, dim=1) for s in state]))
+    return list(state.split(1, dim=1))
+
+
+def _read_unpacked(m, inp, states, lengths):
+    """
+    Read each sequence in a padded batch on its own, for cells that don't
+    support variable length input (see LM.forward).
+    """
+    outs, hidden = [], []
+    for idx, (state, length) in enumerate(zip(states, lengths)):
+        out, state, _ = m(inp[:length, idx:idx+1], hidden=state)
+        outs.append(torch.cat(
+            [out, out.new_zeros(len(inp) - length, *out.size()[1:])]))
+        hidden.append(state)
+
+    return torch.cat(outs, 1), _cat_states(hidden)
+
+
+class _Node(object):
+    __slots__ = ('children', 'state', 'score', 'parent', 'token')
+
+    def __init__(self, parent=None, token=None):
+        self.children = {}
+        self.state, self.score = None, None
+        self.parent, self.token = parent, token
+
+
+class PrefixCache(object):
+    """
+    Trie-structured cache of LM hidden states keyed by token prefixes, so that
+    sequences sharing a prefix (e.g. candidates to be scored or generation
+    seeds) can resume from the longest cached prefix instead of reading it
+    from scratch. States are cached every `block_size` input tokens and are
+    evicted in least-recently-used order when exceeding the memory budget.
+
+    An entry for the key `tokens[:c+1]` holds the hidden state after reading
+    `tokens[:c]` and (optionally) the summed log-probability of `tokens[1:c+1]`.
+
+    Parameters:
+    -----------
+    block_size: int, number of input tokens between cached states
+    max_bytes: int, memory budget for the cached states
+
+    Attributes:
+    -----------
+    saved_tokens: int, number of input tokens that didn't have to be read
+    hits, misses: int, lookups resolved (or not) from the cache
+    """
+    def __init__(self, block_size=8, max_bytes=2 ** 30):
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.root = _Node()
+        self.entries = OrderedDict()  # node -> nbytes, in LRU order
+        self.nbytes = 0
+        self.saved_tokens, self.hits, self.misses = 0, 0, 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {'entries': len(self), 'nbytes': self.nbytes,
+                'saved_tokens': self.saved_tokens,
+                'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        self.__init__(block_size=self.block_size, max_bytes=self.max_bytes)
+
+    def lookup(self, tokens, needs_score=False):
+        """
+        Find the longest cached key that is a prefix of `tokens`.
+
+        Returns:
+        --------
+        consumed: int, number of input tokens covered by the state (0 if none)
+        state: cached hidden state (or None)
+        score: float, summed log-prob of `tokens[1:consumed+1]` (or None)
+        """
+        node, best, best_len = self.root, None, 0
+        for idx, token in enumerate(tokens):
+            node = node.children.get(token)
+            if node is None:
+                break
+            if node.state is not None and (not needs_score or node.score is not None):
+                best, best_len = node, idx + 1
+
+        if best is None:
+            self.misses += 1
+            return 0, None, None
+
+        self.hits += 1
+        self.entries.move_to_end(best)
+        self.saved_tokens += best_len - 1
+
+        return best_len - 1, best.state, best.score
+
+    def insert(self, tokens, state, score=None):
+        """
+        Cache the hidden state after reading `tokens[:-1]` under `tokens`.
+        """
+        node = self.root
+        for token in tokens:
+            child = node.children.get(token)
+            if child is None:
+                child = node.children[token] = _Node(parent=node, token=token)
+            node = child
+
+        if node.state is not None:
+            self.entries.move_to_end(node)
+            if score is not None:
+                node.score = score
+            return
+
+        nbytes = _state_nbytes(state)
+        if nbytes > self.max_bytes:
+            return
+
+        # clone to avoid holding on to the storage of the whole batch
+        node.state, node.score = _clone_state(state), score
+        self.entries[node] = nbytes
+        self.nbytes += nbytes
+
+        while self.nbytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        node, nbytes = self.entries.popitem(last=False)
+        self.nbytes -= nbytes
+        node.state, node.score = None, None
+        # prune dangling branches
+        while node.parent is not None and not node.children and node.state is None:
+            del node.parent.children[node.token]
+            node = node.parent
+
+
+def read_cached(m, seqs, cache=None, score=True):
+    """
+    Read sequences with a LM resuming from the longest prefix stored in a
+    PrefixCache and populating the cache along the way. Sequences are read
+    in packed batches of `cache.block_size` input tokens (or in a single
+    packed batch if no cache is given).
+
+    Cells without variable length support (see LM.forward) read the
+    sequences in a block one at a time.
+
+    Parameters:
+    -----------
+    m: LM
+    seqs: list of lists of ints, the input to the model is `seq[:-1]`
+        and the targets are `seq[1:]`
+    cache: PrefixCache or None
+    score: bool, whether to compute the log-probability of the targets
+
+    Returns:
+    --------
+    hidden: hidden state after reading `seq[:-1]` (num_layers x batch x hid_dim)
+    scores: list of floats (or None), summed log-prob of `seq[1:]`
+    """
+    if cache is not None and m.has_attention:
+        raise ValueError("PrefixCache doesn't support attentional models")
+    if cache is not None and getattr(m, 'conds', None) is not None:
+        raise ValueError("PrefixCache doesn't support conditional models")
+
+    from seqmod.modules.lm import PACKED_CELLS  # avoid circular import
+    packed = isinstance(m.rnn, PACKED_CELLS)
+
+    device = m.device()
+    lengths = [len(seq) - 1 for seq in seqs]
+    if min(lengths) == 0:
+        raise ValueError("Sequences need at least 2 symbols")
+    block_size = cache.block_size if cache is not None else max(lengths)
+
+    pos, states, scores = [0] * len(seqs), [None] * len(seqs), [0.0] * len(seqs)
+    if cache is not None:
+        for b, seq in enumerate(seqs):
+            consumed, state, seq_score = cache.lookup(seq, needs_score=score)
+            if state is not None:
+                pos[b], states[b], scores[b] = consumed, state, seq_score
+
+    init = m.init_hidden_for(torch.zeros(1, 1, 1, device=device))
+    states = [init if state is None else state for state in states]
+
+    while True:
+        active = [b for b in range(len(seqs)) if pos[b] < lengths[b]]
+        if not active:
+            break
+        # sort by segment length as required by packed sequences
+        seg_lengths = [min(block_size, lengths[b] - pos[b]) for b in active]
+        active, seg_lengths = zip(*sorted(
+            zip(active, seg_lengths), key=lambda x: x[1], reverse=True))
+        inp, _ = pad_sequence(
+            [torch.tensor(seqs[b][pos[b]:pos[b]+n])
+             for b, n in zip(active, seg_lengths)])
+        inp = inp.t().contiguous().to(device)
+        seg_lengths_t = torch.tensor(seg_lengths, device=device)
+
+        if packed:
+            hidden = _cat_states([states[b] for b in active])
+            outs, hidden, _ = m(inp, hidden=hidden, lengths=seg_lengths_t)
+        else:
+            outs, hidden = _read_unpacked(
+                m, inp, [states[b] for b in active], seg_lengths)
+
+        if score:
+            targets, _ = pad_sequence(
+                [torch.tensor(seqs[b][pos[b]+1:pos[b]+n+1])
+                 for b, n in zip(active, seg_lengths)])
+            targets = targets.t().contiguous().to(device)
+            # (seg_len x batch)
+            logprobs = m.project(outs, reshape=True)
+            logprobs = logprobs.gather(2, targets.unsqueeze(2)).squeeze(2)
+            mask = torch.arange(0, len(inp), device=device).unsqueeze(1) \
+                        .lt(seg_lengths_t.unsqueeze(0))
+            logprobs = (logprobs * mask.float()).sum(0).tolist()
+
+        states_ = _split_state(hidden)
+        for idx, (b, n) in enumerate(zip(active, seg_lengths)):
+            states[b], pos[b] = states_[idx], pos[b] + n
+            if score:
+                scores[b] += logprobs[idx]
+            if cache is not None and n == block_size:  # block boundary
+                cache.insert(seqs[b][:pos[b]+1], states[b],
+                             score=scores[b] if score else None)
+
+    return _cat_states(states), (scores if score else None)
@@ -0,0 +1,63 @@
+
+import io
+import copy
+
+import torch
+import torch.nn as nn
+
+from seqmod.modules import rnn
+from seqmod.modules.softmax import FullSoftmax
+
+
+# modules with dynamically quantized counterparts
+QUANTIZABLE = (nn.Linear, nn.LSTM, nn.GRU, nn.LSTMCell, nn.GRUCell)
+
+
+def quantize_dynamic(model, dtype=torch.qint8, modules=QUANTIZABLE, inplace=False):
+    """
+    Dynamic (weight-only, activations are quantized on the fly) quantization
+    of a model for CPU inference. All rnn, linear and output projection
+    (`output_emb`) layers are quantized, embeddings are kept in float. Tied
+    output projections get their own quantized copy of the embedding matrix,
+    so the input embeddings aren't affected.
+
+    The quantized model supports the inference paths of LM (Generator,
+    scoring) and EncoderDecoder (translate, translate_beam), but can't be
+    trained.
+
+    Parameters:
+    -----------
+    model: torch.nn.Module, e.g. LM or EncoderDecoder
+    dtype: torch.qint8 or torch.float16
+    modules: tuple of module classes to quantize (see QUANTIZABLE)
+    inplace: bool, whether to quantize the input model instead of a copy
+
+    Returns:
+    --------
+    model: quantized model (on cpu and in eval mode)
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.cpu().eval()
+
+    for m in model.modules():
+        # code paths reading float parameters directly from quantized modules
+        if isinstance(m, rnn.BaseStackedRNN):
+            m.jit = False
+        elif isinstance(m, (rnn._RHN, rnn._RHNCoupled)):
+            m.fused = False
+        elif isinstance(m, FullSoftmax):
+            m.loss_chunk_size = 0
+
+    return torch.quantization.quantize_dynamic(
+        model, set(modules), dtype=dtype, inplace=True)
+
+
+def model_bytes(model):
+    """
+    Size in bytes of the serialized model parameters (shared parameters,
+    e.g. tied weights, are only counted once).
+    """
+    f = io.BytesIO()
+    torch.save(model.state_dict(), f)
+    return f.tell()
@@ -1,4 +1,6 @@
 
+import logging
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -6,17 +8,179 @@ import torch.nn.functional as F
 from seqmod.modules.torch_utils import make_dropout_mask
 
 
+def _layer_dropout(inp, dropout_mask, dropout, training):
+    # type: (Tensor, Optional[Tensor], float, bool) -> Tensor
+    if dropout_mask is not None and training:
+        return inp * dropout_mask
+    return F.dropout(inp, p=dropout, training=training)
+
+
+def stacked_lstm_step(inp, h_0, c_0, w_ih, w_hh, b_ih, b_hh,
+                      dropout_mask, dropout, training):
+    # type: (Tensor, Tensor, Tensor, List[Tensor], List[Tensor], List[Optional[Tensor]], List[Optional[Tensor]], Optional[Tensor], float, bool) -> Tuple[Tensor, Tensor, Tensor]
+    """
+    Single step of a stack of LSTM cells (see StackedLSTM.forward).
+
+    Parameters:
+    -----------
+    inp: (batch x in_dim)
+    h_0, c_0: (num_layers x batch x hid_dim)
+    w_ih, w_hh, b_ih, b_hh: lists of per-layer LSTMCell parameters
+    """
+    num_layers = len(w_ih)
+    h_1, c_1 = [], []
+    for i in range(num_layers):
+        h_1_i, c_1_i = torch.lstm_cell(
+            inp, [h_0[i], c_0[i]], w_ih[i], w_hh[i], b_ih[i], b_hh[i])
+        inp = h_1_i
+        # dropout on all but last layer
+        if i + 1 != num_layers:
+            inp = _layer_dropout(inp, dropout_mask, dropout, training)
+        h_1.append(h_1_i)
+        c_1.append(c_1_i)
+
+    return inp, torch.stack(h_1), torch.stack(c_1)
+
+
+def stacked_gru_step(inp, h_0, w_ih, w_hh, b_ih, b_hh,
+                     dropout_mask, dropout, training):
+    # type: (Tensor, Tensor, List[Tensor], List[Tensor], List[Optional[Tensor]], List[Optional[Tensor]], Optional[Tensor], float, bool) -> Tuple[Tensor, Tensor]
+    """
+    Single step of a stack of GRU cells (see StackedGRU.forward).
+    """
+    num_layers = len(w_ih)
+    h_1 = []
+    for i in range(num_layers):
+        h_1_i = torch.gru_cell(inp, h_0[i], w_ih[i], w_hh[i], b_ih[i], b_hh[i])
+        inp = h_1_i
+        # dropout on all but last layer
+        if i + 1 != num_layers:
+            inp = _layer_dropout(inp, dropout_mask, dropout, training)
+        h_1.append(h_1_i)
+
+    return inp, torch.stack(h_1)
+
+
+def _layer_norm(x, g, bias, normalize_std, eps):
+    # type: (Tensor, Tensor, Optional[Tensor], bool, float) -> Tensor
+    x = x - x.mean(1, keepdim=True)
+    if normalize_std:
+        x = x / (x.std(1, keepdim=True) + eps)
+    x = g * x
+    if bias is not None:
+        x = x + bias
+    return x
+
+
+def _narrow(t, start, length):
+    # type: (Optional[Tensor], int, int) -> Optional[Tensor]
+    if t is None:
+        return t
+    return t.narrow(0, start, length)
+
+
+def normalized_gru_cell(x, h, w_ih, w_hh, b_ih, b_hh, gamma_ih, gamma_hh, eps):
+    # type: (Tensor, Tensor, Tensor, Tensor, Optional[Tensor], Optional[Tensor], Tensor, Tensor, float) -> Tensor
+    """
+    Layer-normalized GRU cell (see NormalizedGRUCell.forward) computing
+    the input and hidden projections for all gates with one matmul each.
+    """
+    hid_dim = h.size(1)
+    ih, hh = torch.mm(x, w_ih.t()), torch.mm(h, w_hh.t())
+    # gates (reset, update) and projection are normalized separately
+    ih_rz = _layer_norm(ih.narrow(1, 0, 2 * hid_dim), gamma_ih.narrow(0, 0, 2 * hid_dim),
+                        _narrow(b_ih, 0, 2 * hid_dim), True, eps)
+    hh_rz = _layer_norm(hh.narrow(1, 0, 2 * hid_dim), gamma_hh.narrow(0, 0, 2 * hid_dim),
+                        _narrow(b_hh, 0, 2 * hid_dim), False, eps)
+    ih_n = _layer_norm(ih.narrow(1, 2 * hid_dim, hid_dim),
+                       gamma_ih.narrow(0, 2 * hid_dim, hid_dim),
+                       _narrow(b_ih, 2 * hid_dim, hid_dim), True, eps)
+    hh_n = _layer_norm(hh.narrow(1, 2 * hid_dim, hid_dim),
+                       gamma_hh.narrow(0, 2 * hid_dim, hid_dim),
+                       _narrow(b_hh, 2 * hid_dim, hid_dim), False, eps)
+
+    r, z = torch.sigmoid(ih_rz + hh_rz).chunk(2, 1)
+    n = torch.tanh(ih_n + r * hh_n)
+    return (1 - z) * n + z * h
+
+
+def stacked_normalized_gru_step(inp, h_0, w_ih, w_hh, b_ih, b_hh,
+                                gamma_ih, gamma_hh, eps,
+                                dropout_mask, dropout, training):
+    # type: (Tensor, Tensor, List[Tensor], List[Tensor], List[Optional[Tensor]], List[Optional[Tensor]], List[Tensor], List[Tensor], float, Optional[Tensor], float, bool) -> Tuple[Tensor, Tensor]
+    """
+    Single step of a stack of NormalizedGRUCells
+    (see StackedNormalizedGRU.forward).
+    """
+    num_layers = len(w_ih)
+    h_1 = []
+    for i in range(num_layers):
+        h_1_i = normalized_gru_cell(inp, h_0[i], w_ih[i], w_hh[i], b_ih[i], b_hh[i],
+                                    gamma_ih[i], gamma_hh[i], eps)
+        inp = h_1_i
+        # dropout on all but last layer
+        if i + 1 != num_layers:
+            inp = _layer_dropout(inp, dropout_mask, dropout, training)
+        h_1.append(h_1_i)
+
+    return inp, torch.stack(h_1)
+
+
+def normalized_gru_recurrence(xs, h_0, w_ih, w_hh, b_ih, b_hh,
+                              gamma_ih, gamma_hh, eps, dropout, training):
+    # type: (Tensor, Tensor, List[Tensor], List[Tensor], List[Optional[Tensor]], List[Optional[Tensor]], List[Tensor], List[Tensor], float, float, bool) -> Tuple[Tensor, Tensor]
+    """
+    Time loop of NormalizedGRU (see NormalizedGRU.forward).
+
+    Parameters:
+    -----------
+    xs: (seq_len x batch x in_dim)
+    h_0: (num_layers x batch x hid_dim)
+    """
+    outputs, h_t = [], h_0
+    for t in range(xs.size(0)):
+        output, h_t = stacked_normalized_gru_step(
+            xs[t], h_t, w_ih, w_hh, b_ih, b_hh, gamma_ih, gamma_hh, eps,
+            None, dropout, training)
+        outputs.append(output)
+    return torch.stack(outputs), h_t
+
+
+_SCRIPTED = {}
+
+
+def get_scripted(func, jit=True):
+    """
+    Get the TorchScript compiled version of `func` (compiled once and
+    cached). Falls back to `func` if `jit` is False or compilation fails.
+    """
+    if not jit:
+        return func
+    if func.__name__ not in _SCRIPTED:
+        try:
+            _SCRIPTED[func.__name__] = torch.jit.script(func)
+        except Exception as e:
+            logging.warn("Couldn't compile {}: {}".format(func.__name__, e))
+            _SCRIPTED[func.__name__] = func
+    return _SCRIPTED[func.__name__]
+
+
 class BaseStackedRNN(nn.Module):
     def __init__(self, cell, num_layers, in_dim, hid_dim,
-                 dropout=0.0, **kwargs):
+                 dropout=0.0, jit=False, **kwargs):
         """
         cell: str or custom cell class
+        jit: bool, whether to run the loop over layers as a TorchScript
+            compiled function (see `stacked_lstm_step`, `stacked_gru_step`).
+            Parameters are shared with the per-layer cells, so checkpoints
+            are compatible across both modes.
         """
         super(BaseStackedRNN, self).__init__()
         self.in_dim = in_dim
         self.hid_dim = hid_dim
         self.dropout = dropout
         self.num_layers = num_layers
+        self.jit = jit
         self.layers = nn.ModuleList()
 
         if isinstance(cell, str):
@@ -25,6 +189,16 @@ class BaseStackedRNN(nn.Module):
             self.layers.append(cell(in_dim, hid_dim, **kwargs))
             in_dim = hid_dim
 
+    def _weights(self):
+        """
+        Per-layer cell parameters as lists (w_ih, w_hh, b_ih, b_hh). Biases
+        are None for cells without bias.
+        """
+        return ([layer.weight_ih for layer in self.layers],
+                [layer.weight_hh for layer in self.layers],
+                [layer.bias_ih for layer in self.layers],
+                [layer.bias_hh for layer in self.layers])
+
     def forward(self, inp, hidden, dropout_mask=None):
         """
         Parameters:
@@ -53,6 +227,12 @@ class StackedLSTM(BaseStackedRNN):
 
     def forward(self, inp, hidden, dropout_mask=None):
         h_0, c_0 = hidden
+        if getattr(self, 'jit', False):
+            step = get_scripted(stacked_lstm_step)
+            inp, h_1, c_1 = step(inp, h_0, c_0, *self._weights(),
+                                 dropout_mask, self.dropout, self.training)
+            return inp, (h_1, c_1)
+
         h_1, c_1 = [], []
         for i, layer in enumerate(self.layers):
             h_1_i, c_1_i = layer(inp, (h_0[i], c_0[i]))
@@ -74,6 +254,11 @@ class StackedGRU(BaseStackedRNN):
         super(StackedGRU, self).__init__('GRUCell', *args, **kwargs)
 
     def forward(self, inp, hidden, dropout_mask=None):
+        if getattr(self, 'jit', False):
+            step = get_scripted(stacked_gru_step)
+            return step(inp, hidden, *self._weights(),
+                        dropout_mask, self.dropout, self.training)
+
         h_1 = []
         for i, layer in enumerate(self.layers):
             h_1_i = layer(inp, hidden[i])
@@ -94,7 +279,19 @@ class StackedNormalizedGRU(BaseStackedRNN):
         super(StackedNormalizedGRU, self).__init__(
             NormalizedGRUCell, *args, **kwargs)
 
+    def _weights(self):
+        w_ih, w_hh, b_ih, b_hh = super(StackedNormalizedGRU, self)._weights()
+        return (w_ih, w_hh, b_ih, b_hh,
+                [layer.gamma_ih for layer in self.layers],
+                [layer.gamma_hh for layer in self.layers],
+                float(self.layers[0].eps))
+
     def forward(self, inp, hidden, dropout_mask=None):
+        if getattr(self, 'jit', False):
+            step = get_scripted(stacked_normalized_gru_step)
+            return step(inp, hidden, *self._weights(),
+                        dropout_mask, self.dropout, self.training)
+
         h_1 = []
         for i, layer in enumerate(self.layers):
             h_1_i = layer(inp, hidden[i])
@@ -125,15 +322,15 @@ class NormalizedGRUCell(nn.GRUCell):
         self.eps = 0
 
     def _layer_norm_x(self, x, g, bias=None):
-        mean = x.mean(1).expand_as(x)
-        std = x.std(1).expand_as(x)
+        mean = x.mean(1, keepdim=True).expand_as(x)
+        std = x.std(1, keepdim=True).expand_as(x)
         output = g.expand_as(x) * ((x - mean) / (std + self.eps))
         if bias is not None:
             output += bias.expand_as(x)
         return output
 
     def _layer_norm_h(self, x, g, bias=None):
-        mean = x.mean(1).expand_as(x)
+        mean = x.mean(1, keepdim=True).expand_as(x)
         output = g.expand_as(x) * (x - mean)
         if bias is not None:
             output += bias.expand_as(x)
@@ -195,17 +392,22 @@ class NormalizedGRUCell(nn.GRUCell):
 
 class NormalizedGRU(StackedNormalizedGRU):
     def __init__(self, input_size, hid_dim, num_layers,
-                 dropout=0.0, bias=True, **kwargs):
+                 dropout=0.0, bias=True, jit=False, **kwargs):
         if 'batch_first' in kwargs or 'bidirectional' in kwargs:
             raise NotImplementedError
         super(NormalizedGRU, self).__init__(
-            num_layers, input_size, hid_dim, bias=bias, dropout=dropout)
+            num_layers, input_size, hid_dim, bias=bias, dropout=dropout, jit=jit)
 
     def forward(self, xs, h_0):
         """
         xs: (seq_len x batch x input_size)
         h_0: (num_layers * 1 x batch x hidden_size)
         """
+        if getattr(self, 'jit', False):
+            # time and layer loops run in TorchScript
+            recurrence = get_scripted(normalized_gru_recurrence)
+            return recurrence(xs, h_0, *self._weights(), self.dropout, self.training)
+
         outputs, h_t = [], h_0
         for x_t in xs:
             output, h_t = super(NormalizedGRU, self).forward(x_t, h_t)
@@ -220,7 +422,98 @@ def _custom_rhn_init(module):
                 nn.init.constant(m.bias, -3)
 
 
-class _RHN(nn.Module):
+def rhn_recurrence(inp, hidden, weights, biases, masks, tied, coupled):
+    # type: (Tensor, Tensor, List[Tensor], List[Tensor], Tensor, bool, bool) -> Tuple[Tensor, Tensor]
+    """
+    Fused RHN recurrence with a single matmul for all gates per micro-layer.
+
+    Parameters:
+    -----------
+    inp: (seq_len x batch x gates * hid_dim), projected input for all gates
+    hidden: (batch x hid_dim)
+    weights: list of (hid_dim x gates * hid_dim) if tied else
+        (gates x hid_dim x hid_dim), recurrent weights per micro-layer
+    biases: list of (gates * hid_dim), recurrent biases per micro-layer
+    masks: (batch x hid_dim) if tied else (gates x batch x hid_dim),
+        hidden dropout masks
+    tied: bool, whether all gates share the same dropout mask
+    coupled: bool, whether the carry gate is coupled to the transform gate
+        (gates are H, T) or not (gates are H, T, C)
+    """
+    num_gates = 2 if coupled else 3
+    s = hidden
+    outs = []
+    for t in range(inp.size(0)):
+        for l in range(len(weights)):
+            # the input projection only enters the first micro-layer
+            bias = inp[t] + biases[l] if l == 0 else biases[l]
+            if tied:
+                gates = torch.addmm(bias, s * masks, weights[l])
+            else:
+                gates = torch.bmm(s.unsqueeze(0) * masks, weights[l])
+                gates = gates.transpose(0, 1).reshape(s.size(0), -1) + bias
+            gates = gates.chunk(num_gates, 1)
+            h, tr = torch.tanh(gates[0]), torch.sigmoid(gates[1])
+            if coupled:
+                s = (h - s) * tr + s
+            else:
+                s = h * tr + s * torch.sigmoid(gates[2])
+        outs.append(s)
+
+    return torch.stack(outs), s
+
+
+def get_rhn_recurrence(jit=True):
+    """
+    Get the (TorchScript compiled, if possible) fused RHN recurrence.
+    """
+    return get_scripted(rhn_recurrence, jit=jit)
+
+
+class _FusedRHNMixin(object):
+    """
+    Fused forward pass for RHN cells: the (per-gate) linear transformations
+    are concatenated so that each micro-layer runs a single matmul, dropout
+    masks are applied once per matmul and the time loop runs in TorchScript
+    (see `rhn_recurrence`). The fused weights are computed from the existing
+    per-gate parameters, so checkpoints are shared with the step-wise
+    implementation.
+    """
+    def _gates(self):
+        raise NotImplementedError
+
+    def _fused_forward(self, inp, hidden, in_masks, hid_masks):
+        seq_len, batch_size, _ = inp.size()
+        input_gates, rnn_gates = self._gates()
+        tied = self.tied_noise
+
+        # input projection (seq_len x batch x gates * hid_dim)
+        if tied:
+            weight = torch.cat([m.weight for m in input_gates], 0)
+            bias = torch.cat([m.bias for m in input_gates], 0)
+            proj = F.linear(in_masks[0] * inp, weight, bias)
+        else:
+            proj = torch.cat([m(mask * inp) for m, mask in zip(input_gates, in_masks)], 2)
+
+        # recurrent weights per micro-layer
+        weights, biases = [], []
+        for layer in rnn_gates:
+            if tied:
+                weights.append(torch.cat([m.weight for m in layer], 0).t())
+            else:
+                weights.append(torch.stack([m.weight.t() for m in layer], 0))
+            if layer[0].bias is None:
+                biases.append(inp.new_zeros(len(layer) * self.hid_dim))
+            else:
+                biases.append(torch.cat([m.bias for m in layer], 0))
+        masks = hid_masks[0] if tied else torch.stack(hid_masks, 0)
+
+        recurrence = get_rhn_recurrence(jit=getattr(self, 'jit', True))
+        return recurrence(proj, hidden, weights, biases, masks, tied,
+                          len(input_gates) == 2)
+
+
+class _RHN(_FusedRHNMixin, nn.Module):
     """
     Implementation of the full RHN in which the recurrence is computed as:
         s_l^t = (h_l^t * t_l^t) + (s_{l-1}^t * c_l^t)
@@ -237,16 +530,21 @@ class _RHN(nn.Module):
     tied_noise: bool, whether to use the same mask for all gates
     input_dropout: float, dropout applied to the input layer
     hidden_dropout: float, dropout applied to the recurrent layers
+    fused: bool, whether to use the fused implementation (see _FusedRHNMixin)
+    jit: bool, whether to run the fused time loop with TorchScript
     kwargs: extra arguments to general RNN cells that are ignored by RHN
     """
     def __init__(self, in_dim, hid_dim, num_layers=1, tied_noise=True,
-                 input_dropout=0.75, hidden_dropout=0.25, **kwargs):
+                 input_dropout=0.75, hidden_dropout=0.25, fused=True,
+                 jit=True, **kwargs):
         self.in_dim = in_dim
         self.hid_dim = hid_dim
         self.depth = num_layers
         self.input_dropout = input_dropout
         self.hidden_dropout = hidden_dropout
         self.tied_noise = tied_noise
+        self.fused = fused
+        self.jit = jit
         super(_RHN, self).__init__()
         self.add_module('input_H', nn.Linear(in_dim, hid_dim))
         self.add_module('input_T', nn.Linear(in_dim, hid_dim))
@@ -267,6 +565,11 @@ class _RHN(nn.Module):
     def custom_init(self):
         _custom_rhn_init(self)
 
+    def _gates(self):
+        # the step-wise implementation computes the carry gate with rnn_t
+        rnn_gates = [(h, t, t) for h, t in zip(self.rnn_h, self.rnn_t)]
+        return (self.input_H, self.input_T, self.input_C), rnn_gates
+
     def _step(self, H_t, T_t, C_t, h0, h_mask, t_mask, c_mask):
         s_lm1, rnns = h0, [self.rnn_h, self.rnn_t, self.rnn_c]
         for l, (rnn_h, rnn_t, rnn_c) in enumerate(zip(*rnns)):
@@ -302,6 +605,16 @@ class _RHN(nn.Module):
         else:
             t_mask = make_dropout_mask(inp, self.input_dropout, (mask_size))
             c_mask = make_dropout_mask(inp, self.input_dropout, (mask_size))
+
+        if getattr(self, 'fused', False):
+            mask_size = (batch_size, self.hid_dim)
+            s_masks = [make_dropout_mask(inp, self.hidden_dropout, mask_size)]
+            if not self.tied_noise:
+                s_masks += [make_dropout_mask(inp, self.hidden_dropout, mask_size)
+                            for _ in range(2)]
+            return self._fused_forward(
+                inp, hidden, [h_mask, t_mask, c_mask], s_masks)
+
         H = (h_mask.expand_as(inp) * inp).view(seq_len * batch_size, -1)
         T = (t_mask.expand_as(inp) * inp).view(seq_len * batch_size, -1)
         C = (c_mask.expand_as(inp) * inp).view(seq_len * batch_size, -1)
@@ -327,7 +640,7 @@ class _RHN(nn.Module):
         return torch.stack(outs), outs[-1]
 
 
-class _RHNCoupled(nn.Module):
+class _RHNCoupled(_FusedRHNMixin, nn.Module):
     """
     Simple variant of the RHN from https://arxiv.org/abs/1607.03474, in which
     the carry gate is omitted and the highway transformation is defined as:
@@ -343,13 +656,16 @@ class _RHNCoupled(nn.Module):
     Parameters: (See _RHN)
     """
     def __init__(self, in_dim, hid_dim, num_layers=1, tied_noise=True,
-                 input_dropout=0.75, hidden_dropout=0.25, **kwargs):
+                 input_dropout=0.75, hidden_dropout=0.25, fused=True,
+                 jit=True, **kwargs):
         self.in_dim = in_dim
         self.hid_dim = hid_dim
         self.depth = num_layers
         self.input_dropout = input_dropout
         self.hidden_dropout = hidden_dropout
         self.tied_noise = tied_noise
+        self.fused = fused
+        self.jit = jit
         super(_RHNCoupled, self).__init__()
         self.add_module('input_H', nn.Linear(in_dim, hid_dim))
         self.add_module('input_T', nn.Linear(in_dim, hid_dim))
@@ -365,6 +681,10 @@ class _RHNCoupled(nn.Module):
     def custom_init(self):
         _custom_rhn_init(self)
 
+    def _gates(self):
+        rnn_gates = list(zip(self.rnn_h, self.rnn_t))
+        return (self.input_H, self.input_T), rnn_gates
+
     def _step(self, H_t, T_t, h0, h_mask, t_mask):
         s_lm1 = h0
         for l, (rnn_h, rnn_t) in enumerate(zip(self.rnn_h, self.rnn_t)):
@@ -396,6 +716,15 @@ class _RHNCoupled(nn.Module):
             t_mask = h_mask
         else:
             t_mask = make_dropout_mask(inp, self.input_dropout, (mask_size))
+
+        if getattr(self, 'fused', False):
+            mask_size = (batch_size, self.hid_dim)
+            s_masks = [make_dropout_mask(inp, self.hidden_dropout, mask_size)]
+            if not self.tied_noise:
+                s_masks.append(
+                    make_dropout_mask(inp, self.hidden_dropout, mask_size))
+            return self._fused_forward(inp, hidden, [h_mask, t_mask], s_masks)
+
         H = (h_mask.expand_as(inp) * inp).view(seq_len * batch_size, -1)
         T = (t_mask.expand_as(inp) * inp).view(seq_len * batch_size, -1)
         H = self.input_H(H).view(seq_len, batch_size, -1)
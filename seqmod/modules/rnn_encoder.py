@@ -6,6 +6,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pad_packed_sequence as unpack
 
+from seqmod import utils as u
 from seqmod.modules.encoder import BaseEncoder
 from seqmod.modules.torch_utils import init_hidden_for, repackage_bidi
 from seqmod.modules.torch_utils import pack_sort, get_last_token
@@ -238,7 +239,9 @@ class GRLRNNEncoder(RNNEncoder):
             grl_loss.append(F.nll_loss(cond_out, cond, size_average=True))
 
         if not test:
+            u.mark_phase('forward')
             (sum(grl_loss) / len(self.grls)).backward(retain_graph=True)
+            u.mark_phase('backward')
 
         return [l.item() for l in grl_loss], cond.size(0)
 
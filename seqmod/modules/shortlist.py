@@ -0,0 +1,110 @@
+
+from collections import defaultdict
+
+import torch
+
+
+class Shortlist(object):
+    """
+    Vocabulary shortlist to restrict the output projection at inference time
+    to a per-batch candidate set of target vocabulary ids. The candidate set
+    is built from the top `top_n` most frequent target words (the vocabulary
+    of a fitted Dict is kept in frequency order with the reserved symbols
+    at the top) plus the translations of the input tokens according to a
+    lexical translation table.
+
+    Parameters:
+    -----------
+    top_n: int, number of most frequent target words to always include
+    lex_table: (optional) dict from input ids to iterables of target ids
+    include: (optional) iterable of target ids to always include
+        (e.g. <eos>, <unk>)
+    exclude: (optional) iterable of target ids to never include (e.g. <pad>)
+    vocab_size: (optional) int, size of the target vocabulary, `top_n` is
+        clamped to it
+    """
+    def __init__(self, top_n, lex_table=None, include=(), exclude=(),
+                 vocab_size=None):
+        if vocab_size is not None:
+            top_n = min(top_n, vocab_size)
+        self.top_n = top_n
+        self.lex_table = lex_table or {}
+        self.exclude = set(exclude)
+        self.base = (set(range(top_n)) | set(include)) - self.exclude
+
+    @classmethod
+    def from_dicts(cls, trg_dict, top_n, src_dict=None, table=None):
+        """
+        Build a Shortlist from a word-level lexical table.
+
+        Parameters:
+        -----------
+        trg_dict: Dict, fitted target dictionary
+        top_n: int, see Shortlist
+        src_dict: (optional) Dict, fitted source dictionary
+        table: (optional) dict from source words to iterables of target words
+        """
+        lex_table = defaultdict(set)
+        if table is not None:
+            if src_dict is None:
+                raise ValueError("Lexical table requires `src_dict`")
+            for src, trgs in table.items():
+                if src not in src_dict.s2i:
+                    continue
+                lex_table[src_dict.index(src)].update(
+                    trg_dict.index(trg) for trg in trgs if trg in trg_dict.s2i)
+
+        include = [trg_dict.get_eos(), trg_dict.get_bos(), trg_dict.get_unk()]
+        include = [idx for idx in include if idx is not None]
+        exclude = [trg_dict.get_pad()] if trg_dict.get_pad() is not None else []
+
+        return cls(top_n, lex_table=dict(lex_table), include=include,
+                   exclude=exclude, vocab_size=len(trg_dict))
+
+    @classmethod
+    def from_lex_file(cls, path, trg_dict, top_n, src_dict, top_k=10,
+                      min_prob=0.0):
+        """
+        Build a Shortlist from a lexical translation file with lines in the
+        form `src_word trg_word prob` (e.g. as extracted from word alignments),
+        keeping the `top_k` most probable translations of each source word.
+        """
+        candidates = defaultdict(list)
+        with open(path) as f:
+            for line in f:
+                line = line.split()
+                if len(line) != 3:
+                    continue
+                src, trg, prob = line
+                if float(prob) >= min_prob:
+                    candidates[src].append((float(prob), trg))
+
+        table = {}
+        for src, trgs in candidates.items():
+            table[src] = [trg for _, trg in sorted(trgs, reverse=True)[:top_k]]
+
+        return cls.from_dicts(trg_dict, top_n, src_dict=src_dict, table=table)
+
+    def __call__(self, inp, device='cpu'):
+        """
+        Compute the candidate set for a given input batch.
+
+        Parameters:
+        -----------
+        inp: torch.LongTensor or (nested) list of ints with the input ids
+
+        Returns:
+        --------
+        torch.LongTensor (num_candidates), sorted candidate target ids
+        """
+        if isinstance(inp, torch.Tensor):
+            device, inp = inp.device, set(inp.contiguous().view(-1).tolist())
+        else:
+            inp = set(i for seq in inp for i in seq)
+
+        candidates = set(self.base)
+        for i in inp:
+            candidates.update(self.lex_table.get(i, ()))
+        candidates -= self.exclude
+
+        return torch.tensor(sorted(candidates), dtype=torch.int64, device=device)
@@ -6,8 +6,9 @@ from torch.autograd import Variable
 from torch.nn.utils.rnn import pad_packed_sequence as unpack
 from torch.nn.utils.rnn import pack_padded_sequence as pack
 
+from seqmod import utils as u
 from seqmod.modules.rnn_encoder import RNNEncoder
-from seqmod.modules.softmax import FullSoftmax, SampledSoftmax
+from seqmod.modules.softmax import FullSoftmax, SampledSoftmax, AdaptiveSoftmax
 
 
 def run_decoder(decoder, thought, hidden, inp, lengths):
@@ -41,7 +42,8 @@ def run_decoder(decoder, thought, hidden, inp, lengths):
 class SkipthoughtLoss(nn.Module):
 
     def __init__(self, embeddings, cell, thought_dim, hid_dim,
-                 dropout=0.0, mode='prev+post', clone=False, softmax='full'):
+                 dropout=0.0, mode='prev+post', clone=False, softmax='full',
+                 loss_chunk_size=0):
 
         self.mode = mode.lower().split('+')
         if sum([part in ('prev', 'same', 'post') for part in self.mode]) == 0:
@@ -72,15 +74,18 @@ class SkipthoughtLoss(nn.Module):
 
         if softmax == 'full':
             self.logits = FullSoftmax(
-                hid_dim, embeddings.embedding_dim, embeddings.num_embeddings)
+                hid_dim, embeddings.embedding_dim, embeddings.num_embeddings,
+                loss_chunk_size=loss_chunk_size)
         elif softmax == 'tied':
             self.logits = FullSoftmax(
                 hid_dim, embeddings.embedding_dim, embeddings.num_embeddings,
-                tie_weights=True)
+                tie_weights=True, loss_chunk_size=loss_chunk_size)
             self.logits.tie_embedding_weights(embeddings)
         elif softmax == 'sampled':
             self.logits = SampledSoftmax(
                 hid_dim, embeddings.embedding_dim, embeddings.num_embeddings)
+        elif softmax == 'adaptive':
+            self.logits = AdaptiveSoftmax(hid_dim, embeddings.num_embeddings)
         else:
             raise ValueError("Unknown softmax {}".format(softmax))
 
@@ -111,6 +116,13 @@ class SkipthoughtLoss(nn.Module):
             if isinstance(self.logits, SampledSoftmax) and self.training:
                 out, new_trg = self.logits(out, targets=trg, normalize=False)
                 dec_loss = F.cross_entropy(out, new_trg, size_average=False)
+            elif isinstance(self.logits, AdaptiveSoftmax):
+                logprobs = self.logits(out, targets=trg)
+                dec_loss = -(logprobs * self.nll_weight[trg]).sum()
+            elif isinstance(self.logits, FullSoftmax) and \
+                 self.logits.loss_chunk_size:
+                dec_loss = self.logits.chunked_loss(
+                    out, trg, weight=self.nll_weight)
             else:
                 dec_loss = F.cross_entropy(
                     self.logits(out, normalize=False), trg, size_average=False,
@@ -124,6 +136,7 @@ class SkipthoughtLoss(nn.Module):
             num_examples += examples
 
         if not test:
+            u.mark_phase('forward')
             loss.backward()
 
         return tuple(report_loss), num_examples
@@ -131,7 +144,8 @@ class SkipthoughtLoss(nn.Module):
 
 class Skipthought(nn.Module):
     def __init__(self, embeddings, mode, softmax='full', cell='GRU', hid_dim=2400,
-                 num_layers=1, bidi=True, summary='last', dropout=0.0):
+                 num_layers=1, bidi=True, summary='last', dropout=0.0,
+                 loss_chunk_size=0):
         super(Skipthought, self).__init__()
 
         self.encoder = RNNEncoder(embeddings, hid_dim, num_layers, cell,
@@ -140,10 +154,11 @@ class Skipthought(nn.Module):
 
         self.decoder = SkipthoughtLoss(
             embeddings, cell, self.encoder.encoding_size[1], hid_dim,
-            mode=mode, dropout=dropout, softmax=softmax)
+            mode=mode, dropout=dropout, softmax=softmax,
+            loss_chunk_size=loss_chunk_size)
 
     def loss(self, batch_data, test=False):
         (inp, lengths), sents = batch_data
         thought, hidden = self.encoder(inp, lengths)
-        losses, num_examples = self.decoder.loss(thought, hidden, sents)
+        losses, num_examples = self.decoder.loss(thought, hidden, sents, test=test)
         return losses, num_examples
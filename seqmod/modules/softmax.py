@@ -4,11 +4,84 @@ import logging
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.autograd import Function
+from torch.utils.checkpoint import checkpoint
 
 from seqmod.modules.torch_utils import variational_dropout
 from seqmod.modules.ff import Highway
 
-from .log_uniform import LogUniformSampler
+from .log_uniform import TorchLogUniformSampler
+
+
+class ChunkedCrossEntropy(Function):
+    """
+    Fused output projection and cross-entropy that processes the input rows
+    in chunks and never materializes the full ((seq_len *) batch x vocab)
+    logits. Only the per-row log-sum-exp is kept for the backward pass, where
+    the logits of each chunk are recomputed.
+    """
+    @staticmethod
+    def forward(ctx, output, weight, bias, targets, row_weight, chunk_size):
+        lse = output.new_empty(output.size(0))
+        loss = output.new_zeros(())
+
+        for start in range(0, output.size(0), chunk_size):
+            stop = start + chunk_size
+            logits = torch.addmm(bias, output[start:stop], weight.t())
+            chunk_lse = logits.logsumexp(1)
+            true = logits.gather(1, targets[start:stop].unsqueeze(1)).squeeze(1)
+            loss += ((chunk_lse - true) * row_weight[start:stop]).sum()
+            lse[start:stop] = chunk_lse
+
+        ctx.chunk_size = chunk_size
+        ctx.save_for_backward(output, weight, bias, targets, row_weight, lse)
+
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        output, weight, bias, targets, row_weight, lse = ctx.saved_tensors
+        grad_output = torch.zeros_like(output)
+        grad_weight, grad_bias = torch.zeros_like(weight), torch.zeros_like(bias)
+
+        for start in range(0, output.size(0), ctx.chunk_size):
+            stop = start + ctx.chunk_size
+            chunk = output[start:stop]
+            # recompute softmax: d(lse - true) / d logits = softmax - onehot
+            grad = torch.addmm(bias, chunk, weight.t()) \
+                        .sub_(lse[start:stop].unsqueeze(1)).exp_()
+            grad.scatter_add_(
+                1, targets[start:stop].unsqueeze(1),
+                grad.new_full((grad.size(0), 1), -1))
+            grad.mul_((row_weight[start:stop] * grad_loss).unsqueeze(1))
+            grad_output[start:stop] = grad @ weight
+            grad_weight.addmm_(grad.t(), chunk)
+            grad_bias += grad.sum(0)
+
+        return grad_output, grad_weight, grad_bias, None, None, None
+
+
+def chunked_cross_entropy(output, weight, bias, targets,
+                          class_weight=None, chunk_size=1024):
+    """
+    Summed cross-entropy of a linear output layer (weight, bias) computed
+    in chunks of `chunk_size` rows (see ChunkedCrossEntropy).
+
+    Parameters:
+    -----------
+    output: (N x hid_dim)
+    weight: (vocab x hid_dim), bias: (vocab)
+    targets: torch.LongTensor (N)
+    class_weight: (optional) (vocab), per-class loss weights, e.g. to ignore
+        the padding index.
+    """
+    if class_weight is None:
+        row_weight = output.new_ones(targets.size(0))
+    else:
+        row_weight = class_weight.index_select(0, targets).to(output.dtype)
+
+    return ChunkedCrossEntropy.apply(
+        output, weight, bias, targets, row_weight, chunk_size)
 
 
 class BaseSoftmax(nn.Module):
@@ -22,6 +95,29 @@ class BaseSoftmax(nn.Module):
     def forward(self, output, labels=False):
         raise NotImplementedError
 
+    def project_output(self, output, shortlist=None):
+        """
+        Project onto the output vocabulary or, if a `shortlist` of vocabulary
+        ids (torch.LongTensor) is given, onto the shortlisted entries only.
+        """
+        if shortlist is None:
+            return self.output_emb(output)
+
+        weight, bias = self.output_emb.weight, self.output_emb.bias
+        if not isinstance(weight, torch.Tensor):
+            # quantized projection (see seqmod.modules.quantize): weights
+            # are packed, unpack and dequantize the shortlisted rows only
+            weight, bias = self.output_emb._weight_bias()
+            weight = weight.index_select(0, shortlist)
+            weight = weight.dequantize() if weight.is_quantized else weight.float()
+        else:
+            weight = weight.index_select(0, shortlist)
+
+        if bias is not None:
+            bias = bias.index_select(0, shortlist)
+
+        return F.linear(output, weight, bias)
+
     def tie_embedding_weights(self, embedding):
         """
         Actually tie the weights
@@ -40,10 +136,17 @@ class FullSoftmax(BaseSoftmax):
     """
     General output layer for Softmax-based models (LM, Decoder)
     It has options for adding a deepout layer previous to the softmax layers.
+
+    Parameters:
+    -----------
+    - loss_chunk_size: int, if positive, models should compute the loss with
+        `chunked_loss` using chunks of the given number of rows.
     """
     def __init__(self, hid_dim, emb_dim, vocab, tie_weights=False, dropout=0.0,
-                 deepout_layers=0, deepout_act=None, maxouts=1):
+                 deepout_layers=0, deepout_act=None, maxouts=1,
+                 loss_chunk_size=0):
 
+        self.loss_chunk_size = loss_chunk_size
         self.hid_dim = hid_dim
         self.emb_dim = emb_dim
         self.vocab = vocab
@@ -71,16 +174,10 @@ class FullSoftmax(BaseSoftmax):
         else:
             self.output_emb = nn.Linear(hid_dim, vocab)
 
-    def forward(self, output, reshape=False, normalize=True):
-        """
-        output: Tensor((seq_len x) batch x hid_dim)
-        reshape: whether to unflatten the seq_len and batch dims in the output
-        normalize: whether to return log-probs (otherwise logits will be returned).
-        """
+    def _hidden(self, output):
         if self.tie_weights and not self.tied_weights:
             raise ValueError("Module should have tied weights")
 
-        seq_len = 1 if output.dim() == 2 else output.size(0)
         output = output.view(-1, self.hid_dim)  # collapse seq_len and batch
 
         if hasattr(self, 'deepout'):
@@ -88,12 +185,41 @@ class FullSoftmax(BaseSoftmax):
         if hasattr(self, 'intermediate'):
             output = self.intermediate(output)
 
-        output = self.output_emb(output)  # ((seq_len *) batch x vocab)
+        return output
+
+    def chunked_loss(self, output, targets, weight=None, chunk_size=None):
+        """
+        Memory-efficient summed negative log-likelihood of the targets
+        (see chunked_cross_entropy). Equivalent to
+        `F.nll_loss(self(output), targets, weight=weight, size_average=False)`
+
+        output: Tensor((seq_len x) batch x hid_dim)
+        targets: Tensor((seq_len x) batch)
+        """
+        return chunked_cross_entropy(
+            self._hidden(output),
+            self.output_emb.weight, self.output_emb.bias, targets.view(-1),
+            class_weight=weight,
+            chunk_size=chunk_size or self.loss_chunk_size or 1024)
+
+    def forward(self, output, reshape=False, normalize=True, shortlist=None):
+        """
+        output: Tensor((seq_len x) batch x hid_dim)
+        reshape: whether to unflatten the seq_len and batch dims in the output
+        normalize: whether to return log-probs (otherwise logits will be returned).
+        shortlist: (optional) torch.LongTensor of vocabulary ids to restrict
+            the output to. Output columns correspond to the shortlist entries.
+        """
+        seq_len = 1 if output.dim() == 2 else output.size(0)
+        output = self._hidden(output)
+
+        # ((seq_len *) batch x vocab)
+        output = self.project_output(output, shortlist=shortlist)
 
         if normalize:
             output = F.log_softmax(output, dim=1)
         if reshape:
-            output = output.view(seq_len, -1, self.vocab)
+            output = output.view(seq_len, -1, output.size(1))
 
         return output
 
@@ -101,19 +227,24 @@ class FullSoftmax(BaseSoftmax):
 class MixtureSoftmax(BaseSoftmax):
     """
     Mixture of softmaxes to provide a high-rank approximatation to the actual output
-    matrix that a Language Model is trying to factorize.
+    matrix that a Language Model is trying to factorize. The mixture is computed
+    in log-space accumulating over one mixture component at a time, which avoids
+    holding the ((seq_len *) batch * mixtures x vocab) probabilities in memory.
 
     Parameters:
     -----------
     - mixtures: int, number of softmaxes in the mixture
+    - chunk_size: int, if positive, process the input rows in chunks of the
+        given size (only affects the intermediate memory).
     """
     def __init__(self, hid_dim, emb_dim, vocab,
-                 tie_weights=False, dropout=0.0, mixtures=5):
+                 tie_weights=False, dropout=0.0, mixtures=5, chunk_size=0):
         self.hid_dim = hid_dim
         self.emb_dim = emb_dim
         self.vocab = vocab
         self.dropout = dropout
         self.mixtures = mixtures
+        self.chunk_size = chunk_size
         self.tie_weights = tie_weights
         self.tied_weights = False  # flag to check if weights were tied before run
         super(MixtureSoftmax, self).__init__()
@@ -122,7 +253,54 @@ class MixtureSoftmax(BaseSoftmax):
         self.mixture_latent = nn.Linear(hid_dim, mixtures * emb_dim)
         self.output_emb = nn.Linear(emb_dim, vocab)
 
-    def forward(self, output, normalize=True, reshape=False):
+    def _mixture_step(self, log_prior, latent, targets=None, shortlist=None):
+        logits = self.project_output(latent, shortlist=shortlist)
+        if targets is None:
+            logprobs = F.log_softmax(logits, dim=1)
+        else:
+            logprobs = logits.gather(1, targets.unsqueeze(1)).squeeze(1) - \
+                       logits.logsumexp(1)
+            logprobs = logprobs.unsqueeze(1)
+
+        return logprobs + log_prior.unsqueeze(1)
+
+    def _mixture_log_probs(self, log_priors, latent, targets=None, shortlist=None):
+        """
+        Accumulate the mixture log-probs one mixture at a time. When gradients
+        are needed, the logits of each mixture are recomputed in the backward
+        pass (checkpointing), so that only those of one mixture are alive at
+        any time.
+
+        log_priors: (rows x mixtures)
+        latent: (rows x mixtures x emb_dim)
+        targets: (optional) (rows), only compute the log-probs of the targets
+        """
+        output = None
+        for k in range(self.mixtures):
+            if torch.is_grad_enabled() and latent.requires_grad:
+                logprobs = checkpoint(
+                    self._mixture_step, log_priors[:, k], latent[:, k],
+                    targets, shortlist, use_reentrant=False)
+            else:
+                logprobs = self._mixture_step(
+                    log_priors[:, k], latent[:, k], targets, shortlist)
+
+            if output is None:
+                output = logprobs
+            else:
+                output = torch.logaddexp(output, logprobs)
+
+        return output if targets is None else output.squeeze(1)
+
+    def forward(self, output, normalize=True, reshape=False, shortlist=None,
+                targets=None):
+        """
+        output: Tensor((seq_len x) batch x hid_dim)
+        targets: (optional) Tensor((seq_len x) batch), if given only the
+            log-probs of the targets are computed, which should be used
+            for computing the loss.
+        shortlist: (optional) see FullSoftmax
+        """
         if not normalize:
             raise ValueError("Mixture of Softmaxes cannot return logits")
 
@@ -132,48 +310,179 @@ class MixtureSoftmax(BaseSoftmax):
         seq_len = 1 if output.dim() == 2 else output.size(0)
         output = output.view(-1, self.hid_dim)  # collapse seq_len and batch
 
-        # Compute weights over mixtures: ((seq_len *) batch x mixture)
-        priors = F.softmax(self.mixture_priors(output), dim=1)
+        # Compute log-weights over mixtures: ((seq_len *) batch x mixture)
+        log_priors = F.log_softmax(self.mixture_priors(output), dim=1)
         # Compute logits 1: (seq_len x batch x mixture * emb_dim)
         output = self.mixture_latent(output).view(
             seq_len, -1, self.mixtures * self.emb_dim)
         # Variational dropout
         output = variational_dropout(
             output, p=self.dropout, training=self.training)
-        # Compute logits 2: ((seq_len *) batch * mixture x vocab)
-        output = self.output_emb(output.view(-1, self.emb_dim))
-        # Compute probabilities
-        output = F.softmax(output, dim=1).view(-1, self.mixtures, self.vocab)
-        # Mix: ((seq_len *) batch x vocab)
-        output = (output * priors.unsqueeze(2).expand_as(output)).sum(1)
-        # Transform probs to log-probs
-        output = output.add_(1e-8).log()
+        # ((seq_len *) batch x mixture x emb_dim)
+        output = output.view(-1, self.mixtures, self.emb_dim)
+
+        if targets is not None:
+            if reshape:
+                raise ValueError("MixtureSoftmax doesn't support `reshape` "
+                                 "when `targets` are given")
+            targets = targets.view(-1)
+
+        # Mix: ((seq_len *) batch x vocab) or ((seq_len *) batch) with targets
+        chunk_size = self.chunk_size or output.size(0)
+        output = torch.cat([
+            self._mixture_log_probs(
+                log_priors[i:i+chunk_size], output[i:i+chunk_size],
+                targets=None if targets is None else targets[i:i+chunk_size],
+                shortlist=shortlist)
+            for i in range(0, output.size(0), chunk_size)])
 
         if reshape:
             # => (seq_len x batch x vocab)
-            output = output.view(seq_len, -1, self.vocab)
+            output = output.view(seq_len, -1, output.size(1))
 
         return output
 
 
-# FIXME: Can't be put inside SampledSoftmax since it can't be pickled
-_SAMPLER = None
+class AdaptiveSoftmax(BaseSoftmax):
+    """
+    Adaptive softmax (Grave et al. 2017) for large vocabularies. The vocabulary
+    is partitioned by frequency into a head (most frequent words plus one entry
+    per tail cluster) and a number of tail clusters with progressively smaller
+    projection dimensions. It relies on the vocabulary being sorted by
+    frequency, which is the case for vocabularies fitted with `Dict`.
+
+    Parameters:
+    -----------
+    - cutoffs: list of ints, vocabulary indices at which each cluster starts,
+        e.g. [2000, 10000] results in a head of size 2000 + 2 and two clusters
+        covering [2000, 10000) and [10000, vocab). If not given, cutoffs are
+        set at 1/20 and 1/4 of the vocabulary.
+    - div_value: float, factor by which the projection dimension is reduced
+        from one cluster to the next.
+    """
+    def __init__(self, hid_dim, vocab, cutoffs=None, div_value=4.0):
+        if cutoffs is None:
+            cutoffs = sorted(set(c for c in (vocab // 20, vocab // 4) if c > 0))
+        cutoffs = list(cutoffs)
+        if cutoffs != sorted(set(cutoffs)) or cutoffs[0] <= 0 or \
+           cutoffs[-1] >= vocab:
+            raise ValueError("cutoffs must be increasing and in range (0, {})"
+                             .format(vocab))
+
+        self.hid_dim = hid_dim
+        self.vocab = vocab
+        self.cutoffs = cutoffs + [vocab]
+        self.div_value = div_value
+        self.tie_weights = False
+        self.tied_weights = False
+        super(AdaptiveSoftmax, self).__init__()
+
+        self.head_size = cutoffs[0]
+        self.n_clusters = len(cutoffs)
+        self.output_emb = nn.Linear(hid_dim, self.head_size + self.n_clusters)
+        self.tail = nn.ModuleList()
+        for i in range(self.n_clusters):
+            low, high = self.cutoffs[i], self.cutoffs[i + 1]
+            dim = max(1, int(hid_dim // (div_value ** (i + 1))))
+            self.tail.append(nn.Sequential(
+                nn.Linear(hid_dim, dim, bias=False),
+                nn.Linear(dim, high - low)))
+
+    def log_probs(self, output):
+        """
+        Compute the log-probabilities over the full vocabulary
+
+        output: ((seq_len *) batch x hid_dim)
+        """
+        head = F.log_softmax(self.output_emb(output), dim=1)
+        logprobs = [head[:, :self.head_size]]
+        for i, tail in enumerate(self.tail):
+            cluster = head[:, self.head_size + i].unsqueeze(1)
+            logprobs.append(F.log_softmax(tail(output), dim=1) + cluster)
+
+        return torch.cat(logprobs, dim=1)
+
+    def target_log_probs(self, output, targets):
+        """
+        Compute the log-probabilities of the targets only, running each tail
+        cluster exclusively over the rows whose target falls in it.
+
+        output: ((seq_len *) batch x hid_dim)
+        targets: ((seq_len *) batch)
+        """
+        head_targets = targets.clone()
+        logprobs = output.new_zeros(targets.size(0))
+
+        for i, tail in enumerate(self.tail):
+            low, high = self.cutoffs[i], self.cutoffs[i + 1]
+            rows = ((targets >= low) & (targets < high)).nonzero().view(-1)
+            if rows.numel() == 0:
+                continue
+            head_targets.index_fill_(0, rows, self.head_size + i)
+            tail_out = F.log_softmax(tail(output.index_select(0, rows)), dim=1)
+            tail_trg = targets.index_select(0, rows) - low
+            logprobs.index_add_(
+                0, rows, tail_out.gather(1, tail_trg.unsqueeze(1)).squeeze(1))
+
+        head = F.log_softmax(self.output_emb(output), dim=1)
+
+        return logprobs + head.gather(1, head_targets.unsqueeze(1)).squeeze(1)
+
+    def forward(self, output, targets=None, normalize=True, reshape=False,
+                shortlist=None):
+        """
+        Parameters:
+        -----------
+        output: ((seq_len *) batch_size x hid_dim)
+        targets: ((seq_len *) batch_size), if given, only the log-probs of the
+            targets are computed, which should be used for computing the loss.
+        shortlist: unsupported, raises a ValueError if given
+
+        Returns:
+        --------
+        - log-probs: ((seq_len *) batch_size x vocab) or, if `targets` is
+            given, ((seq_len *) batch_size)
+        """
+        if not normalize:
+            raise ValueError("AdaptiveSoftmax cannot return logits")
+
+        if shortlist is not None:
+            # normalizing requires the full projection of the tail clusters
+            raise ValueError("AdaptiveSoftmax doesn't support shortlists")
+
+        seq_len = 1 if output.dim() == 2 else output.size(0)
+        output = output.view(-1, self.hid_dim)  # collapse seq_len and batch
+
+        if targets is not None:
+            if reshape:
+                raise ValueError("AdaptiveSoftmax doesn't support `reshape` "
+                                 "when `targets` are given")
+            return self.target_log_probs(output, targets.view(-1))
+
+        # ((seq_len *) batch x vocab)
+        output = self.log_probs(output)
+
+        if reshape:
+            output = output.view(seq_len, -1, output.size(1))
+
+        return output
 
 
 class SampledSoftmax(FullSoftmax):
     def __init__(self, hid_dim, emb_dim, vocab, nsampled=8192, **kwargs):
         super(SampledSoftmax, self).__init__(hid_dim, emb_dim, vocab, **kwargs)
 
-        global _SAMPLER
-        _SAMPLER = LogUniformSampler(vocab)
+        self.sampler = TorchLogUniformSampler(vocab)
         self.nsampled = nsampled
 
-    def forward(self, output, targets=None, normalize=True, reshape=False):
+    def forward(self, output, targets=None, normalize=True, reshape=False,
+                shortlist=None):
         """
         Parameters:
         -----------
         output: ((seq_len *) batch_size x hid_dim)
         targets: ((seq_len *) batch_size)
+        shortlist: (optional) see FullSoftmax, only used during evaluation.
 
         Returns:
         -------
@@ -201,12 +510,13 @@ class SampledSoftmax(FullSoftmax):
                                  "or `reshape` during training")
             return self.sampled(output, targets)
 
-        output = self.output_emb(output)  # ((seq_len *) batch x vocab)
+        # ((seq_len *) batch x vocab)
+        output = self.project_output(output, shortlist=shortlist)
 
         if normalize:
             output = F.log_softmax(output, dim=1)
         if reshape:
-            output = output.view(seq_len, -1, self.vocab)
+            output = output.view(seq_len, -1, output.size(1))
 
         return output
 
@@ -222,11 +532,11 @@ class SampledSoftmax(FullSoftmax):
         logits: ((seq_len *) batch_size x nsampled + 1)  # adding the true class
         new_targets: ((seq_len *) batch_size)
         """
-        sample_ids, true_freq, sample_freq = _SAMPLER.sample(
-            self.nsampled, targets.cpu().numpy())
-        sample_ids = output.new(sample_ids).long()
-        true_freq = output.new(true_freq)
-        sample_freq = output.new(sample_freq)
+        sample_ids, true_freq, sample_freq = self.sampler.sample(
+            self.nsampled, targets)
+        sample_ids = sample_ids.to(output.device)
+        true_freq = true_freq.to(output.device)
+        sample_freq = sample_freq.to(output.device)
 
         # gather true labels and weights
         true_weights = self.output_emb.weight[targets, :]
@@ -246,10 +556,9 @@ class SampledSoftmax(FullSoftmax):
 
         # remove true targets from sample set
         if remove_accidental_match:
-            acc_hits = _SAMPLER.accidental_match(
-                targets.cpu().numpy(), sample_ids.cpu().numpy())
-            if len(acc_hits) > 0:
-                sample_logits[list(zip(*acc_hits))] = -1e37
+            rows, cols = self.sampler.accidental_match(targets, sample_ids)
+            if len(rows) > 0:
+                sample_logits[rows.to(output.device), cols.to(output.device)] = -1e37
 
         # perform correction
         true_logits = true_logits.sub(torch.log(true_freq))
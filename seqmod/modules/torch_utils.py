@@ -45,9 +45,9 @@ def make_length_mask(lengths):
 
     mask: torch.ByteTensor(batch x seq_len)
     """
-    maxlen, batch = lengths.detach().max(), len(lengths)
+    maxlen = lengths.detach().max()
     return torch.arange(0, maxlen, dtype=torch.int64, device=lengths.device) \
-                .repeat(batch, 1) \
+                .unsqueeze(0) \
                 .lt(lengths.unsqueeze(1))
 
 
@@ -233,10 +233,11 @@ def pack_sort(inp, lengths, batch_first=False):
     lengths, sort = torch.sort(lengths, descending=True)
     _, unsort = sort.sort()
 
+    # (lengths as a tensor keep the function traceable, see seqmod.modules.export)
     if batch_first:
-        inp = pack_padded_sequence(inp[sort], lengths.tolist())
+        inp = pack_padded_sequence(inp[sort], lengths.cpu())
     else:
-        inp = pack_padded_sequence(inp[:, sort], lengths.tolist())
+        inp = pack_padded_sequence(inp[:, sort], lengths.cpu())
 
     return inp, unsort
 
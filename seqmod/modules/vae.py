@@ -2,6 +2,7 @@
 import torch
 import torch.nn as nn
 
+from seqmod import utils as u
 from seqmod.modules.torch_utils import swap, make_dropout_mask
 from seqmod.modules.ff import Highway
 from seqmod.misc import inflection_sigmoid, linear
@@ -64,7 +65,9 @@ class VAERNNEncoder(RNNEncoder):
         kl_loss = self.kl_weight * (KL_loss(mu, logvar) / num_examples)
 
         if not test:
+            u.mark_phase('forward')
             kl_loss.backward(retain_graph=True)
+            u.mark_phase('backward')
 
         return (kl_loss.item(),), num_examples  # encoder loss is a list
 
@@ -89,7 +92,8 @@ class VAERNNDecoder(RNNDecoder):
                 self.rnn.in_dim + z_dim,  # append z dim to input
                 self.hid_dim,
                 self.cell,
-                dropout=self.dropout)
+                dropout=self.dropout,
+                jit=self.jit)
 
     def init_hidden_for(self, z):
         batch_size = z.size(0)
@@ -137,10 +141,10 @@ class VAERNNDecoder(RNNDecoder):
         inp = self.embeddings(inp)
 
         if self.add_z:
-            inp = torch.cat([inp, self.z_proj(state.z)], 1)
+            inp = torch.cat([inp, state.select_beam(self.z_proj(state.z))], 1)
 
         if self.conditional:
-            inp = torch.cat([inp, *state.conds], 1)
+            inp = torch.cat([inp, *state.select_beam(state.conds)], 1)
 
         out, hidden = self.rnn(
             inp, state.hidden, dropout_mask=state.dropout_mask)
@@ -159,18 +163,20 @@ class VAEDecoderState(State):
         self.dropout_mask = dropout_mask
 
     def expand_along_beam(self, width):
-        self.z = self.z.repeat(width, 1)
+        """
+        Only the hidden state is copied along the beam, `z` and `conds`
+        are accessed through `beam_map` (see State).
+        """
+        beam_map = self.make_beam_map(
+            self.z.size(0), width, device=self.z.device)
 
         if isinstance(self.hidden, tuple):
-            hidden = (self.hidden[0].repeat(1, width, 1),
-                      self.hidden[1].repeat(1, width, 1))
+            hidden = (self.hidden[0].index_select(1, beam_map),
+                      self.hidden[1].index_select(1, beam_map))
         else:
-            hidden = self.hidden.repeat(1, width, 1)
+            hidden = self.hidden.index_select(1, beam_map)
         self.hidden = hidden
 
-        if self.conds is not None:
-            self.conds = self.conds.repeat(width, 1)
-
     def reorder_beam(self, beam_ids):
         if isinstance(self.hidden, tuple):
             hidden = (swap(self.hidden[0], 1, beam_ids),
@@ -179,6 +185,23 @@ class VAEDecoderState(State):
             hidden = swap(self.hidden, 1, beam_ids)
         self.hidden = hidden
 
+    def index_batches(self, index):
+        if isinstance(self.hidden, tuple):
+            hidden = (self.hidden[0].index_select(1, index),
+                      self.hidden[1].index_select(1, index))
+        else:
+            hidden = self.hidden.index_select(1, index)
+
+        conds, dropout_mask = None, None
+        if self.conds is not None:
+            conds = self.conds.index_select(0, index)
+        if self.dropout_mask is not None:
+            dropout_mask = self.dropout_mask.index_select(0, index)
+
+        return VAEDecoderState(
+            self.z.index_select(0, index), hidden,
+            conds=conds, dropout_mask=dropout_mask)
+
     def split_batches(self):
         batch_size = self.z.size(0)
 
@@ -0,0 +1,248 @@
+
+"""
+Minimal runtime for decoding with models exported by
+`seqmod.modules.export.export_traced`. It only depends on torch and the
+exported artifacts (it doesn't import anything from seqmod), so it can be
+copied as a single file into serving containers.
+
+python runtime.py path/to/artifacts --method beam < input.txt
+"""
+
+import os
+import json
+
+import torch
+
+
+class Vocab(object):
+    """
+    Vocabulary loaded from an exported `vocab.json` entry.
+    """
+    def __init__(self, vocab, bos=None, eos=None, pad=None, unk=None):
+        self.vocab = vocab
+        self.s2i = {s: i for i, s in enumerate(vocab)}
+        self.bos, self.eos, self.pad, self.unk = bos, eos, pad, unk
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def index(self, tokens, bos=True, eos=True):
+        ids = [self.s2i.get(t, self.unk) for t in tokens]
+        if None in ids:
+            raise ValueError("OOV input but no <unk> in vocabulary")
+        if bos and self.bos is not None:
+            ids = [self.bos] + ids
+        if eos and self.eos is not None:
+            ids = ids + [self.eos]
+        return ids
+
+    def tokens(self, ids):
+        specials = (self.bos, self.eos, self.pad)
+        return [self.vocab[i] for i in ids if i not in specials]
+
+
+class TracedModel(object):
+    """
+    Greedy, sampling and beam search decoding with exported TorchScript
+    modules.
+
+    Parameters:
+    -----------
+    path: str, directory with the exported artifacts
+    device: str, device to load the modules to
+    """
+    def __init__(self, path, device='cpu'):
+        with open(os.path.join(path, 'config.json')) as f:
+            self.config = json.load(f)
+        with open(os.path.join(path, 'vocab.json')) as f:
+            vocab = json.load(f)
+
+        self.device = device
+        self.is_lm = self.config['model'] == 'LM'
+        self.trg_d = Vocab(**vocab['trg'])
+        self.src_d = self.trg_d if self.is_lm else Vocab(**vocab['src'])
+        self.batch_dims = [s['batch_dim'] for s in self.config['state']]
+        self.bos, self.eos = self.trg_d.bos, self.trg_d.eos
+        if self.config['reverse']:
+            self.bos, self.eos = self.eos, self.bos
+
+        def load(name):
+            return torch.jit.load(os.path.join(path, name), map_location=device)
+
+        self.decoder = load('decoder.pt')
+        if self.is_lm:
+            # LM prefixes are read by the step module (see export_traced)
+            self.encoder = self.decoder.encode
+        else:
+            self.encoder = load('encoder.pt')
+        self.project = load('project.pt')
+
+    def _pack(self, seqs):
+        lengths = [len(s) for s in seqs]
+        pad = self.src_d.pad if self.src_d.pad is not None else 0
+        inp = torch.full((max(lengths), len(seqs)), pad, dtype=torch.int64)
+        for b, seq in enumerate(seqs):
+            inp[:len(seq), b] = torch.tensor(seq)
+        return inp.to(self.device), torch.tensor(lengths, device=self.device)
+
+    def _select(self, state, index):
+        return [t.index_select(dim, index) for t, dim in zip(state, self.batch_dims)]
+
+    def start(self, inputs):
+        """
+        Encode the input token lists (source sentences or LM prefixes).
+
+        Returns:
+        --------
+        out: (batch x hid_dim) output for the first prediction
+        state: list of state tensors
+        """
+        if self.is_lm:
+            seqs = [self.src_d.index(inp, eos=False) for inp in inputs]
+            # LM packing requires inputs sorted by length
+            sort = sorted(range(len(seqs)), key=lambda i: -len(seqs[i]))
+            unsort = torch.tensor(sorted(range(len(seqs)), key=sort.__getitem__),
+                                  device=self.device)
+            out, *state = self.encoder(*self._pack([seqs[i] for i in sort]))
+            return out.index_select(0, unsort), self._select(state, unsort)
+
+        state = list(self.encoder(*self._pack([self.src_d.index(i) for i in inputs])))
+        prev = torch.full((len(inputs),), self.bos, dtype=torch.int64, device=self.device)
+        return self.step(prev, state)
+
+    def step(self, prev, state):
+        out, *state = self.decoder(prev, *state)
+        return out, state
+
+    def _max_len(self, inputs, max_len):
+        if max_len is not None:
+            return max_len
+        if self.is_lm:
+            return 25
+        # same as EncoderDecoder.translate with max_decode_len=2
+        return 2 * max(len(self.src_d.index(inp)) for inp in inputs)
+
+    def _finalize(self, hyps):
+        # cut after the first <eos>
+        if self.eos is not None:
+            hyps = [hyp[:hyp.index(self.eos)] if self.eos in hyp else hyp
+                    for hyp in hyps]
+        if self.config['reverse']:
+            hyps = [hyp[::-1] for hyp in hyps]
+        return [self.trg_d.tokens(hyp) for hyp in hyps]
+
+    def generate(self, inputs, max_len=None, sample=False, temperature=1.0):
+        """
+        Greedy (or sampled) decoding. Without <eos> in the vocabulary,
+        decoding only stops after `max_len` steps.
+
+        Parameters:
+        -----------
+        inputs: list of token lists (source sentences or LM prefixes)
+
+        Returns:
+        --------
+        scores: list of floats, summed log-probs of the output
+        hyps: list of token lists
+        """
+        with torch.no_grad():
+            out, state = self.start(inputs)
+            batch = len(inputs)
+            scores = torch.zeros(batch, device=self.device)
+            active = torch.ones(batch, dtype=torch.uint8, device=self.device)
+            hyps = []
+            for _ in range(self._max_len(inputs, max_len)):
+                logprobs = self.project(out)
+                if sample:
+                    prev = (logprobs / temperature).exp().multinomial(1).squeeze(1)
+                    logprob = logprobs.gather(1, prev.unsqueeze(1)).squeeze(1)
+                else:
+                    logprob, prev = logprobs.max(1)
+                if self.eos is None:
+                    hyps.append(prev)
+                else:
+                    hyps.append(prev.masked_fill(active == 0, self.eos))
+                    active = active * (prev != self.eos).to(active.dtype)
+                    if active.sum().item() == 0:
+                        break
+                # as in EncoderDecoder.translate, <eos> doesn't add to the score
+                scores += logprob * active.float()
+                out, state = self.step(prev, state)
+
+        return scores.tolist(), self._finalize(torch.stack(hyps, 1).tolist())
+
+    def beam(self, inputs, width=5, max_len=None):
+        """
+        Beam search decoding (summed log-probs, without length normalization),
+        returning the best hypothesis per input (see `generate`).
+        """
+        with torch.no_grad():
+            out, state = self.start(inputs)
+            batch = len(inputs)
+            beam_map = torch.arange(batch, device=self.device).repeat_interleave(width)
+            out, state = out.index_select(0, beam_map), self._select(state, beam_map)
+            # only the first beam entry is alive at the first step
+            scores = torch.full((batch, width), -float('inf'), device=self.device)
+            scores[:, 0] = 0
+            finished = torch.zeros(batch * width, dtype=torch.bool, device=self.device)
+            hyps = torch.zeros(batch * width, 0, dtype=torch.int64, device=self.device)
+
+            for _ in range(self._max_len(inputs, max_len)):
+                logprobs = self.project(out)
+                vocab = logprobs.size(1)
+                # finished entries only extend with <eos> at no cost
+                if self.eos is not None:
+                    logprobs = logprobs.masked_fill(finished.unsqueeze(1), -float('inf'))
+                    logprobs[:, self.eos] = logprobs[:, self.eos].masked_fill(finished, 0)
+                cands = (scores.view(-1, 1) + logprobs).view(batch, -1)
+                scores, best = cands.topk(width, dim=1)
+                source = (best // vocab + torch.arange(
+                    batch, device=self.device).unsqueeze(1) * width).view(-1)
+                prev = (best % vocab).view(-1)
+                hyps = torch.cat([hyps[source], prev.unsqueeze(1)], 1)
+                if self.eos is not None:
+                    finished = finished[source] | (prev == self.eos)
+                    if finished.view(batch, width)[:, 0].all():
+                        break
+                out, state = self.step(prev, self._select(state, source))
+
+        scores, hyps = scores[:, 0].tolist(), hyps.view(batch, width, -1)[:, 0].tolist()
+        return scores, self._finalize(hyps)
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--method', default='argmax', help='argmax, sample or beam')
+    parser.add_argument('--width', default=5, type=int)
+    parser.add_argument('--temperature', default=1.0, type=float)
+    parser.add_argument('--max_len', type=int)
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--level', default='token', help='token or char')
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    model = TracedModel(args.path, device=args.device)
+    sep = ' ' if args.level == 'token' else ''
+
+    def decode(batch):
+        if args.method == 'beam':
+            _, hyps = model.beam(batch, width=args.width, max_len=args.max_len)
+        else:
+            _, hyps = model.generate(batch, max_len=args.max_len,
+                                     sample=args.method == 'sample',
+                                     temperature=args.temperature)
+        for hyp in hyps:
+            print(sep.join(hyp))
+
+    batch = []
+    for line in sys.stdin:
+        line = line.strip()
+        batch.append(line.split() if args.level == 'token' else list(line))
+        if len(batch) == args.batch_size:
+            decode(batch)
+            batch = []
+    if batch:
+        decode(batch)
@@ -4,6 +4,7 @@ import logging
 import math
 import os
 import yaml
+import time
 import itertools
 from datetime import datetime
 
@@ -34,36 +35,74 @@ def load_model(path):
         return load_fn(f)
 
 
-def save_model(model, prefix, d=None, mode='torch'):
+def get_save_fn(mode='torch'):
     """
-    Save model using a preferred method. Model gets saved to `prefix.ext`,
-    where `ext` is derived from the selected mode. Pass `d` if you want to
-    also save a corresponding dictionary to `prefix.dict.ext`.
-
-    If target directory path doesn't exist, it will fail.
+    Returns the serialization function and file extension for a save mode
     """
     if mode == 'torch':
-        save_fn, ext = torch.save, 'pt'
+        return torch.save, 'pt'
     elif mode == 'pickle':
         import pickle as p
-        save_fn, ext = p.dump, 'pkl'
+        return p.dump, 'pkl'
     elif mode == 'npy':
-        save_fn, ext = lambda model, f: np.save(f, model), 'npy'
+        return lambda model, f: np.save(f, model), 'npy'
     else:
         raise ValueError("Unknown mode [{}]".format(mode))
 
+
+def atomic_save(save_fn, obj, filename):
+    """
+    Serialize `obj` to a temporary file next to `filename` and rename it, so
+    that `filename` is never left half-written (e.g. on interruptions).
+    """
+    tmpfile = filename + '.tmp'
+    try:
+        with open(tmpfile, 'wb') as f:
+            save_fn(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpfile, filename)
+    finally:
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+
+
+def save_model(model, prefix, d=None, mode='torch'):
+    """
+    Save model using a preferred method. Model gets saved to `prefix.ext`,
+    where `ext` is derived from the selected mode. Pass `d` if you want to
+    also save a corresponding dictionary to `prefix.dict.ext`.
+
+    If target directory path doesn't exist, it will fail.
+    """
+    save_fn, ext = get_save_fn(mode)
     filename = prefix + "." + ext
 
-    with open(filename, 'wb') as f:
-        save_fn(model, f)
+    atomic_save(save_fn, model, filename)
 
     if d is not None:
-        with open(prefix + ".dict." + ext, 'wb') as f:
-            save_fn(d, f)
+        atomic_save(save_fn, d, prefix + ".dict." + ext)
 
     return filename
 
 
+def snapshot_model(model):
+    """
+    Copy of a model with its parameters and buffers copied to cpu, leaving
+    the original untouched (parameters aren't duplicated on their device).
+    Useful to serialize a model while it keeps training.
+    """
+    memo = {}
+    for t in model.state_dict(keep_vars=True).values():
+        if id(t) in memo:       # tied weights
+            continue
+        copied = t.detach().to('cpu', copy=True)
+        if isinstance(t, torch.nn.Parameter):
+            copied = torch.nn.Parameter(copied, requires_grad=t.requires_grad)
+        memo[id(t)] = copied
+    return copy.deepcopy(model, memo)
+
+
 def save_checkpoint(parent, model, args, d=None, ppl=None, suffix=None):
     """
     Save model together with dictionary and training input arguments.
@@ -147,6 +186,93 @@ def window(it):
         yield result
 
 
+# Timing
+class PhaseTimer(object):
+    """
+    Accumulate wall-clock time per phase of a loop (e.g. data fetching,
+    forward, backward, optimizer step). Each call to `mark(phase)` adds the
+    time since the previous mark (or `start`) to `phase`. Times are kept for
+    the current window (see `reset`) and in total (see `reset_total`).
+    All calls are no-ops if not enabled.
+
+    Parameters:
+    -----------
+    enabled: bool
+    sync: bool, synchronize CUDA before taking a time, so that asynchronous
+        kernels are attributed to the phase that launched them
+    """
+    def __init__(self, enabled=True, sync=True):
+        self.enabled = enabled
+        self.sync = sync
+        self.last_phase, self.last_time = None, None
+        self.reset_total()
+
+    def _now(self):
+        if self.sync and torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+        return time.time()
+
+    def reset(self):
+        "Start a new window"
+        self.window = {'seconds': {}, 'tokens': 0, 'examples': 0}
+
+    def reset_total(self):
+        self.total = {'seconds': {}, 'tokens': 0, 'examples': 0}
+        self.reset()
+
+    def start(self):
+        "Start timing without attributing the elapsed time to any phase"
+        if self.enabled:
+            self.last_phase, self.last_time = None, self._now()
+
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        now = self._now()
+        for acc in (self.window, self.total):
+            acc['seconds'][phase] = acc['seconds'].get(phase, 0) + now - self.last_time
+        self.last_phase, self.last_time = phase, now
+
+    def add(self, tokens, examples):
+        "Count processed tokens and examples (sequences)"
+        if not self.enabled:
+            return
+        for acc in (self.window, self.total):
+            acc['tokens'] += tokens
+            acc['examples'] += examples
+
+    def pack(self, total=False):
+        """
+        Summary of the current window (or the total): seconds and share of
+        time per phase and throughput (tokens/sec, examples/sec).
+        """
+        acc = self.total if total else self.window
+        duration = sum(acc['seconds'].values()) or float('nan')
+        return {'seconds': dict(acc['seconds']),
+                'share': {p: t / duration for p, t in acc['seconds'].items()},
+                'tokens/sec': acc['tokens'] / duration,
+                'examples/sec': acc['examples'] / duration}
+
+
+_PHASE_TIMER = None
+
+
+def set_phase_timer(timer):
+    "Set the timer used by `mark_phase` (None to disable it)"
+    global _PHASE_TIMER
+    _PHASE_TIMER = timer
+
+
+def mark_phase(phase):
+    """
+    Hook for models to report the end of a phase inside `model.loss` to the
+    timer of the running Trainer (e.g. `mark_phase('forward')` right before
+    calling backward, so that forward and backward are timed separately).
+    """
+    if _PHASE_TIMER is not None:
+        _PHASE_TIMER.mark(phase)
+
+
 # Initializers
 def is_bias(param_name):
     return 'bias' in param_name
@@ -384,8 +510,7 @@ def make_lm_hook(d, seed_texts=None, max_seq_len=25, device='cpu',
 
             if early_stopping is not None:
                 trainer.log("info", "Registering early stopping loss...")
-                early_stopping.add_checkpoint(
-                    loss.reduce(), copy.deepcopy(trainer.model).cpu())
+                early_stopping.add_checkpoint(loss.reduce(), trainer.model)
 
             if checkpoint is not None:
                 checkpoint.save(trainer.model, loss.reduce())
@@ -457,7 +582,8 @@ def make_schedule_hook(scheduler, verbose=True):
     def hook(trainer, epoch, batch, checkpoint):
         batches = len(trainer.datasets['train'])
         old_rate = trainer.model.exposure_rate
-        new_rate = scheduler(epoch * batches + batch)
+        # batches seen by all ranks (see Trainer.get_batch_order)
+        new_rate = scheduler(epoch * batches + batch * trainer.world_size)
         trainer.model.exposure_rate = new_rate
 
         if verbose:
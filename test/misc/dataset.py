@@ -9,7 +9,7 @@ import torch
 
 from seqmod.misc import Dict, BlockDataset, PairedDataset, CompressionTable
 from seqmod.misc import DataIter, SDAEIter, SkipthoughtIter, text_processor
-from seqmod.misc.dataset import argsort
+from seqmod.misc.dataset import argsort, BatchPrefetcher
 from seqmod import utils
 
 
@@ -230,6 +230,43 @@ class TestPairedDataset(unittest.TestCase):
             {'src': self.seq_d, 'trg': (self.tag1_d, self.tag2_d)})
 
 
+class TestBatchPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.corpus = [lorem.sentence().split() for _ in range(100)]
+        d = Dict(eos_token=utils.EOS, bos_token=utils.BOS, pad_token=utils.PAD,
+                 force_unk=True, sequential=True)
+        d.fit(self.corpus)
+        self.dataset = PairedDataset(
+            self.corpus, self.corpus, {'src': d, 'trg': d}, batch_size=10)
+
+    def test_order(self):
+        order = [3, 1, 4, 1, 5, 9, 2, 6]
+        with BatchPrefetcher(self.dataset, order, depth=3) as batches:
+            for idx, (src, trg) in zip(order, batches):
+                expected_src, expected_trg = self.dataset[idx]
+                # (padded batch, lengths)
+                self.assertTrue(torch.equal(src[0], expected_src[0]))
+                self.assertEqual(list(src[1]), list(expected_src[1]))
+                self.assertTrue(torch.equal(trg[0], expected_trg[0]))
+
+    def test_errors(self):
+        built = []
+
+        class FailingDataset(object):
+            def __getitem__(self, idx):
+                built.append(idx)
+                if idx == 2:
+                    raise IndexError(idx)
+                return idx
+
+        with self.assertRaises(IndexError):
+            with BatchPrefetcher(FailingDataset(), range(100), depth=2) as batches:
+                for _ in batches:
+                    pass
+        # pending batches are dropped after the failure
+        self.assertLess(len(built), 10)
+
+
 class TestStratify(unittest.TestCase):
     def setUp(self):
         self.sents = []
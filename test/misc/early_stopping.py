@@ -1,6 +1,9 @@
 
+import os
 import unittest
 
+import torch
+
 from seqmod.misc import early_stopping
 
 
@@ -201,3 +204,54 @@ class TestEarlyStopping(unittest.TestCase):
         smallest, model = es.get_min()
         self.assertEqual(smallest, min(test_equal['run']))
         self.assertEqual(model, test_equal['models'][-1])
+
+
+
+class TestModelSnapshots(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(1001)
+        self.model = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.Linear(4, 4))
+        self.model[1].weight = self.model[0].weight  # tied
+
+    def _train(self):
+        with torch.no_grad():
+            for p in self.model.parameters():
+                p.add_(torch.randn_like(p))
+        return {k: v.clone() for k, v in self.model.state_dict().items()}
+
+    def test_restore(self):
+        es = early_stopping.EarlyStopping(3, max_in_memory=1)
+        states, best = [], None
+        for checkpoint in [3, 2, 2.5, 2.7, 2.8]:
+            states.append(self._train())
+            try:
+                es.add_checkpoint(checkpoint, model=self.model)
+            except early_stopping.EarlyStoppingException as e:
+                _, data = e.args
+                best = data['model']
+
+        # only the best snapshot is kept in memory
+        snapshots = [x for *_, x in es.queue]
+        self.assertEqual([s for s in snapshots if s.in_memory()], [best])
+        self.assertTrue(all(os.path.isfile(s.path) for s in snapshots if s is not best))
+        self.assertIs(best.state['0.weight'], best.state['1.weight'])
+
+        model = best.restore()
+        self.assertIsNot(model, self.model)
+        for k, v in model.state_dict().items():
+            self.assertTrue(torch.equal(v, states[1][k]))
+        # also from disk (priorities are negated losses)
+        model = {p: x for p, _, x in es.queue}[-2.7].restore()
+        for k, v in model.state_dict().items():
+            self.assertTrue(torch.equal(v, states[3][k]))
+
+    def test_discard(self):
+        es = early_stopping.EarlyStopping(10, maxsize=3, max_in_memory=0)
+        for checkpoint in [1.0, 2.0, 3.0]:
+            es.add_checkpoint(checkpoint, model=self.model)
+        paths = {p: x.path for p, _, x in es.queue}
+        # queue is emptied (but the best snapshot) on the next checkpoint
+        es.add_checkpoint(4.0, model=self.model)
+        self.assertTrue(os.path.isfile(paths[-1.0]))
+        self.assertFalse(os.path.isfile(paths[-2.0]))
+        self.assertFalse(os.path.isfile(paths[-3.0]))
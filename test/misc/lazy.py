@@ -0,0 +1,83 @@
+
+import os
+import sys
+import unittest
+import subprocess
+
+import seqmod
+import seqmod.misc
+import seqmod.modules
+
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(seqmod.__file__)))
+
+# names exported by `from package import *` before packages were lazy
+MISC_NAMES = '''
+Beam BlockDataset Checkpoint CompressionTable Counter DataIter Dataset
+Dict EarlyStopping EarlyStoppingException LossStatistics MultiDict
+OrderedDict PairedDataset SDAEIter Sequence SkipthoughtIter StdLogger
+TensorboardLogger Trainer VisdomLogger argsort beam_search
+block_batchify bucketing cumsum dataset debatchify defaultdict destruct
+early_stopping exponential get_splits git inflection_sigmoid
+inverse_exponential inverse_linear linear loggers logging math
+pad_sequential_batch preprocess random schedules segmenter shuffle_pairs
+text_processor time torch trainer truncate utils
+'''.split()
+
+MODULES_NAMES = '''
+Attention AttentionalProjection BahdanauScorer BaseEncoder BaseLM
+BaseStackedRNN Beam CNNTextEncoder DCNNEncoder DotScorer Embedding
+EncoderDecoder F FullSoftmax Function GRLRNNEncoder GRLWrapper
+GeneralScorer Generator GradReverse Highway LM LogUniformSampler MLP
+MaxOut MaxoutWindowEncoder MixtureSoftmax NormalizedGRU
+NormalizedGRUCell RHN RHNCoupled RNNDecoder RNNEncoder SampledSoftmax
+StackedGRU StackedLSTM StackedNormalizedGRU attention cnn_text_encoder
+conv_utils dcnn_encoder decoder embedding encoder encoder_decoder
+exposure ff flip grad_reverse init_hidden_for lm log_uniform logging
+make_dropout_mask make_embeddings make_grl_rnn_encoder_decoder
+make_rnn_encoder_decoder nn np read_batch repackage_hidden rnn
+rnn_encoder scheduled_sampling select_cols shards softmax strip_post_eos
+swap torch torch_utils
+'''.split()
+
+
+class LazyImportTest(unittest.TestCase):
+    def test_import_is_cheap(self):
+        loaded = subprocess.check_output([sys.executable, '-c', """
+import sys, seqmod
+heavy = ('sklearn', 'hyperopt', 'visdom', 'tensorboardX', 'seqmod.modules.lm')
+print(' '.join(m for m in heavy if m in sys.modules))
+print('__commit__' in vars(seqmod))
+"""], cwd=TOPDIR).decode('utf-8').split('\n')
+        self.assertEqual(loaded[0], '')
+        self.assertEqual(loaded[1], 'False')
+
+    def test_attributes(self):
+        from seqmod.misc.dataset import Dict, BlockDataset
+        from seqmod.modules.lm import LM
+        from seqmod.modules import rnn
+        self.assertIs(seqmod.Dict, Dict)
+        self.assertIs(seqmod.misc.BlockDataset, BlockDataset)
+        self.assertIs(seqmod.modules.LM, LM)
+        self.assertIs(seqmod.modules.rnn, rnn)
+        self.assertIn('LM', vars(seqmod.modules))  # cached
+        self.assertIn('Trainer', dir(seqmod.misc))
+        with self.assertRaises(AttributeError):
+            seqmod.misc.NotAnAttribute
+
+    def test_star_import(self):
+        exported = subprocess.check_output([sys.executable, '-c', """
+names = {}
+for package in ('seqmod.misc', 'seqmod.modules', 'seqmod'):
+    namespace = {}
+    exec('from {} import *'.format(package), namespace)
+    names[package] = set(namespace) - {'__builtins__'}
+print(' '.join(names['seqmod.misc']))
+print(' '.join(names['seqmod.modules']))
+print(' '.join(names['seqmod']))
+"""], cwd=TOPDIR, stderr=subprocess.DEVNULL).decode('utf-8').split('\n')
+        misc, modules, top = [set(names.split()) for names in exported[:3]]
+        self.assertTrue(set(MISC_NAMES) <= misc)
+        self.assertTrue(set(MODULES_NAMES) <= modules)
+        self.assertTrue(misc | modules | {'Hyperband', 'GitInfo', 'utils'} <= top)
+        self.assertEqual(seqmod.modules.__all__, sorted(seqmod.modules.__all__))
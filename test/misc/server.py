@@ -0,0 +1,94 @@
+
+import json
+import asyncio
+import unittest
+
+from seqmod.misc.dataset import Dict
+from seqmod.misc.server import GenerationServer, Request
+from seqmod.misc.server import LMWorker, EncoderDecoderWorker
+from seqmod.modules.lm import LM
+from seqmod.modules.encoder_decoder import make_rnn_encoder_decoder
+
+
+def run(server, requests):
+    async def main():
+        results = await asyncio.gather(*[server.submit(r) for r in requests])
+        await server.stop()
+        return results
+
+    return asyncio.new_event_loop().run_until_complete(main())
+
+
+def post_raw(server, body):
+    # returns the status code and the decoded body
+    async def main():
+        tcp = await server.serve_http(port=0)
+        port = tcp.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('localhost', port)
+        writer.write('POST / HTTP/1.1\r\nContent-Length: {}\r\n\r\n'
+                     .format(len(body)).encode() + body)
+        response = await reader.read()
+        writer.close()
+        tcp.close()
+        await server.stop()
+        return response
+
+    response = asyncio.new_event_loop().run_until_complete(main())
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(body.decode())
+
+
+class GenerationServerTest(unittest.TestCase):
+    def setUp(self):
+        self.d = Dict(eos_token='<eos>', bos_token='<bos>', pad_token='<pad>') \
+                     .fit([list('abcdefghij')])
+        self.seeds = [list('abc'), list('d'), None, list('jihgf')]
+
+    def _test_continuous(self, make_worker, seeds):
+        def make_requests():
+            return [Request(inp=seed, method='argmax', max_seq_len=3 + idx)
+                    for idx, seed in enumerate(seeds)]
+
+        # requests admitted in batches of 2 (evicted at different steps)
+        results = run(GenerationServer(make_worker(), max_batch_size=2),
+                      make_requests())
+        for request, result in zip(make_requests(), results):
+            expected, = run(GenerationServer(make_worker()), [request])
+            self.assertEqual(result['hyp'], expected['hyp'])
+            self.assertAlmostEqual(result['score'], expected['score'], places=4)
+
+    def test_lm(self):
+        lm = LM(8, 16, self.d, cell='LSTM', num_layers=2).eval()
+        self._test_continuous(lambda: LMWorker(lm, self.d), self.seeds)
+
+    def test_encoder_decoder(self):
+        model = make_rnn_encoder_decoder(
+            1, 8, 16, self.d, att_type='general').eval()
+        self._test_continuous(lambda: EncoderDecoderWorker(model),
+                              [s or list('aa') for s in self.seeds])
+
+    def test_http_errors(self):
+        lm = LM(8, 16, self.d, cell='LSTM').eval()
+        server = GenerationServer(LMWorker(lm, self.d))
+        status, response = post_raw(server, json.dumps({'seed': 'a b'}).encode())
+        self.assertEqual(status, 200)
+        self.assertIn('hyp', response)
+        # malformed requests
+        for body in (json.dumps({'method': 'beam'}), 'not json', '[1, 2]'):
+            status, response = post_raw(server, body.encode())
+            self.assertEqual(status, 400)
+            self.assertIn('error', response)
+
+        # failing worker
+        def forward():
+            raise RuntimeError("broken worker")
+        server.worker.forward = forward
+        status, response = post_raw(server, json.dumps({'seed': 'a b'}).encode())
+        self.assertEqual(status, 500)
+        self.assertIn('broken worker', response['error'])
+
+    def test_conditional_decoder(self):
+        model = make_rnn_encoder_decoder(
+            1, 8, 16, self.d, att_type='general', cond_dims=[2], cond_vocabs=[3])
+        with self.assertRaises(ValueError):
+            EncoderDecoderWorker(model)
@@ -0,0 +1,189 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import lorem
+import torch
+
+from seqmod.misc import Dict, BlockDataset, PairedDataset, Trainer, Checkpoint
+from seqmod.misc import distributed
+from seqmod.misc.loggers import Logger
+from seqmod.modules.lm import LM
+from seqmod.modules.encoder_decoder import make_rnn_encoder_decoder
+from seqmod import utils
+
+
+class PayloadLogger(Logger):
+    def __init__(self):
+        self.payloads = []
+
+    def log(self, event, payload, verbose=True):
+        self.payloads.append((event, payload))
+
+
+class TrainerTimingTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(1001)
+        corpus = [lorem.sentence().split() for _ in range(200)]
+        self.d = Dict(eos_token=utils.EOS, bos_token=utils.BOS, sequential=True)
+        self.d.fit(corpus)
+        self.datasets = {'train': BlockDataset(corpus, self.d, 5, 10),
+                         'valid': BlockDataset(corpus[:20], self.d, 5, 10)}
+
+    def _train(self, timing):
+        model = LM(10, 12, self.d)
+        trainer = Trainer(model, self.datasets, torch.optim.SGD(model.parameters(), lr=0.1),
+                          timing=timing)
+        logger = PayloadLogger()
+        trainer.add_loggers(logger)
+        trainer.train(1, 5, run_test=False)
+        return {event: payload for event, payload in logger.payloads}
+
+    def test_timing(self):
+        payloads = self._train(True)
+        timing = payloads['checkpoint']['timing']
+        # LM reports the end of its forward pass
+        for phase in ('fetch', 'forward', 'backward', 'optimizer'):
+            self.assertIn(phase, timing['seconds'])
+        self.assertAlmostEqual(sum(timing['share'].values()), 1.0)
+        self.assertGreater(timing['tokens/sec'], 0)
+        self.assertGreater(timing['examples/sec'], 0)
+        self.assertIn('timing', payloads['epoch_end'])
+        self.assertIn('validation', payloads['validation_end']['timing']['seconds'])
+        # the model hook is disabled after training
+        self.assertIsNone(utils._PHASE_TIMER)
+
+    def test_encoder_decoder_timing(self):
+        corpus = [lorem.sentence().split() for _ in range(50)]
+        d = Dict(eos_token=utils.EOS, bos_token=utils.BOS, pad_token=utils.PAD,
+                 sequential=True).fit(corpus)
+        model = make_rnn_encoder_decoder(1, 10, 12, d, cell='GRU', att_type='dot')
+        datasets = {'train': PairedDataset(corpus, corpus, {'src': d, 'trg': d},
+                                           batch_size=5)}
+        trainer = Trainer(model, datasets, torch.optim.SGD(model.parameters(), lr=0.1),
+                          timing=True)
+        logger = PayloadLogger()
+        trainer.add_loggers(logger)
+        # several shards per batch, each one with its own backward pass
+        trainer.train(1, 5, run_test=False, split=2)
+        timing = dict(logger.payloads)['checkpoint']['timing']
+        for phase in ('forward', 'backward'):
+            self.assertIn(phase, timing['seconds'])
+        self.assertNotIn('loss', timing['seconds'])
+
+    def test_no_timing(self):
+        payloads = self._train(False)
+        for event in ('checkpoint', 'epoch_end', 'validation_end'):
+            self.assertNotIn('timing', payloads[event])
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(1001)
+        self.topdir = tempfile.mkdtemp()
+        self.model = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.Linear(4, 2))
+
+    def tearDown(self):
+        shutil.rmtree(self.topdir)
+
+    def test_background_nbest(self):
+        checkpoint = Checkpoint('test', topdir=self.topdir, keep=2).setup()
+        states = {}
+        for loss in [3.0, 2.0, 4.0, 1.0]:
+            states[loss] = {k: v.clone() for k, v in self.model.state_dict().items()}
+            checkpoint.save(self.model, loss)
+            # keep training while the model is written
+            with torch.no_grad():
+                for p in self.model.parameters():
+                    p.add_(1.0)
+        checkpoint.wait()
+
+        files = sorted(os.listdir(checkpoint.checkpoint_path()))
+        self.assertEqual(files, ['model-1.0000.pt', 'model-2.0000.pt'])
+        for modelname, loss in checkpoint.buf_best:
+            model = torch.load(modelname)
+            for k, v in model.state_dict().items():
+                self.assertTrue(torch.equal(v, states[loss][k]))
+
+        checkpoint.remove()
+        self.assertFalse(os.path.isdir(checkpoint.checkpoint_path()))
+
+
+def train_distributed(corpus, d, outdir):
+    # runs in each rank (see DistributedTrainerTest)
+    rank = distributed.get_rank()
+    torch.manual_seed(rank)  # replicas start different, rank 0 is broadcast
+    model = LM(10, 12, d)
+    datasets = {'train': BlockDataset(corpus, d, 5, 10),
+                'valid': BlockDataset(corpus[:40], d, 5, 10)}
+    trainer = Trainer(model, datasets, torch.optim.SGD(model.parameters(), lr=0.1))
+    logger = PayloadLogger()
+    trainer.add_loggers(logger)
+    batch_order = trainer.get_batch_order(True)
+    trainer.train(1, 5, run_test=False)
+    valid = trainer.validate_model()
+    # uneven orders are padded by wrapping around
+    padded = [trainer.get_batch_order(False, num_batches=n) for n in (3, 1)]
+
+    # gradients are averaged
+    for p in model.parameters():
+        p.grad = torch.full_like(p, float(rank))
+    distributed.all_reduce_grads(model)
+
+    torch.save({'state': model.state_dict(), 'valid': valid.pack(),
+                'events': [event for event, _ in logger.payloads],
+                'batch_order': batch_order, 'padded': padded,
+                'grads': [p.grad.clone() for p in model.parameters()]},
+               os.path.join(outdir, 'rank{}.pt'.format(rank)))
+
+
+class DistributedTrainerTest(unittest.TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_data_parallel(self):
+        corpus = [lorem.sentence().split() for _ in range(200)]
+        d = Dict(eos_token=utils.EOS, bos_token=utils.BOS, sequential=True)
+        d.fit(corpus)
+        distributed.spawn(train_distributed, 2, corpus, d, self.outdir, threads=1)
+        rank0, rank1 = [torch.load(os.path.join(self.outdir, 'rank{}.pt'.format(r)))
+                        for r in range(2)]
+
+        # shards of the same size covering all batches (only the padding
+        # of an odd number of batches is shared)
+        order0, order1 = set(rank0['batch_order']), set(rank1['batch_order'])
+        self.assertEqual(len(rank0['batch_order']), len(rank1['batch_order']))
+        self.assertEqual(order0 | order1,
+                         set(range(len(BlockDataset(corpus, d, 5, 10)))))
+        self.assertLessEqual(len(order0 & order1), 1)
+        # no batch is dropped, even with fewer batches than ranks
+        (three0, one0), (three1, one1) = rank0['padded'], rank1['padded']
+        self.assertEqual((len(three0), len(three1)), (2, 2))
+        self.assertEqual(len(set(three0 + three1)), 3)
+        self.assertEqual(one0, one1)
+        self.assertEqual(len(one0), 1)
+        # replicas stay in sync
+        for k, v in rank0['state'].items():
+            self.assertTrue(torch.equal(v, rank1['state'][k]))
+        for g0, g1 in zip(rank0['grads'], rank1['grads']):
+            self.assertTrue(torch.allclose(g0, torch.full_like(g0, 0.5)))
+            self.assertTrue(torch.equal(g0, g1))
+        # only rank 0 logs
+        self.assertIn('validation_end', rank0['events'])
+        self.assertEqual(rank1['events'], [])
+
+        # validation is aggregated over the full dataset
+        model = LM(10, 12, d)
+        model.load_state_dict(rank0['state'])
+        model.eval()
+        trainer = Trainer(model, {'valid': BlockDataset(corpus[:40], d, 5, 10)}, None)
+        with torch.no_grad():
+            valid = trainer.validate_model()
+        self.assertEqual(rank0['valid'], rank1['valid'])
+        # hidden state isn't carried over between the two shards
+        self.assertAlmostEqual(rank0['valid']['loss'], valid.pack()['loss'], delta=0.01)
@@ -3,6 +3,9 @@ import unittest
 
 import torch
 
+from seqmod.modules.attention import Attention
+from seqmod.modules.torch_utils import make_length_mask
+
 
 class Sum4DTest(unittest.TestCase):
     def test_sum(self):
@@ -38,3 +41,23 @@ class Sum4DTest(unittest.TestCase):
                                        .transpose(0, 2).transpose(1, 2)
 
         self.assertTrue((test_output == batched_output).all())
+
+
+class BeamAttentionTest(unittest.TestCase):
+    def test_grouped_queries(self):
+        seq_len, batch, width, dim = 6, 3, 4, 10
+        enc_outs = torch.rand(seq_len, batch, dim)
+        mask = make_length_mask(torch.tensor([6, 4, 2]))
+        # (batch * width x dim), beam entries contiguous per batch entry
+        dec_out = torch.rand(batch * width, dim)
+        beam_map = torch.arange(0, batch).unsqueeze(1).repeat(1, width).view(-1)
+
+        for scorer in ('dot', 'general', 'bahdanau'):
+            attn = Attention(dim, dim, scorer=scorer)
+            context, weights = attn(dec_out, enc_outs, mask=mask)
+            # compare against physically repeated encoder outputs
+            context2, weights2 = attn(
+                dec_out, enc_outs.index_select(1, beam_map),
+                mask=mask.index_select(0, beam_map))
+            self.assertTrue(torch.allclose(context, context2, atol=1e-6), scorer)
+            self.assertTrue(torch.allclose(weights, weights2, atol=1e-6), scorer)
@@ -2,8 +2,11 @@
 import unittest
 
 import torch
+import torch.nn.functional as F
 
-from seqmod.modules.cache import Cache
+from seqmod.modules.cache import Cache, cache_target_probs, interpolate
+from seqmod.modules.cache import evaluate_grid
+from seqmod.modules.cache_index import BruteForceIndex, IVFIndex, IVFPQIndex
 
 
 class CacheTest(unittest.TestCase):
@@ -60,3 +63,97 @@ class CacheTest(unittest.TestCase):
                     break
             self.assertTrue(checked, 'row {} was found in the cache'.format(idx))
             checked = False
+
+
+class CacheBlockTest(unittest.TestCase):
+    def setUp(self):
+        self.size, self.batch, self.dim, self.vocab = 7, 3, 8, 10
+        self.keys = torch.randn(20, self.batch, self.dim)
+        self.vals = torch.randint(0, self.vocab, (20, self.batch), dtype=torch.int64)
+        self.logits = torch.randn(20, self.batch, self.vocab)
+        self.theta, self.alpha = 0.5, 0.3
+
+    def loop(self):
+        # reference step-wise implementation
+        cache, probs = Cache(self.dim, self.size, self.vocab), []
+        for key, val, logits in zip(self.keys, self.vals, self.logits):
+            prob = F.softmax(logits, dim=1)
+            if cache.stored > 0:
+                scores, vals = cache.query(key)
+                cache_prob = F.softmax(self.theta * scores, dim=1)
+                prob = (1 - self.alpha) * prob
+                for b in range(self.batch):
+                    prob[b].index_add_(0, vals[b], self.alpha * cache_prob[b])
+            probs.append(prob.gather(1, val.unsqueeze(1)).squeeze(1))
+            cache.add(key.unsqueeze(0), val.unsqueeze(0))
+        return torch.stack(probs)
+
+    def model_probs(self):
+        return F.softmax(self.logits, dim=2).gather(2, self.vals.unsqueeze(2)).squeeze(2)
+
+    def test_query_block(self):
+        expected = self.loop()
+        cache, probs = Cache(self.dim, self.size, self.vocab), []
+        for start in range(0, 20, 6):
+            keys, vals = self.keys[start:start+6], self.vals[start:start+6]
+            scores, memvals = cache.query_block(keys, vals)
+            cache_probs, has_items = cache_target_probs(
+                scores, memvals, vals, self.theta)
+            probs.append(interpolate(self.model_probs()[start:start+6],
+                                     cache_probs, has_items, self.alpha))
+            cache.add(keys, vals)
+        self.assertTrue(torch.allclose(torch.cat(probs), expected, atol=1e-6))
+
+    def test_grid(self):
+        expected = -self.loop().add(1e-8).log().mean()
+        loss = evaluate_grid(self.keys, self.vals, self.model_probs(), self.size,
+                             [0.1, self.theta], [self.alpha, 0.1], block_size=4)
+        self.assertAlmostEqual(loss[1, 0].item(), expected.item(), places=5)
+
+
+class CacheIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dim, self.size = 16, 500
+        # well separated clusters (orthogonal centers far apart relative to the
+        # noise), so that neighbours lie in the query cluster for any draw
+        self.labels = torch.randint(0, 10, (600,))
+        centers = torch.eye(10, self.dim) * 10
+        self.keys = centers[self.labels] + torch.randn(600, self.dim) * 0.5
+        self.vals = torch.arange(0, 600)
+
+    def test_brute_force(self):
+        cache = Cache(self.dim, self.size, 600)
+        cache.add(self.keys.unsqueeze(1), self.vals.unsqueeze(1))
+        indexed = Cache(self.dim, self.size, 600, index=BruteForceIndex(self.dim, self.size))
+        indexed.add(self.keys.unsqueeze(1), self.vals.unsqueeze(1))
+        for query in torch.randn(3, 1, self.dim):
+            scores, vals = cache.query(query, topk=5)
+            index_scores, index_vals = indexed.query(query, topk=5)
+            self.assertTrue(torch.allclose(scores, index_scores, atol=1e-5))
+            self.assertEqual(vals.tolist(), index_vals.tolist())
+            # evicted items
+            self.assertTrue((index_vals >= 100).all())
+
+    def test_ivfpq(self):
+        index = IVFPQIndex(self.dim, self.size, nlist=8, num_subspaces=4,
+                           nbits=4, nprobe=8)
+        index.train(self.keys, seed=1)
+        for keys, vals in zip(self.keys.split(50), self.vals.split(50)):
+            index.add(keys, vals)
+        query = self.keys[-10:]
+        _, vals = index.search(query, 10)
+        # all clusters probed: quantization errors are small compared to the
+        # distance between clusters, so all neighbours share the query cluster
+        self.assertTrue((self.labels[vals] == self.labels[-10:].unsqueeze(1)).all())
+        self.assertTrue((vals >= 100).all())
+
+    def test_ivf(self):
+        index = IVFIndex(self.dim, self.size, nlist=8, nprobe=8)
+        index.train(self.keys, seed=1)
+        index.add(self.keys, self.vals)
+        exact = BruteForceIndex(self.dim, self.size)
+        exact.add(self.keys, self.vals)
+        query = torch.randn(4, self.dim)
+        # all clusters probed: exact search
+        self.assertEqual(index.search(query, 5)[1].tolist(),
+                         exact.search(query, 5)[1].tolist())
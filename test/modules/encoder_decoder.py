@@ -0,0 +1,130 @@
+
+import unittest
+
+import torch
+import torch.nn.functional as F
+
+from seqmod.misc import Dict
+from seqmod.modules.encoder_decoder import make_rnn_encoder_decoder
+
+
+class ScoreTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(1001)
+        self.d = Dict(bos_token='<bos>', eos_token='<eos>', pad_token='<pad>')
+        self.d.fit([list('abcdefghijklmnopqrstuvwxyz')])
+        src = [list('abcdef'), list('ghij'), list('klmnopq')]
+        self.lengths = torch.tensor([len(s) + 2 for s in src])
+        self.src = self.d.pack(list(self.d.transform(src)))
+        eos = self.d.get_eos()
+        # different numbers of candidates of different lengths per source
+        self.candidates = [
+            [[3, 4, 5, eos], [6, eos], [7, 8, 9, 10, 11]],
+            [[12, 13, eos]],
+            [[14, 15, 16, 17, eos], [18]]]
+
+    def forced_decoding(self, model, b, cand):
+        # reference: decode a single (source, candidate) pair step by step
+        length = self.lengths[b:b+1]
+        src = self.src[:length.item(), b:b+1]
+        enc_outs, enc_hidden = model.encoder(src, lengths=length)
+        state = model.decoder.init_state(enc_outs, enc_hidden, length)
+        inp = [self.d.get_bos()] + cand[:-1]
+        score = 0.0
+        for prev, target in zip(inp, cand):
+            out, _ = model.decoder(torch.tensor([prev]), state)
+            score += model.decoder.project(out)[0, target].item()
+        return score
+
+    def check_score(self, model):
+        model.eval()
+        with torch.no_grad():
+            # one and several candidates per source in each round
+            for batch_size in (3, 6):
+                scores = model.score(
+                    self.src, self.lengths, self.candidates, batch_size=batch_size)
+                for b, cands in enumerate(self.candidates):
+                    for c, cand in enumerate(cands):
+                        expected = self.forced_decoding(model, b, cand)
+                        self.assertAlmostEqual(scores[b][c], expected, places=4)
+
+    def test_score_attention(self):
+        self.check_score(make_rnn_encoder_decoder(
+            1, 16, 24, self.d, cell='LSTM', att_type='general'))
+
+    def test_score_no_attention(self):
+        self.check_score(make_rnn_encoder_decoder(
+            2, 16, 24, self.d, cell='GRU', encoder_summary='last'))
+
+    def test_score_bahdanau(self):
+        # bahdanau scores grouped queries over the projected encoder outputs
+        self.check_score(make_rnn_encoder_decoder(
+            2, 16, 24, self.d, cell='GRU', att_type='bahdanau'))
+
+    def test_empty_candidate(self):
+        model = make_rnn_encoder_decoder(
+            1, 16, 24, self.d, cell='GRU', att_type='dot').eval()
+        with self.assertRaises(ValueError):
+            model.score(self.src, self.lengths, [[[3]], [], [[]]])
+
+    def test_index_batches(self):
+        model = make_rnn_encoder_decoder(
+            1, 16, 24, self.d, cell='LSTM', att_type='bahdanau', input_feed=True).eval()
+        enc_outs, enc_hidden = model.encoder(self.src, lengths=self.lengths)
+        state = model.decoder.init_state(enc_outs, enc_hidden, self.lengths)
+        index = torch.tensor([2, 0, 2, 1])
+        new = state.index_batches(index)
+        for old_h, new_h in zip(state.hidden, new.hidden):
+            self.assertTrue(torch.equal(old_h[:, index], new_h))
+        self.assertTrue(torch.equal(state.context[:, index], new.context))
+        self.assertTrue(torch.equal(state.enc_att[:, index], new.enc_att))
+        self.assertTrue(torch.equal(state.mask[index], new.mask))
+        self.assertTrue(torch.equal(state.input_feed[index], new.input_feed))
+        self.assertIsNone(new.conds)
+        # the new state is independent from the original one
+        new.input_feed.add_(1)
+        self.assertFalse(torch.equal(state.input_feed[index], new.input_feed))
+
+
+class DecoderLossTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(1001)
+        self.d = Dict(bos_token='<bos>', eos_token='<eos>', pad_token='<pad>')
+        self.d.fit([list('abcdefghijklmnopqrstuvwxyz')])
+
+    def test_skip_padding(self):
+        model = make_rnn_encoder_decoder(
+            1, 16, 24, self.d, cell='LSTM', att_type='general')
+        src, src_lengths = self.d.pack(
+            list(self.d.transform([list('abcdef'), list('ghij'), list('kl')])),
+            return_lengths=True)
+        trg, trg_lengths = self.d.pack(
+            list(self.d.transform([list('mnop'), list('qrstuvw'), list('x')])),
+            return_lengths=True)
+        src_lengths, trg_lengths = torch.tensor(src_lengths), torch.tensor(trg_lengths)
+        inp, targets = trg[:-1], trg[1:]
+        self.assertTrue((targets == self.d.get_pad()).any())
+        num_examples = trg_lengths.sum().item()
+
+        def run(loss_fn):
+            model.zero_grad()
+            enc_outs, enc_hidden = model.encoder(src, lengths=src_lengths)
+            state = model.decoder.init_state(enc_outs, enc_hidden, src_lengths)
+            loss = loss_fn(state)
+            return loss, [p.grad.clone() for p in model.parameters()]
+
+        def unfiltered(state):
+            # project all positions, padding is ignored by nll_weight
+            outs = torch.stack([model.decoder(t, state)[0] for t in inp])
+            loss = F.nll_loss(
+                model.decoder.project(outs.view(-1, outs.size(-1))), targets.view(-1),
+                weight=model.nll_weight, reduction='sum') / num_examples
+            loss.backward()
+            return loss.item()
+
+        loss, grads = run(lambda state: model.decoder_loss(
+            state, inp, targets, num_examples, split=2))
+        expected, expected_grads = run(unfiltered)
+        self.assertAlmostEqual(loss, expected, places=5)
+        for grad, expected_grad in zip(grads, expected_grads):
+            self.assertTrue(torch.allclose(grad, expected_grad, atol=1e-6))
@@ -0,0 +1,118 @@
+
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+from seqmod.misc import Dict
+from seqmod.modules.lm import LM
+from seqmod.modules.encoder_decoder import make_rnn_encoder_decoder
+from seqmod.modules.export import export_traced
+from seqmod.runtime import TracedModel
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(1001)
+        self.d = Dict(bos_token='<bos>', eos_token='<eos>', pad_token='<pad>')
+        self.d.fit([list('abcdefghijklmnopqrstuvwxyz')])
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _tokens(self, hyp):
+        eos = self.d.get_eos()
+        hyp = hyp[:hyp.index(eos)] if eos in hyp else hyp
+        specials = (self.d.get_bos(), eos, self.d.get_pad())
+        return [self.d.vocab[i] for i in hyp if i not in specials]
+
+    def test_encoder_decoder(self):
+        model = make_rnn_encoder_decoder(
+            1, 16, 32, self.d, cell='LSTM', att_type='general',
+            input_feed=True).eval()
+        runtime = TracedModel(export_traced(model, self.path))
+
+        inputs = [list('abcdef'), list('ghij'), list('klm')]
+        src, lengths = self.d.pack(list(self.d.transform(inputs)), return_lengths=True)
+        lengths = torch.tensor(lengths)
+        # input_feed is initialized with noise, seed to get the same one
+        with torch.no_grad():
+            torch.manual_seed(1001)
+            scores, hyps, _ = model.translate(src, lengths)
+            torch.manual_seed(1001)
+            beam_scores, beam_hyps, _ = model.translate_beam(src, lengths, beam_width=3)
+
+        torch.manual_seed(1001)
+        traced_scores, traced_hyps = runtime.generate(inputs)
+        self.assertEqual(traced_hyps, [self._tokens(h) for h in hyps])
+        for score, expected in zip(traced_scores, scores):
+            self.assertAlmostEqual(score, expected, places=4)
+
+        torch.manual_seed(1001)
+        traced_scores, traced_hyps = runtime.beam(inputs, width=3)
+        self.assertEqual(traced_hyps, [self._tokens(h) for h in beam_hyps])
+        for score, expected in zip(traced_scores, beam_scores):
+            self.assertAlmostEqual(score, expected, places=4)
+
+    def test_encoder_decoder_sample(self):
+        model = make_rnn_encoder_decoder(
+            1, 16, 32, self.d, cell='GRU', att_type='general').eval()
+        runtime = TracedModel(export_traced(model, self.path))
+
+        inputs = [list('abcdef'), list('ghij'), list('klm')]
+        src, lengths = self.d.pack(list(self.d.transform(inputs)), return_lengths=True)
+        lengths = torch.tensor(lengths)
+        # same seed, same samples
+        with torch.no_grad():
+            torch.manual_seed(1001)
+            scores, hyps, _ = model.translate(src, lengths, sample=True, tau=0.5)
+
+        torch.manual_seed(1001)
+        traced_scores, traced_hyps = runtime.generate(
+            inputs, sample=True, temperature=0.5)
+        self.assertEqual(traced_hyps, [self._tokens(h) for h in hyps])
+        for score, expected in zip(traced_scores, scores):
+            self.assertAlmostEqual(score, expected, places=4)
+
+    def _greedy(self, model, d, prefix, max_len):
+        # eager greedy decoding
+        with torch.no_grad():
+            inp = torch.tensor([list(d.transform([prefix]))[0]]).t()
+            if d.get_eos() is not None:
+                inp = inp[:-1]
+            outs, hidden, _ = model(inp)
+            out, expected = outs[-1], []
+            for _ in range(max_len):
+                prev = model.project(out).max(1)[1]
+                if prev.item() == d.get_eos():
+                    break
+                expected.append(d.vocab[prev.item()])
+                outs, hidden, _ = model(prev.unsqueeze(0), hidden=hidden)
+                out = outs[-1]
+        return expected
+
+    def test_lm(self):
+        model = LM(16, 32, self.d, num_layers=2, cell='LSTM').eval()
+        runtime = TracedModel(export_traced(model, self.path))
+
+        prefix = list('hello')
+        # shorter prefix first to exercise sorting for packing
+        _, (_, hyp) = runtime.generate([list('ab'), prefix], max_len=10)
+        self.assertEqual(hyp, self._greedy(model, self.d, prefix, 10))
+
+    def test_lm_without_eos(self):
+        # no special symbols to strip from the output either
+        d = Dict().fit([list('abcdefghijklmnopqrstuvwxyz')])
+        model = LM(16, 32, d, cell='GRU').eval()
+        runtime = TracedModel(export_traced(model, self.path))
+
+        prefix = list('hello')
+        # decoding only stops at max_len
+        _, (_, hyp) = runtime.generate([list('ab'), prefix], max_len=7)
+        self.assertEqual(hyp, self._greedy(model, d, prefix, 7))
+        _, hyps = runtime.generate([prefix], max_len=7, sample=True)
+        self.assertEqual(len(hyps[0]), 7)
+        _, hyps = runtime.beam([list('ab'), prefix], width=3, max_len=7)
+        self.assertEqual([len(hyp) for hyp in hyps], [7, 7])
@@ -0,0 +1,155 @@
+
+import unittest
+
+import numpy as np
+import torch
+
+from seqmod.misc.dataset import Dict
+from seqmod.modules.lm import AttentionalProjection, LM
+from seqmod.modules.lm import read_batch, read_batch_iterative
+from seqmod.modules.prefix_cache import PrefixCache
+
+
+class AttentionalProjectionTest(unittest.TestCase):
+    def setUp(self):
+        seq_len, batch, hid_dim = 7, 3, 16
+        self.attn = AttentionalProjection(10, hid_dim, hid_dim)
+        self.outs = torch.randn(seq_len, batch, hid_dim)
+        self.emb = torch.randn(seq_len, batch, hid_dim)
+
+    def loop(self, outs, emb):
+        # reference step-wise implementation
+        attn = self.attn
+        emb_att = attn.attn.scorer.project_enc_outs(emb)
+        output, weights = [], []
+        for idx, hid in enumerate(outs):
+            t = max(0, idx - 1)
+            context, weight = attn.attn(
+                outs[t], emb[:max(1, t)], enc_att=emb_att[:max(1, t)])
+            output.append(attn.hid2hid(hid) + attn.emb2hid(context))
+            weights.append(weight)
+        return torch.stack(output), weights
+
+    def test_causal(self):
+        with torch.no_grad():
+            expected, expected_weights = self.loop(self.outs, self.emb)
+            output, weights = self.attn(self.outs, self.emb)
+        self.assertTrue(torch.allclose(output, expected, atol=1e-6))
+        for weight, expected_weight in zip(weights, expected_weights):
+            self.assertTrue(torch.allclose(weight, expected_weight, atol=1e-6))
+
+    def test_incremental(self):
+        with torch.no_grad():
+            expected, _ = self.attn(self.outs, self.emb)
+            cache, output = {}, []
+            for step in range(len(self.outs)):
+                out, _ = self.attn(
+                    self.outs[step:step+1], self.emb[step:step+1], cache=cache)
+                output.append(out)
+        self.assertTrue(torch.allclose(torch.cat(output), expected, atol=1e-6))
+
+
+class ReadBatchTest(unittest.TestCase):
+    def test_packed(self):
+        d = Dict(pad_token='<pad>').fit([list('abcdefghij')])
+        seeds = [[3, 4, 5, 6], [4, 5], [7, 8, 9, 10, 3], [6, 6, 6]]
+        for cell in ('GRU', 'LSTM', 'RHN', 'RHNCoupled'):
+            lm = LM(8, 16, d, cell=cell, num_layers=2, dropout=0.0).eval()
+            if cell.startswith('RHN'):
+                # RHN samples its own dropout masks (also in eval mode)
+                lm.rnn.input_dropout = lm.rnn.hidden_dropout = 0.0
+            with torch.no_grad():
+                prev, hidden = read_batch(lm, seeds)
+                expected_prev, expected_hidden = read_batch_iterative(lm, seeds)
+            self.assertEqual(prev.tolist(), expected_prev.tolist())
+            if cell == 'LSTM':
+                hidden, expected_hidden = hidden[0], expected_hidden[0]
+            self.assertTrue(torch.allclose(hidden, expected_hidden, atol=1e-6))
+
+
+class PrefixCacheTest(unittest.TestCase):
+    def setUp(self):
+        d = Dict(pad_token='<pad>').fit([list('abcdefghij')])
+        self.lm = LM(8, 16, d, cell='LSTM', num_layers=2).eval()
+        prefix = [3, 4, 5, 6, 7, 8, 9, 10, 3, 4]
+        self.seqs = [prefix + [5, 6], prefix + [7], [4, 5, 6], prefix[:5]]
+
+    def test_scores(self):
+        cache = PrefixCache(block_size=4)
+        expected = list(self.lm.score_sequences(self.seqs, batch_size=3))
+        for _ in range(2):
+            scores = list(self.lm.score_sequences(
+                self.seqs, batch_size=3, prefix_cache=cache))
+            self.assertTrue(np.allclose(scores, expected, atol=1e-5))
+        self.assertTrue(cache.stats()['saved_tokens'] > 0)
+        # read_batch resumes from the cached states
+        with torch.no_grad():
+            _, (hidden, _) = read_batch(self.lm, self.seqs, prefix_cache=cache)
+            _, (expected_hidden, _) = read_batch(self.lm, self.seqs)
+        self.assertTrue(torch.allclose(hidden, expected_hidden, atol=1e-6))
+
+    def test_custom_cell(self):
+        # cells without variable length support are read one at a time
+        d = Dict(pad_token='<pad>').fit([list('abcdefghij')])
+        lm = LM(8, 16, d, cell='NormalizedGRU').eval()
+        expected = []
+        with torch.no_grad():
+            for seq in self.seqs:
+                outs, _, _ = lm(torch.tensor(seq[:-1]).unsqueeze(1))
+                logprobs = lm.project(outs, reshape=True).squeeze(1)
+                expected.append(logprobs.gather(
+                    1, torch.tensor(seq[1:]).unsqueeze(1)).sum().item())
+        for cache in (None, PrefixCache(block_size=4), PrefixCache(block_size=4)):
+            scores = list(lm.score_sequences(self.seqs, prefix_cache=cache))
+            self.assertTrue(np.allclose(scores, expected, atol=1e-5))
+            scores = [s for s, _ in lm.score_corpus(
+                self.seqs, batch_tokens=20, prefix_cache=cache)]
+            self.assertTrue(np.allclose(scores, expected, atol=1e-5))
+
+    def test_eviction(self):
+        cache = PrefixCache(block_size=2, max_bytes=2 * 2 * 2 * 16 * 4)
+        list(self.lm.score_sequences(self.seqs, prefix_cache=cache))
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.nbytes <= cache.max_bytes)
+
+
+class ScoreCorpusTest(unittest.TestCase):
+    def test_score_corpus(self):
+        d = Dict(pad_token='<pad>', bos_token='<bos>').fit([list('abcdefghij')])
+        lm = LM(8, 16, d, cell='GRU').eval()
+        sents = [list('abcdefg'), list('ab'), list('jihgfedcba'), list('cc')]
+        results = list(lm.score_corpus(sents, d=d, batch_tokens=10, buffer_size=3))
+        self.assertEqual(len(results), len(sents))
+        for sent, (log_prob, ppl) in zip(sents, results):
+            inp = torch.tensor(list(d.transform([sent]))[0]).unsqueeze(1)
+            expected = lm.predict_proba(inp)[0]
+            self.assertAlmostEqual(np.exp(log_prob / len(sent)), expected, places=5)
+            self.assertAlmostEqual(ppl, 1 / expected, places=3)
+
+    def test_short_sentences(self):
+        d = Dict(pad_token='<pad>', bos_token='<bos>').fit([list('abcdefghij')])
+        lm = LM(8, 16, d, cell='GRU').eval()
+        # empty sentences are just <bos> and can't be scored
+        sents = [list('abc'), [], list('de'), [], list('fghij')]
+        results = list(lm.score_corpus(sents, d=d, batch_tokens=10, buffer_size=2))
+        self.assertEqual(len(results), len(sents))
+        for sent, (log_prob, ppl) in zip(sents, results):
+            if not sent:
+                self.assertTrue(np.isnan(log_prob) and np.isnan(ppl))
+        expected = list(lm.score_corpus([s for s in sents if s], d=d))
+        self.assertTrue(np.allclose(
+            [r for r, s in zip(results, sents) if s], expected, atol=1e-5))
+        # score_sequences agrees in both batching modes
+        seqs = list(d.transform(sents))
+        self.assertTrue(np.allclose(
+            list(lm.score_sequences(seqs, batch_size=2)),
+            [log_prob for log_prob, _ in results], atol=1e-5, equal_nan=True))
+
+
+class JitTest(unittest.TestCase):
+    def test_custom_cells(self):
+        d = Dict(pad_token='<pad>').fit([list('abcdefghij')])
+        for cell in ('NormalizedGRU', 'RHN', 'RHNCoupled'):
+            for jit in (False, True):
+                lm = LM(8, 16, d, cell=cell, jit=jit)
+                self.assertEqual(lm.rnn.jit, jit)
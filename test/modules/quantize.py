@@ -0,0 +1,60 @@
+
+import unittest
+
+import torch
+
+from seqmod.misc import Dict
+from seqmod.modules.lm import LM
+from seqmod.modules.encoder_decoder import make_rnn_encoder_decoder
+from seqmod.modules.quantize import quantize_dynamic, model_bytes
+
+
+class QuantizeTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(1001)
+        self.d = Dict(bos_token='<bos>', eos_token='<eos>', pad_token='<pad>')
+        self.d.fit([list('abcdefghijklmnopqrstuvwxyz')])
+
+    def test_lm(self):
+        model = LM(64, 64, self.d, num_layers=2, cell='LSTM', tie_weights=True).eval()
+        quantized = quantize_dynamic(model)
+        # float model and tied input embeddings are left untouched
+        self.assertIs(model.project.output_emb.weight, model.embeddings.weight)
+        self.assertTrue(torch.equal(
+            quantized.embeddings.weight, model.embeddings.weight))
+        self.assertLess(model_bytes(quantized), model_bytes(model))
+
+        sents = list(self.d.transform([list('abcde'), list('hello'), list('xyz')]))
+        expected = [s for s, _ in model.score_corpus(sents)]
+        scores = [s for s, _ in quantized.score_corpus(sents)]
+        for score, expected_score in zip(scores, expected):
+            self.assertAlmostEqual(score, expected_score, delta=0.1)
+
+        # shortlisted projection (dequantized shortlisted rows)
+        inp = torch.randn(3, 64)
+        ids = torch.tensor([2, 5, 7])
+        with torch.no_grad():
+            full = model.project(inp, normalize=False)
+            short = quantized.project(inp, normalize=False, shortlist=ids)
+        self.assertEqual(short.size(), (3, 3))
+        self.assertTrue(torch.allclose(full.index_select(1, ids), short, atol=0.5))
+
+        # generation
+        for method in ('argmax', 'sample', 'beam'):
+            for batch_size in (1, 3):
+                _, hyps = quantized.generate(
+                    self.d, method=method, seed_texts=[list('abc')], max_seq_len=5,
+                    batch_size=batch_size, width=batch_size)
+                self.assertEqual(len(hyps), batch_size)
+
+    def test_encoder_decoder(self):
+        model = make_rnn_encoder_decoder(
+            1, 32, 64, self.d, cell='LSTM', att_type='general', input_feed=True).eval()
+        quantized = quantize_dynamic(model)
+        src = torch.tensor(list(self.d.transform([list('abcdef'), list('ghijkl')]))).t()
+        lengths = torch.tensor([8, 8])
+        with torch.no_grad():
+            _, hyps, _ = quantized.translate(src, lengths)
+            _, beam_hyps, _ = quantized.translate_beam(src, lengths, beam_width=3)
+        self.assertEqual(len(hyps), 2)
+        self.assertEqual(len(beam_hyps), 2)
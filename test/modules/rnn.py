@@ -0,0 +1,72 @@
+
+import unittest
+
+import torch
+
+from seqmod.modules.rnn import RHN, RHNCoupled
+from seqmod.modules.rnn import StackedLSTM, StackedGRU, StackedNormalizedGRU
+from seqmod.modules.rnn import NormalizedGRU
+
+
+class FusedRHNTest(unittest.TestCase):
+    def _test_parity(self, cls, tied_noise):
+        rnn = cls(10, 16, num_layers=3, tied_noise=tied_noise)
+        inp, hidden = torch.randn(7, 4, 10), torch.randn(1, 4, 16)
+        outputs, grads = [], []
+        for fused in (False, True):
+            rnn.fused = fused
+            rnn.zero_grad()
+            torch.manual_seed(1001)  # same dropout masks
+            out, last = rnn(inp, hidden)
+            out.sum().backward()
+            outputs.append((out, last))
+            grads.append([p.grad.clone() for p in rnn.parameters()
+                          if p.grad is not None])
+        (out, last), (expected, expected_last) = outputs[1], outputs[0]
+        self.assertTrue(torch.allclose(out, expected, atol=1e-6))
+        self.assertTrue(torch.allclose(last, expected_last, atol=1e-6))
+        for grad, expected_grad in zip(grads[1], grads[0]):
+            self.assertTrue(torch.allclose(grad, expected_grad, atol=1e-5))
+
+    def test_rhn(self):
+        self._test_parity(RHN, True)
+        self._test_parity(RHN, False)
+
+    def test_rhn_coupled(self):
+        self._test_parity(RHNCoupled, True)
+        self._test_parity(RHNCoupled, False)
+
+
+class ScriptedStackedRNNTest(unittest.TestCase):
+    def _run(self, rnn, inp, hidden, jit, **kwargs):
+        rnn.jit = jit
+        rnn.zero_grad()
+        torch.manual_seed(1001)  # same dropout masks
+        out, last = rnn(inp, hidden, **kwargs)
+        out.sum().backward()
+        if isinstance(last, tuple):
+            last = torch.cat(last)
+        return out, last, [p.grad.clone() for p in rnn.parameters()]
+
+    def _test_parity(self, rnn, inp, hidden, **kwargs):
+        out, last, grads = self._run(rnn, inp, hidden, True, **kwargs)
+        expected, expected_last, expected_grads = self._run(
+            rnn, inp, hidden, False, **kwargs)
+        self.assertTrue(torch.allclose(out, expected, atol=1e-6))
+        self.assertTrue(torch.allclose(last, expected_last, atol=1e-6))
+        for grad, expected_grad in zip(grads, expected_grads):
+            self.assertTrue(torch.allclose(grad, expected_grad, atol=1e-5))
+
+    def test_stacked(self):
+        inp, hidden = torch.randn(4, 10), torch.randn(3, 4, 16)
+        for cls in (StackedLSTM, StackedGRU, StackedNormalizedGRU):
+            for bias in (True, False):
+                rnn = cls(3, 10, 16, dropout=0.3, bias=bias)
+                h = (hidden, torch.randn(3, 4, 16)) if cls is StackedLSTM else hidden
+                self._test_parity(rnn, inp, h)
+                self._test_parity(
+                    rnn, inp, h, dropout_mask=torch.bernoulli(torch.rand(4, 16)))
+
+    def test_normalized_gru(self):
+        rnn = NormalizedGRU(10, 16, 2, dropout=0.3)
+        self._test_parity(rnn, torch.randn(7, 4, 10), torch.randn(2, 4, 16))
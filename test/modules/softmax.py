@@ -0,0 +1,194 @@
+
+import pickle
+import unittest
+
+import torch
+
+from seqmod.misc.dataset import Dict
+from seqmod.modules.softmax import FullSoftmax, MixtureSoftmax, AdaptiveSoftmax
+from seqmod.modules.softmax import SampledSoftmax, chunked_cross_entropy
+from seqmod.modules.log_uniform import TorchLogUniformSampler
+from seqmod.modules.shortlist import Shortlist
+
+
+class ShortlistTest(unittest.TestCase):
+    def setUp(self):
+        self.vocab, self.hid_dim, self.emb_dim = 20, 10, 8
+        self.output = torch.randn(3, 4, self.hid_dim)
+        self.shortlist = Shortlist(5, lex_table={1: [12, 17]}, include=[19])
+
+    def test_candidates(self):
+        ids = self.shortlist(torch.tensor([[1, 7], [8, 1]]))
+        self.assertEqual(ids.tolist(), [0, 1, 2, 3, 4, 12, 17, 19])
+        ids = self.shortlist([[7, 8]])
+        self.assertEqual(ids.tolist(), [0, 1, 2, 3, 4, 19])
+
+    def test_clamp_and_exclude(self):
+        shortlist = Shortlist(50, lex_table={1: [0, 12]}, exclude=[0],
+                              vocab_size=self.vocab)
+        ids = shortlist([[1]])
+        self.assertEqual(ids.tolist(), list(range(1, self.vocab)))
+
+    def test_from_dicts(self):
+        d = Dict(pad_token='<pad>', eos_token='<eos>').fit([list('abc')])
+        ids = Shortlist.from_dicts(d, 100)([[]])
+        self.assertEqual(ids.tolist(), [i for i in range(len(d)) if i != d.get_pad()])
+
+    def _test_softmax(self, softmax):
+        ids = self.shortlist(torch.tensor([1]))
+        with torch.no_grad():
+            logits = softmax(self.output, reshape=True, normalize=False)
+            short = softmax(self.output, reshape=True, normalize=False,
+                            shortlist=ids)
+        self.assertEqual(short.size(), (3, 4, len(ids)))
+        self.assertTrue(torch.allclose(
+            logits.index_select(2, ids), short, atol=1e-6))
+
+    def test_full_softmax(self):
+        self._test_softmax(FullSoftmax(self.hid_dim, self.emb_dim, self.vocab))
+
+    def test_full_vocab_mixture_softmax(self):
+        softmax = MixtureSoftmax(self.hid_dim, self.emb_dim, self.vocab)
+        ids = Shortlist(self.vocab)([])
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(
+                softmax(self.output), softmax(self.output, shortlist=ids)))
+
+
+class AdaptiveSoftmaxTest(unittest.TestCase):
+    def setUp(self):
+        self.vocab, self.hid_dim = 50, 16
+        self.softmax = AdaptiveSoftmax(self.hid_dim, self.vocab, cutoffs=[10, 30])
+        self.output = torch.randn(5, 3, self.hid_dim)
+
+    def test_normalized(self):
+        with torch.no_grad():
+            logprobs = self.softmax(self.output, reshape=True)
+        self.assertEqual(logprobs.size(), (5, 3, self.vocab))
+        self.assertTrue(torch.allclose(
+            logprobs.exp().sum(2), torch.ones(5, 3), atol=1e-5))
+
+    def test_shortlist(self):
+        with self.assertRaises(ValueError):
+            self.softmax(self.output, shortlist=torch.tensor([0, 1]))
+
+    def test_target_log_probs(self):
+        targets = torch.randint(0, self.vocab, (5 * 3,), dtype=torch.int64)
+        targets[:3] = torch.tensor([0, 15, 45])  # cover all clusters
+        with torch.no_grad():
+            logprobs = self.softmax(self.output)
+            target_logprobs = self.softmax(self.output, targets=targets)
+        self.assertTrue(torch.allclose(
+            logprobs.gather(1, targets.unsqueeze(1)).squeeze(1),
+            target_logprobs, atol=1e-5))
+
+
+class SampledSoftmaxTest(unittest.TestCase):
+    def test_sampler(self):
+        sampler = TorchLogUniformSampler(1000)
+        labels = torch.tensor([0, 1, 2, 500, 999])
+        samples, true_freq, sample_freq = sampler.sample(100, labels)
+        self.assertEqual(len(set(samples.tolist())), 100)
+        self.assertEqual(true_freq.size(), (5,))
+        self.assertEqual(sample_freq.size(), (100,))
+        rows, cols = sampler.accidental_match(labels, samples)
+        expected = [(r, c) for r, label in enumerate(labels.tolist())
+                    for c, sample in enumerate(samples.tolist())
+                    if label == sample]
+        self.assertEqual(list(zip(rows.tolist(), cols.tolist())), expected)
+
+    def test_training(self):
+        softmax = SampledSoftmax(10, 10, 200, nsampled=20)
+        targets = torch.tensor([0, 1, 2, 150])
+        logits, new_targets = softmax(
+            torch.randn(4, 10), targets=targets, normalize=False)
+        self.assertEqual(logits.size(), (4, 21))
+        self.assertEqual(new_targets.tolist(), [0, 0, 0, 0])
+        # module should be picklable
+        pickle.loads(pickle.dumps(softmax))
+
+
+class ChunkedCrossEntropyTest(unittest.TestCase):
+    def test_gradients(self):
+        vocab, hid_dim, rows = 30, 8, 13
+        output = torch.randn(rows, hid_dim, dtype=torch.float64, requires_grad=True)
+        weight = torch.randn(vocab, hid_dim, dtype=torch.float64, requires_grad=True)
+        bias = torch.randn(vocab, dtype=torch.float64, requires_grad=True)
+        targets = torch.randint(0, vocab, (rows,), dtype=torch.int64)
+        class_weight = torch.ones(vocab, dtype=torch.float64)
+        class_weight[targets[0]] = 0
+
+        loss = chunked_cross_entropy(
+            output, weight, bias, targets, class_weight=class_weight, chunk_size=4)
+        grads = torch.autograd.grad(loss, (output, weight, bias))
+        expected = torch.nn.functional.nll_loss(
+            torch.nn.functional.log_softmax(output @ weight.t() + bias, dim=1),
+            targets, weight=class_weight, size_average=False)
+        expected_grads = torch.autograd.grad(expected, (output, weight, bias))
+
+        self.assertTrue(torch.allclose(loss, expected))
+        for grad, expected_grad in zip(grads, expected_grads):
+            self.assertTrue(torch.allclose(grad, expected_grad))
+
+
+class MixtureSoftmaxTest(unittest.TestCase):
+    def setUp(self):
+        self.vocab, self.hid_dim, self.emb_dim = 30, 10, 8
+        self.softmax = MixtureSoftmax(
+            self.hid_dim, self.emb_dim, self.vocab, mixtures=3).eval()
+        self.output = torch.randn(5, 3, self.hid_dim)
+
+    def _reference(self, output):
+        # mixture of probabilities
+        softmax, output = self.softmax, output.view(-1, self.hid_dim)
+        priors = torch.nn.functional.softmax(softmax.mixture_priors(output), dim=1)
+        latent = softmax.mixture_latent(output).view(-1, softmax.emb_dim)
+        probs = torch.nn.functional.softmax(softmax.output_emb(latent), dim=1)
+        probs = probs.view(-1, softmax.mixtures, self.vocab)
+        return (probs * priors.unsqueeze(2)).sum(1).log()
+
+    def test_log_space(self):
+        with torch.no_grad():
+            expected = self._reference(self.output)
+            self.assertTrue(torch.allclose(
+                self.softmax(self.output), expected, atol=1e-5))
+            self.softmax.chunk_size = 4
+            self.assertTrue(torch.allclose(
+                self.softmax(self.output), expected, atol=1e-5))
+
+    def test_targets(self):
+        targets = torch.randint(0, self.vocab, (5, 3), dtype=torch.int64)
+        with torch.no_grad():
+            logprobs = self.softmax(self.output)
+            target_logprobs = self.softmax(self.output, targets=targets)
+        self.assertTrue(torch.allclose(
+            logprobs.gather(1, targets.view(-1, 1)).squeeze(1),
+            target_logprobs, atol=1e-5))
+
+    def test_gradients(self):
+        self.softmax.train()  # no dropout
+        targets = torch.randint(0, self.vocab, (5, 3), dtype=torch.int64)
+
+        def grads(loss):
+            self.softmax.zero_grad()
+            loss.backward()
+            return [p.grad.clone() for p in self.softmax.parameters()]
+
+        expected = grads(-self._reference(self.output).gather(
+            1, targets.view(-1, 1)).sum())
+        # no logits are kept for the backward pass (they are recomputed)
+        saved = []
+        with torch.autograd.graph.saved_tensors_hooks(
+                lambda t: saved.append(t.size()) or t, lambda t: t):
+            loss = -self.softmax(self.output, targets=targets).sum()
+        self.assertNotIn((5 * 3, self.vocab), saved)
+        for grad, expected_grad in zip(grads(loss), expected):
+            self.assertTrue(torch.allclose(grad, expected_grad, atol=1e-5))
+
+    def test_neg_inf(self):
+        # e.g. mixtures with zero prior for all rows
+        log_priors = torch.full((4, self.softmax.mixtures), -float('inf'))
+        latent = torch.randn(4, self.softmax.mixtures, self.emb_dim)
+        with torch.no_grad():
+            output = self.softmax._mixture_log_probs(log_priors, latent)
+        self.assertTrue((output == -float('inf')).all())